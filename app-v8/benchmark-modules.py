@@ -0,0 +1,228 @@
+import argparse
+import json
+import math
+import platform
+import statistics
+import sys
+import time
+import torch
+
+from torch.profiler import profile, ProfilerActivity
+
+from libft2gan.multichannel_linear import MultichannelLinear
+from libft2gan.multichannel_layernorm import MultichannelLayerNorm
+from libft2gan.multichannel_multihead_attention import MultichannelMultiheadAttention
+from libft2gan.convolutional_multihead_attention import ConvolutionalMultiheadAttention
+from libft2gan.convolutional_embedding import ConvolutionalEmbedding
+from libft2gan.frame_conv import FrameConv
+from libft2gan.res_block import ResBlock
+from libft2gan.frame_transformer import FrameTransformerEncoder, FrameTransformerDecoder
+
+MODULES = ['MultichannelLinear', 'MultichannelLayerNorm', 'MultichannelMultiheadAttention', 'ConvolutionalMultiheadAttention', 'ResBlock', 'FrameConv', 'ConvolutionalEmbedding', 'FrameTransformerEncoder', 'FrameTransformerDecoder']
+
+# compared against the baseline, time in milliseconds and memory in megabytes
+METRICS = ['forward_ms', 'backward_ms', 'peak_mb', 'allocations']
+
+def unet_levels(channels, n_fft):
+    # (channels, features) at each level of libft2gan.frame_transformer.FrameTransformer, enc1 to enc6
+    max_bin = n_fft // 2
+    return [(channels * m, max_bin // 2 ** i) for i, m in enumerate([1, 2, 4, 6, 8, 10])]
+
+def cases(args, cropsize):
+    # yields (name, config, build) for every module at the shapes the u-net runs it at; build returns the module and
+    # its forward arguments
+    b, w, a, heads = args.batch_size, cropsize, args.num_attention_maps, args.num_heads
+    levels = unet_levels(args.channels, args.n_fft)
+
+    def x(c, f):
+        return torch.randn(b, c, f, w)
+
+    def qk():
+        return torch.randn(b, a, heads, w, w)
+
+    for i, (c, f) in enumerate(levels):
+        yield 'MultichannelLinear', { 'channels': a, 'features': f, 'depthwise': False }, lambda f=f: (MultichannelLinear(a, a, f, f), (x(a, f),))
+        yield 'MultichannelLinear', { 'channels': a, 'features': f, 'depthwise': True }, lambda f=f: (MultichannelLinear(a, a, f, f, depthwise=True), (x(a, f),))
+        yield 'MultichannelLayerNorm', { 'channels': c, 'features': f }, lambda c=c, f=f: (MultichannelLayerNorm(c, f), (x(c, f),))
+        yield 'MultichannelMultiheadAttention', { 'channels': c, 'features': f }, lambda c=c, f=f: (MultichannelMultiheadAttention(c, a, heads, f), (x(c, f),))
+        yield 'FrameConv', { 'channels': c, 'features': f }, lambda c=c, f=f: (FrameConv(c, c, f, f), (x(c, f),))
+
+        # attends over every bin of every frame, so only the deeper levels fit in memory
+        conv_heads = math.gcd(c // 2, heads)
+        if b * conv_heads * (f * w) ** 2 * 4 <= args.max_attention_mb * 1024 ** 2:
+            yield 'ConvolutionalMultiheadAttention', { 'channels': c, 'features': f, 'num_heads': conv_heads }, lambda c=c, f=f, conv_heads=conv_heads: (ConvolutionalMultiheadAttention(c, conv_heads), (x(c, f),))
+
+        if i == 0:
+            yield 'ResBlock', { 'in_channels': 3, 'out_channels': c, 'features': f, 'downsample': False }, lambda c=c, f=f: (ResBlock(3, c, f), (x(3, f),))
+        else:
+            pc, pf = levels[i - 1]
+            yield 'ResBlock', { 'in_channels': pc, 'out_channels': c, 'features': pf, 'downsample': True }, lambda c=c, pc=pc, pf=pf: (ResBlock(pc, c, pf, downsample=True), (x(pc, pf),))
+
+        if i < len(levels) - 1:
+            nc = levels[i + 1][0]
+            yield 'ResBlock', { 'in_channels': nc + c, 'out_channels': c, 'features': f, 'downsample': False }, lambda c=c, f=f, nc=nc: (ResBlock(nc + c, c, f), (x(nc + c, f),))
+
+        yield 'FrameTransformerEncoder', { 'channels': c, 'features': f }, lambda i=i, c=c, f=f: (FrameTransformerEncoder(c, a, f, dropout=args.dropout, expansion=args.expansion, num_heads=heads), (x(c, f), qk() if i > 0 else None))
+
+        if i < len(levels) - 1:
+            yield 'FrameTransformerDecoder', { 'channels': c, 'features': f }, lambda c=c, f=f: (FrameTransformerDecoder(c, a, f, dropout=args.dropout, expansion=args.expansion, num_heads=heads), (x(c, f), x(c, f), qk(), qk(), qk()))
+
+    yield 'ConvolutionalEmbedding', { 'channels': 2, 'features': levels[0][1] }, lambda: (ConvolutionalEmbedding(2, levels[0][1]), (x(2, levels[0][1]),))
+
+def case_name(module, config, batch_size, cropsize):
+    return f'{module}[' + ','.join(f'{k}={v}' for k, v in config.items()) + f',b={batch_size},w={cropsize}]'
+
+def outputs(out):
+    return [o for o in (out if isinstance(out, tuple) else (out,)) if torch.is_tensor(o) and o.requires_grad]
+
+def step(module, inputs):
+    module.zero_grad(set_to_none=True)
+
+    for t in inputs:
+        if t is not None:
+            t.grad = None
+
+    start = time.perf_counter()
+    out = module(*inputs)
+    forward = time.perf_counter() - start
+
+    loss = sum(o.float().mean() for o in outputs(out))
+
+    start = time.perf_counter()
+    loss.backward()
+    backward = time.perf_counter() - start
+
+    return forward, backward
+
+def memory_stats(module, inputs):
+    # replays one forward and backward pass under the profiler. peak is the most memory the step held at once
+    # beyond its inputs, allocations counts every tensor allocation the step made
+    with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as prof:
+        step(module, inputs)
+
+    events = sorted((e.start_ns(), e.nbytes()) for e in prof.profiler.kineto_results.events() if e.name() == '[memory]')
+
+    held, peak, allocations, allocated = 0, 0, 0, 0
+    for _, nbytes in events:
+        held += nbytes
+        peak = max(peak, held)
+
+        if nbytes > 0:
+            allocations += 1
+            allocated += nbytes
+
+    return peak / 1024 ** 2, allocations, allocated / 1024 ** 2
+
+def bench(build, args):
+    torch.manual_seed(args.seed)
+    module, inputs = build()
+    module.train()
+
+    inputs = tuple(t.requires_grad_() if t is not None else None for t in inputs)
+
+    for _ in range(args.warmup):
+        step(module, inputs)
+
+    forward, backward = zip(*[step(module, inputs) for _ in range(args.iterations)])
+    peak, allocations, allocated = memory_stats(module, inputs)
+
+    return {
+        'forward_ms': statistics.median(forward) * 1000,
+        'backward_ms': statistics.median(backward) * 1000,
+        'forward_min_ms': min(forward) * 1000,
+        'backward_min_ms': min(backward) * 1000,
+        'peak_mb': peak,
+        'allocations': allocations,
+        'allocated_mb': allocated,
+        'parameters': sum(p.numel() for p in module.parameters()),
+    }
+
+def compare(results, baseline, tolerance):
+    # a metric regresses when it grew by more than tolerance (a fraction) over the baseline run of the same case
+    previous = { r['name']: r for r in baseline['results'] }
+    regressions = []
+
+    for r in results:
+        base = previous.get(r['name'])
+        if base is None:
+            continue
+
+        for metric in METRICS:
+            if base.get(metric) and r[metric] > base[metric] * (1 + tolerance):
+                regressions.append((r['name'], metric, base[metric], r[metric]))
+
+    return regressions
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument('--seed', type=int, default=0)
+    p.add_argument('--modules', type=str, default=','.join(MODULES))
+    p.add_argument('--cropsizes', type=str, default='128,256,512,1024,2048')
+    p.add_argument('--batch_size', type=int, default=1)
+    p.add_argument('--n_fft', type=int, default=2048)
+    p.add_argument('--channels', type=int, default=8)
+    p.add_argument('--num_attention_maps', type=int, default=1)
+    p.add_argument('--num_heads', type=int, default=8)
+    p.add_argument('--expansion', type=int, default=4)
+    p.add_argument('--dropout', type=float, default=0.35)
+    p.add_argument('--max_attention_mb', type=float, default=1024)
+    p.add_argument('--threads', type=int, default=None)
+    p.add_argument('--warmup', type=int, default=2)
+    p.add_argument('--iterations', type=int, default=10)
+    p.add_argument('--output', type=str, default='benchmark-modules.json')
+    p.add_argument('--baseline', type=str, default=None)
+    p.add_argument('--tolerance', type=float, default=0.15)
+    args = p.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    modules = args.modules.split(',')
+    for module in modules:
+        if module not in MODULES:
+            p.error(f'unknown module {module}, expected one of {", ".join(MODULES)}')
+
+    results = []
+    for cropsize in [int(c) for c in args.cropsizes.split(',')]:
+        for module, config, build in cases(args, cropsize):
+            if module not in modules:
+                continue
+
+            name = case_name(module, config, args.batch_size, cropsize)
+            r = bench(build, args)
+            results.append({ 'name': name, 'module': module, 'config': config, 'batch_size': args.batch_size, 'cropsize': cropsize, **r })
+
+            print(f'{name:<96} fwd {r["forward_ms"]:9.2f} ms  bwd {r["backward_ms"]:9.2f} ms  peak {r["peak_mb"]:8.1f} MB  {r["allocations"]:5d} allocs')
+
+    report = {
+        'meta': {
+            'torch': torch.__version__,
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'processor': platform.processor(),
+            'threads': torch.get_num_threads(),
+            'args': vars(args),
+        },
+        'results': results,
+    }
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=1)
+
+    print(f'wrote {len(results)} results to {args.output}')
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+        regressions = compare(results, baseline, args.tolerance)
+        for name, metric, before, after in regressions:
+            print(f'REGRESSION {name} {metric}: {before:.2f} -> {after:.2f} ({after / before - 1:+.0%})')
+
+        if regressions:
+            sys.exit(1)
+
+        print(f'no regressions beyond {args.tolerance:.0%} against {args.baseline}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+import argparse
+import os
+import random
+import tempfile
+import time
+import numpy as np
+import torch
+
+import torch.nn.functional as F
+
+from libft2gan.dataset_utils import apply_pitch_shift, apply_pitch_shift_batch, apply_random_eq, EQCurveBank
+from libft2gan.dataset_voxaug_new import VoxAugDataset, BATCH_VOCAL_AUGMENTATIONS
+from libft2gan.waveform_augmentation import WaveformAugmentation
+
+def reference_pitch_shift(M, P, random, pitch_shift):
+    _, num_bins, num_frames = M.shape
+    scaling_factor = 2 ** (pitch_shift / 12)
+
+    H_L = np.zeros_like(M[0])
+    H_R = np.zeros_like(M[1])
+
+    for i in range(num_frames):
+        H_L[:, i] = np.interp(np.arange(num_bins) * scaling_factor, np.arange(num_bins), M[0, :, i])
+        H_R[:, i] = np.interp(np.arange(num_bins) * scaling_factor, np.arange(num_bins), M[1, :, i])
+
+    G_L, G_L_accum = np.zeros_like(P[0]), np.zeros(num_bins)
+    G_R, G_R_accum = np.zeros_like(P[1]), np.zeros(num_bins)
+
+    for i in range(1, num_frames):
+        dphase = P[0, :, i] - P[0, :, i - 1]
+        dphase = dphase - 2 * np.pi * np.floor((dphase + np.pi) / (2 * np.pi))
+        dphase = dphase / scaling_factor
+        G_L_accum += dphase
+        G_L[:, i] = P[0, :, i - 1] + G_L_accum
+
+        dphase = P[1, :, i] - P[1, :, i - 1]
+        dphase = dphase - 2 * np.pi * np.floor((dphase + np.pi) / (2 * np.pi))
+        dphase = dphase / scaling_factor
+        G_R_accum += dphase
+        G_R[:, i] = P[1, :, i - 1] + G_R_accum
+
+    return np.array([H_L, H_R]), np.array([G_L, G_R])
+
+def reference_random_eq(M, P, random, min=0, max=2):
+    arrs = [F.interpolate(torch.rand((1, 1, r,)) * (max - min) + min, size=(M.shape[1]), mode='linear', align_corners=True).squeeze(0).squeeze(0).numpy() for r in [512, 256, 128, 64, 32, 16, 8, 4, 2]]
+    eq = np.clip(sum(arrs) / 9.0, min, max)
+    eq = np.expand_dims(eq, (0, 2))
+
+    return M * eq, P
+
+def timeit(fn, iterations):
+    fn()
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    return (time.perf_counter() - start) / iterations
+
+def phase_error(a, b):
+    return np.abs(np.angle(np.exp(1.j * (a - b)))).max()
+
+def check_pitch_shift(M, P, rng, shifts, atol):
+    worst = 0
+
+    for shift in shifts:
+        H0, G0 = reference_pitch_shift(M, P, rng, shift)
+        H1, G1 = apply_pitch_shift(M, P, rng, shift)
+        H2, G2 = apply_pitch_shift_batch(torch.from_numpy(M).unsqueeze(0), torch.from_numpy(P).unsqueeze(0), shift)
+
+        worst = max(worst, np.abs(H0 - H1).max(), phase_error(G0, G1), np.abs(H0 - H2[0].numpy()).max(), phase_error(G0, G2[0].numpy()))
+
+    if worst > atol:
+        raise AssertionError(f'pitch shift mismatch against reference: max abs error {worst}')
+
+    return worst
+
+def bench_pitch_shift(M, P, rng, batch_size, iterations):
+    shift = 7.3
+    ref = timeit(lambda: reference_pitch_shift(M, P, rng, shift), max(1, iterations // 10))
+    vec = timeit(lambda: apply_pitch_shift(M, P, rng, shift), iterations)
+
+    MB = torch.from_numpy(np.stack([M] * batch_size))
+    PB = torch.from_numpy(np.stack([P] * batch_size))
+    shifts = torch.empty(batch_size).uniform_(-12, 12)
+    bat = timeit(lambda: apply_pitch_shift_batch(MB, PB, shifts), iterations) / batch_size
+
+    print(f'pitch shift [{M.shape[0]}, {M.shape[1]}, {M.shape[2]}]')
+    print(f'  loop:       {ref * 1000:.2f} ms/item')
+    print(f'  vectorized: {vec * 1000:.2f} ms/item ({ref / vec:.1f}x)')
+    print(f'  batched:    {bat * 1000:.2f} ms/item at batch {batch_size} ({ref / bat:.1f}x)')
+
+def bench_random_eq(M, P, rng, iterations):
+    ones = np.ones_like(M[:, :, :1])
+    ref = np.stack([reference_random_eq(ones, P, rng, 0.5, 1.5)[0][0, :, 0] for _ in range(512)])
+    new = np.stack([apply_random_eq(ones, P, rng, 0.5, 1.5)[0][0, :, 0] for _ in range(512)])
+    print(f'random eq curve mean/std: reference {ref.mean():.4f}/{ref.std():.4f}, bank {new.mean():.4f}/{new.std():.4f}')
+
+    build = timeit(lambda: EQCurveBank(M.shape[1]), 1)
+    ref_curve = timeit(lambda: reference_random_eq(ones, P, rng, 0.5, 1.5), iterations * 10)
+    new_curve = timeit(lambda: apply_random_eq(ones, P, rng, 0.5, 1.5), iterations * 10)
+    ref_item = timeit(lambda: reference_random_eq(M, P, rng, 0.5, 1.5), iterations)
+    new_item = timeit(lambda: apply_random_eq(M, P, rng, 0.5, 1.5), iterations)
+
+    print(f'random eq [{M.shape[0]}, {M.shape[1]}, {M.shape[2]}], bank of 4096 built once in {build * 1000:.1f} ms')
+    print(f'  curve only: interpolate {ref_curve * 1e6:.1f} us, bank {new_curve * 1e6:.1f} us ({ref_curve / new_curve:.1f}x)')
+    print(f'  full item:  interpolate {ref_item * 1000:.2f} ms, bank {new_item * 1000:.2f} ms')
+
+def bench_waveform_chain(hop_length, cropsize, batch_size, iterations):
+    W = (np.random.randn(2, 2048 * hop_length) * 0.3).astype(np.float32)
+    augmentation = WaveformAugmentation(BATCH_VOCAL_AUGMENTATIONS)
+    WB = torch.from_numpy(np.stack([W[:, :cropsize * hop_length]] * batch_size))
+
+    with tempfile.TemporaryDirectory() as vocal_lib:
+        np.savez(os.path.join(vocal_lib, 'synthetic_p0.npz'), XW=W, c=np.float32(1))
+        dataset = VoxAugDataset(vocal_lib=[vocal_lib], cropsize=cropsize, hop_length=hop_length)
+
+        per_item = timeit(lambda: dataset._get_vocals(0), iterations)
+        dataset.batch_augment = True
+        per_item_crop = timeit(lambda: dataset._get_vocals(0), iterations)
+
+    batched = timeit(lambda: augmentation(WB), max(1, iterations // 4)) / batch_size
+
+    print(f'vocal waveform chain [2, {WB.shape[2]}]')
+    print(f'  pedalboard chain in worker:   {per_item * 1000:.2f} ms/item')
+    print(f'  worker with batch_augment:    {per_item_crop * 1000:.2f} ms/item')
+    print(f'  WaveformAugmentation batched: {batched * 1000:.2f} ms/item at batch {batch_size}')
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument('--seed', type=int, default=0)
+    p.add_argument('--n_fft', type=int, default=2048)
+    p.add_argument('--cropsize', type=int, default=2048)
+    p.add_argument('--batch_size', type=int, default=8)
+    p.add_argument('--iterations', type=int, default=20)
+    p.add_argument('--atol', type=float, default=1e-3)
+    args = p.parse_args()
+
+    rng = random.Random(args.seed)
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+
+    M = np.random.rand(2, args.n_fft // 2 + 1, args.cropsize).astype(np.float32)
+    P = np.random.uniform(-np.pi, np.pi, size=M.shape).astype(np.float32)
+
+    err = check_pitch_shift(M, P, rng, [-12, -5.5, -1, 0, 0.25, 3, 12], args.atol)
+    print(f'pitch shift matches reference (max abs error {err:.3g})')
+
+    bench_pitch_shift(M, P, rng, args.batch_size, args.iterations)
+    bench_random_eq(M, P, rng, args.iterations)
+    bench_waveform_chain(args.n_fft // 2, 256, args.batch_size, args.iterations)
+
+if __name__ == '__main__':
+    main()
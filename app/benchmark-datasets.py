@@ -0,0 +1,227 @@
+import argparse
+import contextlib
+import json
+import math
+import os
+import random
+import tempfile
+import time
+import numpy as np
+import torch
+import torch.utils.data
+
+from libft2gan import dataset_pretrain, dataset_voxaug, dataset_voxaug_new, dataset_voxcheck
+
+MODULES = { 'voxaug': dataset_voxaug, 'voxaug_new': dataset_voxaug_new, 'pretrain': dataset_pretrain, 'voxcheck': dataset_voxcheck }
+
+# the dataset_utils augmentations and patch reads timed per item when a dataset module uses them; pedalboard plugins
+# are timed by class. the rest of an item (cropping, mixing, the outputs) is reported as other
+TIMED = [
+    'load_patch', 'load_crop',
+    'apply_time_stretch', 'apply_pitch_shift', 'apply_random_eq', 'apply_dynamic_range_mod', 'apply_multiplicative_noise', 'apply_stereo_spatialization',
+    'apply_channel_drop', 'apply_random_phase_noise', 'apply_harmonic_distortion', 'apply_emphasis', 'apply_deemphasis', 'apply_random_volume',
+    'apply_frame_mag_masking', 'apply_frame_phase_masking'
+]
+
+class Timers(object):
+    def __init__(self):
+        self.totals = {}
+
+    def add(self, name, seconds):
+        self.totals[name] = self.totals.get(name, 0) + seconds
+
+    def wrap(self, name, fn):
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.add(name, time.perf_counter() - start)
+
+        return timed
+
+class TimedPlugin(object):
+    def __init__(self, plugin, name, timers):
+        self.plugin = plugin
+        self.name = name
+        self.timers = timers
+
+    def process(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return self.plugin.process(*args, **kwargs)
+        finally:
+            self.timers.add(self.name, time.perf_counter() - start)
+
+class TimedPedalboard(object):
+    # stands in for the pedalboard module inside dataset_voxaug_new so every plugin it creates is timed
+    def __init__(self, pedalboard, timers):
+        self.pedalboard = pedalboard
+        self.timers = timers
+
+    def __getattr__(self, name):
+        cls = getattr(self.pedalboard, name)
+        return lambda *args, **kwargs: TimedPlugin(cls(*args, **kwargs), f'pedalboard.{name}', self.timers)
+
+@contextlib.contextmanager
+def instrument(module, timers):
+    # the augmentation lists are built on every item from the module's globals, so swapping them is enough
+    originals = { name: getattr(module, name) for name in TIMED + ['pedalboard'] if hasattr(module, name) }
+
+    for name, fn in originals.items():
+        setattr(module, name, TimedPedalboard(fn, timers) if name == 'pedalboard' else timers.wrap(name, fn))
+
+    try:
+        yield
+    finally:
+        for name, fn in originals.items():
+            setattr(module, name, fn)
+
+def make_library(path, patches, frames, n_fft, hop_length, seed, name):
+    # patches hold what every dataset variant reads: the spectrogram X, the waveform XW and the song scales
+    rng = np.random.RandomState(seed)
+    os.makedirs(path, exist_ok=True)
+
+    for i in range(patches):
+        XW = (rng.randn(2, frames * hop_length) * 0.1).astype(np.float32)
+        X = ((rng.rand(2, n_fft // 2 + 1, frames) * np.exp(1.j * rng.uniform(-np.pi, np.pi, (2, n_fft // 2 + 1, frames)))) ** 2).astype(np.complex64)
+        np.savez(os.path.join(path, f'{name}{i}_p0.npz'), X=X, XW=XW, c=np.float32(np.abs(X).max()), cr=np.float32(np.abs(X.real).max()), ci=np.float32(np.abs(X.imag).max()))
+
+def make_dataset(name, instrumental_lib, vocal_lib, args):
+    kwargs = { 'n_fft': args.n_fft, 'hop_length': args.hop_length, 'cropsize': args.cropsize, 'seed': args.seed }
+
+    if name == 'voxaug':
+        return dataset_voxaug.VoxAugDataset(instrumental_lib=[instrumental_lib], vocal_lib=[vocal_lib], **kwargs)
+    if name == 'voxaug_new':
+        return dataset_voxaug_new.VoxAugDataset(instrumental_lib=[instrumental_lib], vocal_lib=[vocal_lib], batch_augment=args.batch_augment, **kwargs)
+    if name == 'pretrain':
+        return dataset_pretrain.VoxAugDataset(instrumental_lib=[instrumental_lib], vocal_lib=[vocal_lib], **kwargs)
+
+    return dataset_voxcheck.VoxAugDataset(instrumental_lib=[instrumental_lib], vocal_lib=[vocal_lib], **kwargs)
+
+def bench_items(name, dataset, items):
+    # one worker's cost: items made in this process, with the time inside each augmentation broken out
+    dataset[0]
+
+    timers = Timers()
+    with instrument(MODULES[name], timers):
+        start = time.perf_counter()
+        for i in range(items):
+            dataset[random.randrange(len(dataset))]
+        total = time.perf_counter() - start
+
+    breakdown = { k: v / items for k, v in sorted(timers.totals.items(), key=lambda kv: -kv[1]) }
+    pedalboard = sum(v for k, v in breakdown.items() if k.startswith('pedalboard.'))
+
+    if pedalboard > 0:
+        breakdown['pedalboard chain'] = pedalboard
+
+    breakdown['other'] = total / items - sum(v for k, v in breakdown.items() if k != 'pedalboard chain')
+
+    return total / items, breakdown
+
+def bench_workers(dataset, num_workers, batch_size, batches, prefetch_factor):
+    # items/sec through a dataloader, after the first round of batches (worker startup) has been delivered
+    warmup = max(1, num_workers)
+    sampler = torch.utils.data.RandomSampler(dataset, replacement=True, num_samples=batch_size * (batches + warmup))
+    loader = torch.utils.data.DataLoader(dataset, batch_size=batch_size, sampler=sampler, num_workers=num_workers, prefetch_factor=prefetch_factor if num_workers > 0 else None)
+
+    start = None
+    for i, _ in enumerate(loader):
+        if i == warmup - 1:
+            start = time.perf_counter()
+
+    return batches * batch_size / (time.perf_counter() - start)
+
+def consumption_rate(args):
+    # items/sec one gpu takes in, from the training telemetry (the step time less the wait on the dataloader) or
+    # from --step_time and --train_batch_size
+    if args.telemetry is not None:
+        samples, busy = 0, 0
+
+        with open(args.telemetry) as f:
+            for line in f:
+                record = json.loads(line)
+
+                if record.get('type') == 'step':
+                    samples += record['samples']
+                    busy += record['total'] - record['data']
+
+        return samples / busy if busy > 0 else None
+
+    if args.step_time is not None:
+        return args.train_batch_size / args.step_time
+
+    return None
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument('--seed', type=int, default=0)
+    p.add_argument('--datasets', type=str, default=','.join(MODULES))
+    p.add_argument('--library_dir', type=str, default=None, help='keeps the synthetic libraries here instead of a temporary directory')
+    p.add_argument('--patches', type=int, default=8)
+    p.add_argument('--patch_frames', type=int, default=1024)
+    p.add_argument('--n_fft', type=int, default=2048)
+    p.add_argument('--hop_length', type=int, default=1024)
+    p.add_argument('--cropsize', type=int, default=256)
+    p.add_argument('--batch_augment', action='store_true', help='dataset_voxaug_new leaves the waveform chain to WaveformAugmentation on the gpu')
+    p.add_argument('--items', type=int, default=32)
+    p.add_argument('--workers', type=str, default='0,1,2,4,8')
+    p.add_argument('--batch_size', type=int, default=4)
+    p.add_argument('--batches', type=int, default=16)
+    p.add_argument('--prefetch_factor', type=int, default=2)
+    p.add_argument('--telemetry', type=str, default=None, help='telemetry jsonl written by train.py --telemetry')
+    p.add_argument('--step_time', type=float, default=None, help='seconds per training step on the gpu')
+    p.add_argument('--train_batch_size', type=int, default=None)
+    p.add_argument('--output', type=str, default=None, help='json file for the results')
+    args = p.parse_args()
+
+    if args.step_time is not None and args.train_batch_size is None:
+        p.error('--step_time needs --train_batch_size')
+
+    random.seed(args.seed)
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+
+    rate = consumption_rate(args)
+    workers = [int(w) for w in args.workers.split(',')]
+    results = {}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        root = args.library_dir if args.library_dir is not None else tmp
+        instrumental_lib, vocal_lib = os.path.join(root, 'instruments'), os.path.join(root, 'vocals')
+
+        if not os.path.exists(instrumental_lib):
+            make_library(instrumental_lib, args.patches, args.patch_frames, args.n_fft, args.hop_length, args.seed, 'instruments')
+            make_library(vocal_lib, args.patches, args.patch_frames, args.n_fft, args.hop_length, args.seed + 1, 'vocals')
+
+        for name in args.datasets.split(','):
+            dataset = make_dataset(name, instrumental_lib, vocal_lib, args)
+            per_item, breakdown = bench_items(name, dataset, args.items)
+            scaling = { w: bench_workers(dataset, w, args.batch_size, args.batches, args.prefetch_factor) for w in workers }
+
+            print(f'{name}: {per_item * 1000:.1f} ms/item, {1 / per_item:.1f} items/s per worker')
+            for k, v in breakdown.items():
+                print(f'  {k:<36} {v * 1000:8.2f} ms/item {v / per_item:6.1%}')
+
+            for w, items_per_sec in scaling.items():
+                print(f'  {w} workers: {items_per_sec:.1f} items/s' + (f' ({items_per_sec / w:.1f} per worker)' if w > 0 else ' (main process)'))
+
+            result = { 'ms_per_item': per_item * 1000, 'items_per_sec_per_worker': 1 / per_item, 'breakdown_ms': { k: v * 1000 for k, v in breakdown.items() }, 'items_per_sec': scaling }
+
+            if rate is not None:
+                # the per-worker estimate assumes linear scaling; the measured count is the fewest tried that kept up
+                result['workers_needed'] = math.ceil(rate * per_item)
+                result['workers_measured'] = next((w for w, items_per_sec in scaling.items() if items_per_sec >= rate), None)
+
+                measured = { None: f'more than {max(workers)}', 0: 'the main process' }.get(result['workers_measured'], result['workers_measured'])
+                print(f'  the gpu takes {rate:.1f} items/s: {result["workers_needed"]} workers at the single worker rate, {measured} measured')
+
+            results[name] = result
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump({ 'args': vars(args), 'gpu_items_per_sec': rate, 'results': results }, f, indent=1)
+
+if __name__ == '__main__':
+    main()
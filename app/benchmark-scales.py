@@ -0,0 +1,128 @@
+import argparse
+import time
+import torch
+import torch.nn.functional as F
+
+from libft2gan.audio_scales import BandScale, MelScale, OctaveScale, Tempogram
+
+def reference_scale(x, fb):
+    return torch.matmul(x.transpose(-1, -2), fb).transpose(-1, -2)
+
+def dft_kernel(tempogram):
+    # a dense (win_length, n_fft // 2 + 1) complex dft matrix
+    return torch.exp(-2j * torch.pi * torch.arange(tempogram.win_length).unsqueeze(1) * torch.arange(tempogram.n_fft // 2 + 1).unsqueeze(0) / tempogram.n_fft)
+
+def reference_tempogram(onset, tempogram, kernel):
+    # the same windows through the dense dft matrix
+    pad = tempogram.win_length // 2
+    frames = F.pad(onset, (pad, tempogram.win_length - pad - 1)).unfold(-1, tempogram.win_length, tempogram.hop_length) * tempogram.window
+    return torch.abs(frames.to(torch.complex64) @ kernel).transpose(-1, -2)
+
+def timeit(fn, iterations):
+    fn()
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    return (time.perf_counter() - start) / iterations
+
+def scales(n_stft, learned_filters):
+    return [
+        ('mel', MelScale(n_filters=128, sample_rate=44100, n_stft=n_stft, learned_filters=learned_filters)),
+        ('octave', OctaveScale(n_filters=128, sample_rate=44100, n_stft=n_stft, learned_filters=learned_filters)),
+        ('band', BandScale(n_filters=128, min_freq=0, max_freq=22050, sample_rate=44100, n_stft=n_stft, learned_filters=learned_filters)),
+    ]
+
+def check_scale(scale, x, atol):
+    # outputs, input gradients and filter gradients against the dense matmul; the dense filter gradient is only
+    # compared inside the bands, the banded filters have no weights outside them
+    fb = scale.fb.dense().detach().requires_grad_()
+    xa = x.clone().requires_grad_()
+    xb = x.clone().requires_grad_()
+    g = torch.rand(x.shape[:-2] + (fb.shape[1], x.shape[-1]))
+
+    ya = reference_scale(xa, fb)
+    yb = scale(xb)
+    ya.backward(g)
+    yb.backward(g)
+
+    worst = max((ya - yb).abs().max().item(), (xa.grad - xb.grad).abs().max().item())
+
+    if scale.fb.values.grad is not None:
+        dense_grad = fb.grad.t()[scale.fb.dense().t() != 0]
+        worst = max(worst, ((dense_grad - scale.fb.values.grad) / dense_grad.abs().max()).abs().max().item())
+
+    if worst > atol:
+        raise AssertionError(f'banded filterbank mismatch against dense: max error {worst}')
+
+    return worst
+
+def bench_scale(name, scale, x, iterations):
+    fb = scale.fb.dense().detach().requires_grad_(scale.fb.values.requires_grad)
+    x = x.clone().requires_grad_()
+
+    def step(fn):
+        y = fn(x)
+        y.sum().backward()
+
+    dense_fwd = timeit(lambda: reference_scale(x.detach(), fb.detach()), iterations)
+    banded_fwd = timeit(lambda: scale(x.detach()), iterations)
+    dense_step = timeit(lambda: step(lambda x: reference_scale(x, fb)), iterations)
+    banded_step = timeit(lambda: step(scale), iterations)
+
+    print(f'{name} [{", ".join(str(d) for d in x.shape)}] -> {scale.fb.crow.shape[0] - 1} filters, {scale.fb.values.numel()} of {fb.numel()} weights non-zero')
+    print(f'  forward:          dense {dense_fwd * 1000:8.2f} ms, banded {banded_fwd * 1000:8.2f} ms ({dense_fwd / banded_fwd:.1f}x)')
+    print(f'  forward+backward: dense {dense_step * 1000:8.2f} ms, banded {banded_step * 1000:8.2f} ms ({dense_step / banded_step:.1f}x)')
+
+def bench_tempogram(tempogram, x, iterations, atol):
+    kernel = dft_kernel(tempogram).to(x.device)
+    onset = tempogram.onset_strength(x)
+    err = ((reference_tempogram(onset, tempogram, kernel) - tempogram.tempogram(onset)).abs().max() / tempogram.tempogram(onset).abs().max()).item()
+
+    if err > atol:
+        raise AssertionError(f'fft tempogram mismatch against dense dft: max error {err}')
+
+    onset = onset.detach().requires_grad_()
+
+    def step(fn):
+        fn(onset).sum().backward()
+
+    dense_fwd = timeit(lambda: reference_tempogram(onset.detach(), tempogram, kernel), iterations)
+    fft_fwd = timeit(lambda: tempogram.tempogram(onset.detach()), iterations)
+    dense_step = timeit(lambda: step(lambda onset: reference_tempogram(onset, tempogram, kernel)), iterations)
+    fft_step = timeit(lambda: step(tempogram.tempogram), iterations)
+
+    print(f'tempogram [{", ".join(str(d) for d in onset.shape)}] win_length {tempogram.win_length}, hop_length {tempogram.hop_length}, n_fft {tempogram.n_fft} matches dense (max error {err:.3g})')
+    print(f'  forward:          dense {dense_fwd * 1000:8.2f} ms, fft    {fft_fwd * 1000:8.2f} ms ({dense_fwd / fft_fwd:.1f}x)')
+    print(f'  forward+backward: dense {dense_step * 1000:8.2f} ms, fft    {fft_step * 1000:8.2f} ms ({dense_step / fft_step:.1f}x)')
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument('--seed', type=int, default=0)
+    p.add_argument('--gpu', type=int, default=-1)
+    p.add_argument('--batch_size', type=int, default=4)
+    p.add_argument('--n_stft', type=int, default=1024)
+    p.add_argument('--cropsize', type=int, default=2048)
+    p.add_argument('--iterations', type=int, default=10)
+    p.add_argument('--atol', type=float, default=1e-4)
+    p.add_argument('--learned_filters', action='store_true')
+    p.add_argument('--tempogram_n_fft', type=int, default=512)
+    p.add_argument('--tempogram_win_length', type=int, default=None)
+    p.add_argument('--tempogram_hop_length', type=int, default=None)
+    args = p.parse_args()
+
+    torch.manual_seed(args.seed)
+    device = torch.device(f'cuda:{args.gpu}' if args.gpu >= 0 else 'cpu')
+
+    for name, scale in scales(args.n_stft, True):
+        err = check_scale(scale, torch.rand(2, 2, args.n_stft, 64), args.atol)
+        print(f'{name} scale matches dense (max error {err:.3g})')
+
+    x = torch.rand(args.batch_size, 2, args.n_stft, args.cropsize, device=device)
+    for name, scale in scales(args.n_stft, args.learned_filters):
+        bench_scale(name, scale.to(device), x, args.iterations)
+
+    tempogram = Tempogram(args.tempogram_n_fft, win_length=args.tempogram_win_length, hop_length=args.tempogram_hop_length, learnable=args.learned_filters)
+    bench_tempogram(tempogram.to(device), x, args.iterations, args.atol)
+
+if __name__ == '__main__':
+    main()
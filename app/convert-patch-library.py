@@ -0,0 +1,96 @@
+import argparse
+import os
+import time
+import numpy as np
+
+from tqdm import tqdm
+
+from libft2gan.patch_codecs import decode, encode
+from libft2gan.patch_shards import PatchShardWriter, PatchShardReader, list_patches, patch_name, song_name
+
+def array_codecs(arrays, spectrogram_codec, waveform_codec):
+    codecs = {}
+
+    for k, v in arrays.items():
+        if np.iscomplexobj(v):
+            codecs[k] = spectrogram_codec
+        elif v.ndim > 1 and np.issubdtype(v.dtype, np.floating):
+            codecs[k] = waveform_codec
+
+    return codecs
+
+def convert(input_dir, output_dir, shard_size, time_major, spectrogram_codec, waveform_codec, verify):
+    patches = sorted(list_patches(input_dir), key=patch_name)
+
+    with PatchShardWriter(output_dir, shard_size=shard_size, time_major=time_major, measure=True) as writer:
+        existing = set(writer.names)
+
+        for path in tqdm(patches, desc=os.path.basename(os.path.normpath(input_dir))):
+            name = os.path.splitext(os.path.basename(path))[0]
+
+            if name in existing:
+                continue
+
+            with np.load(path, allow_pickle=True) as data:
+                arrays = { k: data[k] for k in data.files }
+
+            writer.add(name, song_name(name), arrays, array_codecs(arrays, spectrogram_codec, waveform_codec))
+
+    writer.report()
+
+    if verify:
+        reader = PatchShardReader(output_dir)
+        lookup = { n: i for i, n in enumerate(reader.names) }
+
+        for path in tqdm(patches, desc='verify'):
+            patch = reader.load(lookup[os.path.splitext(os.path.basename(path))[0]])
+
+            with np.load(path, allow_pickle=True) as data:
+                arrays = { k: data[k] for k in data.files }
+
+            codecs = array_codecs(arrays, spectrogram_codec, waveform_codec)
+
+            for k, v in arrays.items():
+                # lossy codecs are checked against their own round trip
+                codec = codecs.get(k, 'raw')
+                expected = decode(codec, *encode(codec, v), v.dtype)
+
+                if not np.array_equal(expected, patch[k]):
+                    raise AssertionError(f'{path}: {k} differs after conversion')
+
+        reader.close()
+
+    start = time.perf_counter()
+    list_patches(input_dir)
+    listed = time.perf_counter() - start
+
+    start = time.perf_counter()
+    list_patches(output_dir)
+    indexed = time.perf_counter() - start
+
+    print(f'{len(patches)} patches: listing npz directory {listed * 1000:.1f} ms, opening shard index {indexed * 1000:.1f} ms')
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument('--input', type=str, required=True)
+    p.add_argument('--output', type=str, default=None)
+    p.add_argument('--shard_size', type=float, default=4, help='shard size in GiB')
+    p.add_argument('--time_major', type=str, default='true')
+    p.add_argument('--spectrogram_codec', type=str.lower, choices=['raw', 'f16', 'logmag8', 'logmag16'], default='raw')
+    p.add_argument('--waveform_codec', type=str.lower, choices=['raw', 'f16', 'pcm16'], default='raw')
+    p.add_argument('--verify', type=str, default='false')
+    args = p.parse_args()
+
+    args.input = [p for p in args.input.split('|')]
+    args.output = [p for p in args.output.split('|')] if args.output is not None else [f'{os.path.normpath(p)}_SHARDS' for p in args.input]
+    args.time_major = str.lower(args.time_major) == 'true'
+    args.verify = str.lower(args.verify) == 'true'
+
+    if len(args.input) != len(args.output):
+        raise ValueError('--input and --output need the same number of libraries')
+
+    for input_dir, output_dir in zip(args.input, args.output):
+        convert(input_dir, output_dir, int(args.shard_size * 2 ** 30), args.time_major, args.spectrogram_codec, args.waveform_codec, args.verify)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+import argparse
+import json
+import os
+import shutil
+
+from libft2gan.patch_fingerprint import FingerprintIndex, find_matches, song_duplicates, update_fingerprints
+from libft2gan.patch_shards import is_shard_library
+
+# finds the same songs across libraries by content rather than by file name (see check-duplicates.py). libraries
+# are given in priority order: of each duplicate pair the song in the later library (or the later name within one
+# library) is the one reported for quarantine, so list _VALIDATION libraries first to keep them intact
+def quarantine(library, index, song):
+    if is_shard_library(library):
+        print(f'{library}: cannot move {song} out of a shard library, rebuild it without the song')
+        return []
+
+    dup_dir = os.path.join(library, 'dup')
+    os.makedirs(dup_dir, exist_ok=True)
+
+    moved = []
+    for name, s in zip(index.names, index.songs):
+        if s == song and os.path.exists(os.path.join(library, f'{name}.npz')):
+            shutil.move(os.path.join(library, f'{name}.npz'), os.path.join(dup_dir, f'{name}.npz'))
+            moved.append(name)
+
+    return moved
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument('--libraries', type=str, required=True)
+    p.add_argument('--pool', type=int, default=4)
+    p.add_argument('--max_ber', type=float, default=0.35)
+    p.add_argument('--min_fraction', type=float, default=0.5)
+    p.add_argument('--num_workers', type=int, default=None)
+    p.add_argument('--report', type=str, default='duplicates.json')
+    p.add_argument('--quarantine', type=str, default='false')
+    args = p.parse_args()
+
+    libraries = args.libraries.split('|')
+    args.quarantine = str.lower(args.quarantine) == 'true'
+
+    indexes = [update_fingerprints(library, pool=args.pool, num_workers=args.num_workers) for library in libraries]
+    matches = find_matches(indexes, max_ber=args.max_ber)
+    duplicates = song_duplicates(indexes, matches, min_fraction=args.min_fraction)
+
+    report = []
+    for (la, song_a), (lb, song_b), fraction, ber in duplicates:
+        keep, drop = ((la, song_a), (lb, song_b)) if (la, song_a) <= (lb, song_b) else ((lb, song_b), (la, song_a))
+        leak = la != lb and any(libraries[l].rstrip('/\\').endswith('_VALIDATION') for l in (la, lb))
+        report.append({
+            'keep': { 'library': libraries[keep[0]], 'song': keep[1] },
+            'duplicate': { 'library': libraries[drop[0]], 'song': drop[1] },
+            'fraction': fraction, 'ber': ber, 'validation_leak': leak
+        })
+
+        print(f'{"[validation leak] " if leak else ""}{libraries[drop[0]]}/{drop[1]} duplicates {libraries[keep[0]]}/{keep[1]} ({fraction:.0%} of patches, ber {ber:.3f})')
+
+    print(f'{len(matches)} matching patches, {len(duplicates)} duplicate songs')
+
+    if args.quarantine:
+        quarantined = set()
+
+        for entry in report:
+            library, song = entry['duplicate']['library'], entry['duplicate']['song']
+
+            if (library, song) not in quarantined:
+                quarantined.add((library, song))
+                entry['quarantined'] = quarantine(library, indexes[libraries.index(library)], song)
+
+    with open(args.report, 'w') as f:
+        json.dump(report, f, indent=1)
+
+if __name__ == '__main__':
+    main()
@@ -2,6 +2,7 @@
 import math
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
 def _hz_to_mel(freq: float):
     return 2595.0 * math.log10(1.0 + (freq / 700.0))
@@ -115,51 +116,137 @@ def linear_fbanks(n_freqs: int, f_min: float, f_max: float, n_filters: int, samp
     fb = _create_triangular_filterbank(all_freqs, f_pts)
 
     return fb
+
+def _csr(crow, col, values, size):
+    return torch.sparse_csr_tensor(crow, col, values, size=size, check_invariants=False)
+
+class _BandedMatmul(torch.autograd.Function):
+    # y = A x over the frequency dim of x for a csr matrix A (n_filters, n_freqs): every output row gathers the bins
+    # of its band and sums them. the input gradient is A^T applied the same way and the gradient of the values is
+    # the dense gradient sampled at A's non-zeros only (sddmm), so nothing (n_filters, n_freqs) sized is made. the
+    # sparse kernels have no half precision versions, so both passes run in the dtype of the values with autocast off
+    @staticmethod
+    def forward(ctx, x, values, crow, col, t_crow, t_col, t_perm):
+        n_filters, n_freqs = crow.shape[0] - 1, t_crow.shape[0] - 1
+        xs = x.movedim(-2, 0).reshape(n_freqs, -1).to(values.dtype)
+
+        with torch.autocast(x.device.type, enabled=False):
+            y = _csr(crow, col, values, (n_filters, n_freqs)) @ xs
+
+        ctx.save_for_backward(xs if ctx.needs_input_grad[1] else None, values, crow, col, t_crow, t_col, t_perm)
+        ctx.shape = x.shape
+        ctx.dtype = x.dtype
+
+        return y.reshape((n_filters,) + x.shape[:-2] + x.shape[-1:]).movedim(0, -2).to(x.dtype)
+
+    @staticmethod
+    def backward(ctx, grad):
+        xs, values, crow, col, t_crow, t_col, t_perm = ctx.saved_tensors
+        n_filters, n_freqs = crow.shape[0] - 1, t_crow.shape[0] - 1
+        gs = grad.movedim(-2, 0).reshape(n_filters, -1).to(values.dtype)
+        grad_x = grad_values = None
+
+        with torch.autocast(grad.device.type, enabled=False):
+            if ctx.needs_input_grad[0]:
+                gx = _csr(t_crow, t_col, values[t_perm], (n_freqs, n_filters)) @ gs
+                grad_x = gx.reshape((n_freqs,) + ctx.shape[:-2] + ctx.shape[-1:]).movedim(0, -2).to(ctx.dtype)
+
+            if ctx.needs_input_grad[1]:
+                grad_values = torch.sparse.sampled_addmm(_csr(crow, col, values, (n_filters, n_freqs)), gs, xs.t(), beta=0).values()
+
+        return grad_x, grad_values, None, None, None, None, None
+
+class BandedFilterbank(nn.Module):
+    # a (n_freqs, n_filters) filterbank kept as the non-zero band of each filter in csr form and applied with a
+    # sparse matmul, instead of multiplying every bin by every filter. each triangular filter covers a few bins, so
+    # this is a small fraction of the dense work. learned filters only learn the weights inside their bands
+    def __init__(self, fb, learned_filters=False):
+        super().__init__()
+
+        n_freqs, n_filters = fb.shape
+        fbt = fb.t().contiguous()
+        rows, cols = fbt.nonzero(as_tuple=True)
+
+        crow = torch.zeros(n_filters + 1, dtype=torch.long)
+        crow[1:] = torch.cumsum(torch.bincount(rows, minlength=n_filters), dim=0)
+
+        # the transposed structure, for the input gradient; values[t_perm] are its values
+        t_perm = torch.argsort(cols * n_filters + rows)
+        t_crow = torch.zeros(n_freqs + 1, dtype=torch.long)
+        t_crow[1:] = torch.cumsum(torch.bincount(cols, minlength=n_freqs), dim=0)
+
+        self.register_buffer('crow', crow)
+        self.register_buffer('col', cols)
+        self.register_buffer('t_crow', t_crow)
+        self.register_buffer('t_col', rows[t_perm])
+        self.register_buffer('t_perm', t_perm)
+
+        if learned_filters:
+            self.values = nn.Parameter(fbt[rows, cols])
+        else:
+            self.register_buffer('values', fbt[rows, cols])
+
+    def dense(self):
+        # the (n_freqs, n_filters) filterbank
+        return _csr(self.crow, self.col, self.values, (self.crow.shape[0] - 1, self.t_crow.shape[0] - 1)).to_dense().t()
+
+    def forward(self, x):
+        return _BandedMatmul.apply(x, self.values, self.crow, self.col, self.t_crow, self.t_col, self.t_perm)
     
 class Tempogram(nn.Module):
-    def __init__(self, n_fft, win_length=None, learnable=False):
+    # fourier tempogram of an onset envelope [..., T]: windows of win_length frames every hop_length frames, each
+    # weighted by a hann window and transformed with an rfft of n_fft points, giving [..., n_fft // 2 + 1, frames].
+    # learnable makes the window weighting a parameter. forward takes a spectrogram [B, C, F, T] and reduces it to
+    # its onset envelope [B, C, T] first; tempogram takes the envelope directly
+    def __init__(self, n_fft, win_length=None, hop_length=None, learnable=False):
         super(Tempogram, self).__init__()
 
         self.n_fft = n_fft
         self.win_length = n_fft if win_length is None else win_length
-        self.tempo_bins = torch.arange(n_fft // 2 + 1, dtype=torch.float).unsqueeze(0).unsqueeze(1)
+        self.hop_length = self.win_length // 4 if hop_length is None else hop_length
         self.learnable = learnable
 
         if learnable:
-            self.tempo_kernel = nn.Parameter(torch.abs(torch.exp(-2j * torch.pi * self.tempo_bins * torch.arange(n_fft // 2 + 1, dtype=torch.float).unsqueeze(0).unsqueeze(2) / (n_fft // 2 + 1))))
+            self.window = nn.Parameter(torch.hann_window(self.win_length))
+        else:
+            self.register_buffer('window', torch.hann_window(self.win_length))
+
+    def onset_strength(self, magnitude, phase=None):
+        # magnitude weighted by the negative phase advance when phase is given, otherwise the spectral flux. summed
+        # over frequency, [B, C, F, T] -> [B, C, T]
+        if phase is not None:
+            onset = magnitude * torch.relu(-torch.diff(phase, dim=-1, prepend=phase[..., :1]))
         else:
-            self.register_buffer('tempo_kernel', torch.exp(-2j * torch.pi * self.tempo_bins * torch.arange(n_fft // 2 + 1, dtype=torch.float).unsqueeze(0).unsqueeze(2) / (n_fft // 2 + 1)))
+            onset = torch.relu(torch.diff(magnitude, dim=-1, prepend=magnitude[..., :1]))
 
-    def forward(self, magnitude, phase):
-        phase_diff = torch.zeros_like(phase)
-        phase_diff[:, :, :, 1:] = torch.diff(phase, dim=3)
-        onset_strength = torch.sum(magnitude * torch.maximum(torch.zeros_like(phase_diff), -phase_diff), dim=1)
-        tempogram = torch.abs(torch.matmul(onset_strength.to(dtype=torch.complex64 if not self.learnable else None).transpose(1,2).unsqueeze(1), self.tempo_kernel).transpose(2,3))
-        return tempogram
+        return torch.sum(onset, dim=-2)
+
+    def tempogram(self, onset):
+        # centered like an stft, so frame i is at onset frame i * hop_length
+        pad = self.win_length // 2
+        frames = F.pad(onset.float(), (pad, self.win_length - pad - 1)).unfold(-1, self.win_length, self.hop_length)
+        return torch.abs(torch.fft.rfft(frames * self.window, n=self.n_fft, dim=-1)).transpose(-1, -2)
+
+    def forward(self, magnitude, phase=None):
+        return self.tempogram(self.onset_strength(magnitude, phase))
 
 class MelScale(nn.Module):
     def __init__(self, n_filters=128, sample_rate=44100, n_stft=1025, min_freq=0, max_freq=None, learned_filters=True):
         super().__init__()
         
-        if learned_filters:
-            self.fb = nn.Parameter(melscale_fbanks(n_stft, min_freq, max_freq if max_freq is not None else float(sample_rate // 2), n_mels=n_filters, sample_rate=sample_rate))
-        else:
-            self.register_buffer('fb', melscale_fbanks(n_stft, min_freq, max_freq if max_freq is not None else float(sample_rate // 2), n_mels=n_filters, sample_rate=sample_rate))
+        self.fb = BandedFilterbank(melscale_fbanks(n_stft, min_freq, max_freq if max_freq is not None else float(sample_rate // 2), n_mels=n_filters, sample_rate=sample_rate), learned_filters)
 
     def forward(self, x):
-        return torch.matmul(x.transpose(-1, -2), self.fb).transpose(-1, -2)
+        return self.fb(x)
 
 class OctaveScale(nn.Module):
     def __init__(self, n_filters=128, sample_rate=44100, n_stft=1025, learned_filters=True, limit_to_freqs=False, min_freq=0, max_freq=None):
         super().__init__()
         
-        if learned_filters:
-            self.fb = nn.Parameter(octavescale_fbanks(n_stft, n_filters=n_filters, sample_rate=sample_rate, limit_to_freqs=limit_to_freqs, f_min=min_freq, f_max=max_freq))
-        else:
-            self.register_buffer('fb', octavescale_fbanks(n_stft, n_filters=n_filters, sample_rate=sample_rate, limit_to_freqs=limit_to_freqs, f_min=min_freq, f_max=max_freq))
+        self.fb = BandedFilterbank(octavescale_fbanks(n_stft, n_filters=n_filters, sample_rate=sample_rate, limit_to_freqs=limit_to_freqs, f_min=min_freq, f_max=max_freq), learned_filters)
 
     def forward(self, x, reshape_as=None):
-        x = torch.matmul(x.transpose(-1, -2), self.fb).transpose(-1, -2)
+        x = self.fb(x)
 
         if reshape_as is not None:
             x = x.reshape_as(reshape_as)
@@ -170,10 +257,7 @@ class BandScale(nn.Module):
     def __init__(self, n_filters, min_freq, max_freq, sample_rate=44100, n_stft=1025, learned_filters=True):
         super().__init__()
         
-        if learned_filters:
-            self.fb = nn.Parameter(linear_fbanks(n_stft, f_min=min_freq, f_max=max_freq, n_filters=n_filters, sample_rate=sample_rate))
-        else:
-            self.register_buffer('fb', linear_fbanks(n_stft, f_min=min_freq, f_max=max_freq, n_filters=n_filters, sample_rate=sample_rate))
+        self.fb = BandedFilterbank(linear_fbanks(n_stft, f_min=min_freq, f_max=max_freq, n_filters=n_filters, sample_rate=sample_rate), learned_filters)
 
     def forward(self, x):
-        return torch.matmul(x.transpose(-1, -2), self.fb).transpose(-1, -2)
\ No newline at end of file
+        return self.fb(x)
\ No newline at end of file
@@ -0,0 +1,78 @@
+import math
+import random
+import torch
+import torch.distributed
+import torch.utils.data
+
+class CropStream(torch.utils.data.IterableDataset):
+    # streams crops_per_patch training items from every patch read instead of one, for datasets with item_crops
+    # (the voxaug datasets). patch order comes from the sampler when one is given (DistributedSampler,
+    # DeviceBalancedSampler) or else from a seeded permutation split across ranks the same way; each dataloader worker
+    # takes every num_workers-th patch of that order. crops of one patch land next to each other, so items pass
+    # through a shuffle buffer before they are yielded
+    def __init__(self, dataset, crops_per_patch=8, shuffle_buffer=64, sampler=None, num_replicas=None, rank=None, seed=0):
+        if num_replicas is None:
+            num_replicas = torch.distributed.get_world_size() if torch.distributed.is_available() and torch.distributed.is_initialized() else 1
+
+        if rank is None:
+            rank = torch.distributed.get_rank() if torch.distributed.is_available() and torch.distributed.is_initialized() else 0
+
+        self.dataset = dataset
+        self.crops_per_patch = crops_per_patch
+        self.shuffle_buffer = shuffle_buffer
+        self.sampler = sampler
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+        self.dataset.set_epoch(epoch)
+
+        if self.sampler is not None and hasattr(self.sampler, 'set_epoch'):
+            self.sampler.set_epoch(epoch)
+
+    def _indices(self):
+        if self.sampler is not None:
+            return list(self.sampler)
+
+        g = random.Random(self.seed + self.epoch)
+        indices = list(range(len(self.dataset)))
+        g.shuffle(indices)
+
+        total_size = math.ceil(len(indices) / self.num_replicas) * self.num_replicas
+        indices += indices[:total_size - len(indices)]
+
+        return indices[self.rank:total_size:self.num_replicas]
+
+    def __len__(self):
+        patches = len(self.sampler) if self.sampler is not None else math.ceil(len(self.dataset) / self.num_replicas)
+        return patches * self.crops_per_patch
+
+    def __iter__(self):
+        info = torch.utils.data.get_worker_info()
+        worker, num_workers = (info.id, info.num_workers) if info is not None else (0, 1)
+
+        # workers start from copies of the same dataset, so its random state is reseeded or they would all pick the
+        # same crops and augmentations
+        self.dataset.random.seed(f'{self.seed}-{self.epoch}-{self.rank}-{worker}')
+        g = random.Random(f'{self.seed}-{self.epoch}-{self.rank}-{worker}-buffer')
+
+        buffer = []
+        for idx in self._indices()[worker::num_workers]:
+            for item in self.dataset.item_crops(idx, self.crops_per_patch):
+                if self.shuffle_buffer <= 0:
+                    yield item
+                    continue
+
+                if len(buffer) < self.shuffle_buffer:
+                    buffer.append(item)
+                    continue
+
+                i = g.randrange(len(buffer))
+                yield buffer[i]
+                buffer[i] = item
+
+        g.shuffle(buffer)
+        yield from buffer
@@ -5,6 +5,7 @@ import torch
 import torch.utils.data
 import torch.nn.functional as F
 from libft2gan.dataset_utils import apply_channel_drop, apply_dynamic_range_mod, apply_multiplicative_noise, apply_random_eq, apply_stereo_spatialization, apply_time_stretch, apply_random_phase_noise, apply_time_masking, apply_frequency_masking, apply_emphasis, apply_deemphasis, apply_pitch_shift, apply_masking, apply_harmonic_distortion, apply_random_volume, apply_frame_mag_masking, apply_frame_phase_masking
+from libft2gan.patch_stats import LibraryStats
 import librosa
 
 class VoxAugDataset(torch.utils.data.Dataset):
@@ -50,6 +51,7 @@ class VoxAugDataset(torch.utils.data.Dataset):
                         self.vocal_list.append(v)
 
         self.random = random.Random(seed)
+        self.stats = LibraryStats(list(instrumental_lib) + list(pretraining_lib or []) + list(vocal_lib or []))
 
         def key(p):
             return os.path.basename(p)
@@ -69,7 +71,7 @@ class VoxAugDataset(torch.utils.data.Dataset):
         path = str(self.vocal_list[(self.epoch + idx) % len(self.vocal_list)])
         vdata = np.load(path, allow_pickle=True)
         V, Vc = vdata['X'], vdata['c']
-        VCr, VCi = vdata['cr'], vdata['ci']
+        VCr, VCi = self.stats.song_scale(path, vdata)
 
         if self.random.uniform(0,1) < 0.5:
             V = apply_time_stretch(V, self.random, self.cropsize)
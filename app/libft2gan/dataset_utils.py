@@ -3,18 +3,37 @@ import torch.nn.functional as F
 import numpy as np
 import librosa
 
+class EQCurveBank(object):
+    # unit EQ curves: the mean of uniform noise linearly interpolated from 512, 256, ..., 2 points up to num_bins.
+    # an average of values in [min, max] never leaves that range, so min + (max - min) * curve has the same
+    # distribution as interpolating noise drawn in [min, max] and clipping
+    def __init__(self, num_bins, size=4096, resolutions=(512, 256, 128, 64, 32, 16, 8, 4, 2)):
+        curves = torch.zeros((size, 1, num_bins))
+
+        for r in resolutions:
+            curves += F.interpolate(torch.rand((size, 1, r)), size=num_bins, mode='linear', align_corners=True)
+
+        self.curves = (curves.squeeze(1) / len(resolutions)).numpy()
+
+    def __len__(self):
+        return self.curves.shape[0]
+
+    def sample(self, random, min=0, max=2):
+        return min + (max - min) * self.curves[random.randrange(len(self))]
+
+_eq_banks = {}
+
+def get_eq_bank(num_bins):
+    bank = _eq_banks.get(num_bins)
+
+    if bank is None:
+        bank = EQCurveBank(num_bins)
+        _eq_banks[num_bins] = bank
+
+    return bank
+
 def apply_random_eq(M, P, random, min=0, max=2):
-    arr1 = F.interpolate(torch.rand((1, 1, 512,)) * (max - min) + min, size=(M.shape[1]), mode='linear', align_corners=True).squeeze(0).squeeze(0).numpy()
-    arr2 = F.interpolate(torch.rand((1, 1, 256,)) * (max - min) + min, size=(M.shape[1]), mode='linear', align_corners=True).squeeze(0).squeeze(0).numpy()
-    arr3 = F.interpolate(torch.rand((1, 1, 128,)) * (max - min) + min, size=(M.shape[1]), mode='linear', align_corners=True).squeeze(0).squeeze(0).numpy()
-    arr4 = F.interpolate(torch.rand((1, 1, 64,)) * (max - min) + min, size=(M.shape[1]), mode='linear', align_corners=True).squeeze(0).squeeze(0).numpy()
-    arr5 = F.interpolate(torch.rand((1, 1, 32,)) * (max - min) + min, size=(M.shape[1]), mode='linear', align_corners=True).squeeze(0).squeeze(0).numpy()
-    arr6 = F.interpolate(torch.rand((1, 1, 16,)) * (max - min) + min, size=(M.shape[1]), mode='linear', align_corners=True).squeeze(0).squeeze(0).numpy()
-    arr7 = F.interpolate(torch.rand((1, 1, 8,)) * (max - min) + min, size=(M.shape[1]), mode='linear', align_corners=True).squeeze(0).squeeze(0).numpy()
-    arr8 = F.interpolate(torch.rand((1, 1, 4,)) * (max - min) + min, size=(M.shape[1]), mode='linear', align_corners=True).squeeze(0).squeeze(0).numpy()
-    arr9 = F.interpolate(torch.rand((1, 1, 2,)) * (max - min) + min, size=(M.shape[1]), mode='linear', align_corners=True).squeeze(0).squeeze(0).numpy()
-    eq = (arr1 + arr2 + arr3 + arr4 + arr5 + arr6 + arr7 + arr8 + arr9) / 9.0
-    eq = np.clip(eq, min, max)
+    eq = get_eq_bank(M.shape[1]).sample(random, min, max)
     eq = np.expand_dims(eq, (0, 2))
 
     return M * eq, P
@@ -70,10 +89,17 @@ def apply_channel_drop(M, P, random, channel, alpha=1):
         
     return alpha * H + (1 - alpha) * M, P
 
-def apply_time_stretch(M, random, target_size):
+def apply_time_stretch(M, random, target_size, anchor=None):
+    # anchor is an optional (start, end) frame range the stretched window is placed on: a longer window contains it
+    # and a shorter one lies inside it, so a crop chosen beforehand (for its vocal activity) is what gets stretched
     if M.shape[2] > target_size:
         size = random.randint(target_size // 16, M.shape[2])
-        start = random.randint(0, M.shape[2] - size)
+
+        if anchor is not None:
+            lo, hi = sorted((anchor[0], anchor[1] - size))
+            start = random.randint(max(0, min(lo, M.shape[2] - size)), max(0, min(hi, M.shape[2] - size)))
+        else:
+            start = random.randint(0, M.shape[2] - size)
         cropped = M[:, :, start:start+size]
         H = M[:, :, :target_size]
         H.real = F.interpolate(torch.from_numpy(cropped.real).unsqueeze(0), size=(M.shape[1], target_size), mode='bilinear', align_corners=True).squeeze(0).numpy()
@@ -124,8 +150,6 @@ def apply_harmonic_distortion(M, P, random, c, num_harmonics=2, gain=0.1, n_fft=
     left_X = left_M * np.exp(1.j * left_P)
     right_X = right_M * np.exp(1.j * right_P)
 
-    librosa.effects.pitch_shift()
-
     left_s = librosa.istft(left_X, hop_length=hop_length)
     right_s = librosa.istft(right_X, hop_length=hop_length)
 
@@ -149,33 +173,48 @@ def apply_harmonic_distortion(M, P, random, c, num_harmonics=2, gain=0.1, n_fft=
     return np.array([left_M, right_M]), np.array([np.angle(left_X), np.angle(right_X)])
 
 def apply_pitch_shift(M, P, random, pitch_shift):
-    _, num_bins, num_frames = M.shape
+    _, num_bins, _ = M.shape
     scaling_factor = 2 ** (pitch_shift / 12)
 
-    H_L = np.zeros_like(M[0])
-    H_R = np.zeros_like(M[1])
+    # same linear interpolation as np.interp per frame, done for every frame at once
+    pos = np.minimum(np.arange(num_bins) * scaling_factor, num_bins - 1)
+    lo = np.floor(pos).astype(np.int64)
+    hi = np.minimum(lo + 1, num_bins - 1)
+    w = (pos - lo).astype(M.dtype)[:, None]
+    H = M[:, lo, :] * (1 - w) + M[:, hi, :] * w
+
+    dphase = np.diff(P, axis=2)
+    dphase = dphase - 2 * np.pi * np.floor((dphase + np.pi) / (2 * np.pi))
+    dphase = dphase / scaling_factor
+
+    G = np.zeros_like(P)
+    G[:, :, 1:] = P[:, :, :-1] + np.cumsum(dphase, axis=2, dtype=np.float64)
+
+    return H, G
+
+def apply_pitch_shift_batch(M, P, pitch_shift):
+    # M, P: [B, C, F, T]; pitch_shift: semitones, either a float or one per batch item
+    b, _, num_bins, _ = M.shape
+    pitch_shift = torch.as_tensor(pitch_shift, dtype=torch.float64, device=M.device).reshape(-1).expand(b)
+    scaling_factor = 2 ** (pitch_shift / 12)
 
-    for i in range(num_frames):
-        H_L[:, i] = np.interp(np.arange(num_bins) * scaling_factor, np.arange(num_bins), M[0, :, i])
-        H_R[:, i] = np.interp(np.arange(num_bins) * scaling_factor, np.arange(num_bins), M[1, :, i])
+    pos = torch.minimum(torch.arange(num_bins, dtype=torch.float64, device=M.device).unsqueeze(0) * scaling_factor.unsqueeze(1), torch.tensor(num_bins - 1, dtype=torch.float64, device=M.device))
+    lo = torch.floor(pos).long()
+    hi = torch.clamp(lo + 1, max=num_bins - 1)
+    w = (pos - lo).to(M.dtype)[:, None, :, None]
 
-    G_L, G_L_accum = np.zeros_like(P[0]), np.zeros(num_bins)
-    G_R, G_R_accum = np.zeros_like(P[1]), np.zeros(num_bins)
+    lo = lo[:, None, :, None].expand(-1, M.shape[1], -1, M.shape[3])
+    hi = hi[:, None, :, None].expand(-1, M.shape[1], -1, M.shape[3])
+    H = torch.gather(M, 2, lo) * (1 - w) + torch.gather(M, 2, hi) * w
 
-    for i in range(1, num_frames):
-        dphase = P[0, :, i] - P[0, :, i - 1]
-        dphase = dphase - 2 * np.pi * np.floor((dphase + np.pi) / (2 * np.pi))
-        dphase = dphase / scaling_factor
-        G_L_accum += dphase
-        G_L[:, i] = P[0, :, i - 1] + G_L_accum
+    dphase = torch.diff(P, dim=3)
+    dphase = dphase - 2 * torch.pi * torch.floor((dphase + torch.pi) / (2 * torch.pi))
+    dphase = dphase / scaling_factor.to(P.dtype)[:, None, None, None]
 
-        dphase = P[1, :, i] - P[1, :, i - 1]
-        dphase = dphase - 2 * np.pi * np.floor((dphase + np.pi) / (2 * np.pi))
-        dphase = dphase / scaling_factor
-        G_R_accum += dphase
-        G_R[:, i] = P[1, :, i - 1] + G_R_accum
+    G = torch.zeros_like(P)
+    G[:, :, :, 1:] = P[:, :, :, :-1] + torch.cumsum(dphase, dim=3)
 
-    return np.array([H_L, H_R]), np.array([G_L, G_R])
+    return H, G
 
 def apply_emphasis(M, P, random, coef):
     left_M = M[0]
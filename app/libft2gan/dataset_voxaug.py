@@ -1,14 +1,18 @@
 import os
 import random
+import time
 import numpy as np
 import torch
 import torch.utils.data
 import torch.nn.functional as F
 from libft2gan.dataset_utils import apply_channel_drop, apply_dynamic_range_mod, apply_masking, apply_multiplicative_noise, apply_random_eq, apply_stereo_spatialization, apply_time_stretch, apply_random_phase_noise, apply_time_masking, apply_emphasis, apply_deemphasis, apply_pitch_shift, apply_harmonic_distortion, apply_random_volume
+from libft2gan.patch_shards import array_shape, list_patches, load_crop, load_patch, patch_name
+from libft2gan.patch_stats import LibraryStats
+from libft2gan.vocal_activity import VocalActivity
 import librosa
 
 class VoxAugDataset(torch.utils.data.Dataset):
-    def __init__(self, instrumental_lib=[], vocal_lib=[], is_validation=False, n_fft=2048, hop_length=1024, cropsize=256, sr=44100, seed=0, inst_rate=0.01, data_limit=None, predict_vocals=False, time_scaling=True, vocal_threshold=0.001, vout_bands=4, predict_phase=False):
+    def __init__(self, instrumental_lib=[], vocal_lib=[], is_validation=False, n_fft=2048, hop_length=1024, cropsize=256, sr=44100, seed=0, inst_rate=0.01, data_limit=None, predict_vocals=False, time_scaling=True, vocal_threshold=0.001, vout_bands=4, predict_phase=False, min_vocal_activity=None, vocal_candidates=8):
         self.is_validation = is_validation
         self.vocal_list = []
         self.curr_list = []
@@ -19,6 +23,8 @@ class VoxAugDataset(torch.utils.data.Dataset):
         self.vocal_threshold = vocal_threshold
         self.vout_bands = vout_bands
         self.predict_phase = predict_phase
+        self.min_vocal_activity = min_vocal_activity
+        self.vocal_candidates = vocal_candidates
 
         self.max_bin = n_fft // 2
         self.sr = sr
@@ -27,27 +33,21 @@ class VoxAugDataset(torch.utils.data.Dataset):
         self.cropsize = cropsize
 
         self.random = random.Random(seed)
+        self.stats = LibraryStats(list(instrumental_lib) + list(vocal_lib or []))
+        self.activity = VocalActivity(vocal_lib or [], vout_bands)
 
-        for mp in instrumental_lib:
-            mixes = [os.path.join(mp, f) for f in os.listdir(mp) if os.path.isfile(os.path.join(mp, f))]
+        # libft2gan.device_sampler.DeviceIOStats, set by the training script to time instrumental reads per device
+        self.io_stats = None
 
-            for m in mixes:
-                if m.endswith('.npz'):
-                    self.curr_list.append(m)
+        for mp in instrumental_lib:
+            self.curr_list.extend(list_patches(mp))
             
         if not is_validation and len(vocal_lib) != 0:
             for vp in vocal_lib:
-                vox = [os.path.join(vp, f) for f in os.listdir(vp) if os.path.isfile(os.path.join(vp, f))]
-
-                for v in vox:
-                    if v.endswith('.npz'):
-                        self.vocal_list.append(v)
-
-        def key(p):
-            return os.path.basename(p)
+                self.vocal_list.extend(list_patches(vp))
         
-        self.vocal_list.sort(key=key)
-        self.curr_list.sort(key=key)
+        self.vocal_list.sort(key=patch_name)
+        self.curr_list.sort(key=patch_name)
         self.random.shuffle(self.vocal_list)
         self.random.shuffle(self.curr_list)
 
@@ -57,20 +57,63 @@ class VoxAugDataset(torch.utils.data.Dataset):
     def __len__(self):
         return len(self.curr_list)
 
+    def _crop_range(self, n):
+        if n > self.cropsize:
+            start = self.random.randint(0, n - self.cropsize - 1)
+            return start, start + self.cropsize
+
+        return 0, n
+
+    def _pick_vocals(self, idx):
+        # with min_vocal_activity set, crops are drawn from the activity index until one has enough frames with
+        # vocals (or vocal_candidates have been tried, keeping the best), so silent crops are never loaded
+        vpatch = self.vocal_list[(self.epoch + idx) % len(self.vocal_list)]
+
+        if self.min_vocal_activity is None:
+            return vpatch, None
+
+        best, best_density = (vpatch, None), -1
+        for k in range(self.vocal_candidates):
+            levels = self.activity.levels(vpatch)
+
+            if levels is None:
+                return vpatch, None
+
+            crop = self._crop_range(len(levels))
+            density = self.activity.density(vpatch, *crop, self.vocal_threshold)
+
+            if density >= self.min_vocal_activity:
+                return vpatch, crop
+
+            if density > best_density:
+                best, best_density = (vpatch, crop), density
+
+            vpatch = self.vocal_list[self.random.randrange(len(self.vocal_list))]
+
+        return best
+
     def _get_vocals(self, idx):
-        path = str(self.vocal_list[(self.epoch + idx) % len(self.vocal_list)])
-        vdata = np.load(path, allow_pickle=True)
+        vpatch, crop = self._pick_vocals(idx)
+        vdata = load_patch(vpatch)
             
-        V, Vc = vdata['X'], vdata['c']
-        VCr, VCi = vdata['cr'], vdata['ci']
+        Vc = vdata['c']
+        VCr, VCi = self.stats.song_scale(vpatch, vdata)
+
+        # VP is read from the activity index when nothing below changes the crop's band levels
+        unchanged = False
 
         if self.random.uniform(0,1) < 0.5:
-            V = apply_time_stretch(V, self.random, self.cropsize)
-        elif V.shape[2] > self.cropsize:
-            start = self.random.randint(0, V.shape[2] - self.cropsize - 1)
-            V = V[:, :, start:start+self.cropsize]
+            V = apply_time_stretch(vdata['X'], self.random, self.cropsize, anchor=crop)
+        else:
+            if crop is None:
+                crop = self._crop_range(array_shape(vdata, 'X')[-1])
+
+            V = load_crop(vdata, 'X', lambda n: crop)
+            unchanged = True
 
         if np.random.uniform() < 0.04:
+            unchanged = False
+
             if np.random.uniform() < 0.5:
                 V[0] = 0
             else:
@@ -96,23 +139,26 @@ class VoxAugDataset(torch.utils.data.Dataset):
             if self.random.uniform(0,1) < p:
                 M, P = aug(M, P, self.random, **args)
                 M = np.clip(M / Vc, 0, 1) * Vc
+                unchanged = False
 
         V = M * np.exp(1.j * P)
+        VP = self.activity.vp(vpatch, *crop, self.vocal_threshold) if unchanged else None
 
         if self.random.uniform(0,1) < 0.5:
             V = V[::-1]
+            VP = VP[::-1] if VP is not None else None
 
-        VP = V[:, :-1, :]
-        VP = (np.abs(VP) / Vc).reshape((VP.shape[0], self.vout_bands, VP.shape[1] // self.vout_bands, VP.shape[2]))
-        VP = VP.mean(axis=2)
-        VP = np.where(VP > self.vocal_threshold, 1, 0)
+        if VP is None:
+            VP = V[:, :-1, :]
+            VP = (np.abs(VP) / Vc).reshape((VP.shape[0], self.vout_bands, VP.shape[1] // self.vout_bands, VP.shape[2]))
+            VP = VP.mean(axis=2)
+            VP = np.where(VP > self.vocal_threshold, 1, 0)
 
         return V, VP
 
     def _augment_instruments(self, X, c):
-        if X.shape[2] > self.cropsize:
-            start = self.random.randint(0, X.shape[2] - self.cropsize - 1)
-            X = X[:, :, start:start+self.cropsize]
+        start, end = self._crop_range(X.shape[2])
+        X = X[:, :, start:end]
 
         P = np.angle(X)
         M = np.abs(X)
@@ -139,26 +185,56 @@ class VoxAugDataset(torch.utils.data.Dataset):
             X = X[::-1]
 
         return X
+
+    def _training_item(self, idx, Y, c):
+        Y = self._augment_instruments(Y, c)
+        V, VP = self._get_vocals(idx)
+
+        return self._output(Y + V, Y, VP, c)
+
+    def item_crops(self, idx, count):
+        # count training items cut from one read of patch idx, each with its own crop, augmentation and vocals; used
+        # by libft2gan.crop_stream.CropStream
+        patch = self.curr_list[idx % len(self.curr_list)]
+        start = time.perf_counter()
+        data = load_patch(patch)
+        Y, c = data['X' if 'Y' not in data.files else 'Y'], data['c']
+
+        if self.io_stats is not None:
+            self.io_stats.record(patch, time.perf_counter() - start)
+
+        for k in range(count):
+            start, end = self._crop_range(Y.shape[2])
+            yield self._training_item(idx * count + k, Y[:, :, start:end], c)
     
     def __getitem__(self, idx):
-        path = str(self.curr_list[idx % len(self.curr_list)])
-        data = np.load(path, allow_pickle=True)
+        patch = self.curr_list[idx % len(self.curr_list)]
+        start = time.perf_counter()
+        data = load_patch(patch)
         aug = 'Y' not in data.files
 
-        X, c = data['X'], data['c']
-        cr, ci = data['cr'], data['ci']
-        Y = X if aug else data['Y']
-        V, VP = None, np.zeros((X.shape[0], self.vout_bands, X.shape[2]))
+        c = data['c']
+        cr, ci = self.stats.song_scale(patch, data)
 
         if not self.is_validation:
-            Y = self._augment_instruments(Y, c)
-            V, VP = self._get_vocals(idx)
-            X = Y + V
-        elif X.shape[2] > self.cropsize:
-            start = self.random.randint(0, X.shape[2] - self.cropsize - 1)
-            X = X[:, :, start:start+self.cropsize]
-            Y = Y[:, :, start:start+self.cropsize]
+            Y = load_crop(data, 'X' if aug else 'Y', self._crop_range)
+
+            if self.io_stats is not None:
+                self.io_stats.record(patch, time.perf_counter() - start)
+
+            return self._training_item(idx, Y, c)
+
+        X = data['X']
+        Y = X if aug else data['Y']
+        VP = np.zeros((X.shape[0], self.vout_bands, X.shape[2]))
+
+        start, end = self._crop_range(X.shape[2])
+        X = X[:, :, start:end]
+        Y = Y[:, :, start:end]
+
+        return self._output(X, Y, VP, c)
 
+    def _output(self, X, Y, VP, c):
         XP = (np.angle(X) + np.pi) / (2 * np.pi)
         YP = (np.angle(Y) + np.pi) / (2 * np.pi)
         X = np.abs(X) / c
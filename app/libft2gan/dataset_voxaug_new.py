@@ -1,5 +1,6 @@
 import os
 import random
+import time
 import numpy as np
 import torch
 import torch.utils.data
@@ -8,6 +9,8 @@ import librosa
 
 import pedalboard
 
+from libft2gan.patch_shards import list_patches, load_crop, load_patch, patch_name
+
 def normalize_waveform(W, W2=None):
     if W2 is not None:
         normalized_waveform = W / np.max([1, np.abs(W).max(), np.abs(W2).max()])
@@ -24,8 +27,33 @@ def one_hot_encode_waveform(quantized_waveform, num_levels=256):
     one_hot_waveform = np.eye(num_levels)[quantized_waveform]
     return one_hot_waveform
 
+# batched equivalents of the pedalboard chains below for libft2gan.waveform_augmentation.WaveformAugmentation
+BATCH_VOCAL_AUGMENTATIONS = [
+    (0.2, 'compressor', { 'threshold_db': (-30, -10), 'ratio': (1.5, 10.0), 'attack_ms': (1, 50), 'release_ms': (50, 500) }),
+    (0.2, 'distortion', { 'drive_db': (0, 15) }),
+    (0.1, 'highpass', { 'cutoff_frequency_hz': (0, 1000) }),
+    (0.2, 'lowpass', { 'cutoff_frequency_hz': (2000, 10000) }),
+    (0.1, 'high_shelf', { 'cutoff_frequency_hz': (1000, 16000), 'gain_db': (-6, 6), 'q': (0.5, 2) }),
+    (0.1, 'low_shelf', { 'cutoff_frequency_hz': (1, 1000), 'gain_db': (-6, 6), 'q': (0.5, 2) }),
+    (0.25, 'peak', { 'cutoff_frequency_hz': (25, 500), 'gain_db': (-6, 6), 'q': (0.5, 2) }),
+    (0.25, 'peak', { 'cutoff_frequency_hz': (300, 1200), 'gain_db': (-6, 6), 'q': (0.5, 2) }),
+    (0.25, 'peak', { 'cutoff_frequency_hz': (1000, 4000), 'gain_db': (-6, 6), 'q': (0.5, 2) }),
+    (0.25, 'peak', { 'cutoff_frequency_hz': (4000, 12000), 'gain_db': (-6, 6), 'q': (0.5, 2) }),
+    (0., 'limiter', { 'threshold_db': (-12, -3), 'release_ms': (50, 200) }),
+    (0.2, 'noise_gate', { 'threshold_db': (-100, -20), 'ratio': (1, 10), 'attack_ms': (0.1, 10), 'release_ms': (20, 200) }),
+    (0.2, 'pitch_shift', { 'semitones': (-12, 12) }),
+]
+
+BATCH_INSTRUMENT_AUGMENTATIONS = [
+    (0.2, 'peak', { 'cutoff_frequency_hz': (25, 500), 'gain_db': (-6, 6), 'q': (0.5, 2) }),
+    (0.2, 'peak', { 'cutoff_frequency_hz': (300, 1200), 'gain_db': (-6, 6), 'q': (0.5, 2) }),
+    (0.2, 'peak', { 'cutoff_frequency_hz': (1000, 4000), 'gain_db': (-6, 6), 'q': (0.5, 2) }),
+    (0.2, 'peak', { 'cutoff_frequency_hz': (4000, 12000), 'gain_db': (-6, 6), 'q': (0.5, 2) }),
+    (0.2, 'pitch_shift', { 'semitones': (-4, 4) }),
+]
+
 class VoxAugDataset(torch.utils.data.Dataset):
-    def __init__(self, instrumental_lib=[], vocal_lib=[], is_validation=False, n_fft=2048, hop_length=1024, cropsize=256, sr=44100, seed=0, inst_rate=0.01, data_limit=None, predict_vocals=False, time_scaling=True, vocal_threshold=0.001, vout_bands=4, predict_phase=False, n_mels=256):
+    def __init__(self, instrumental_lib=[], vocal_lib=[], is_validation=False, n_fft=2048, hop_length=1024, cropsize=256, sr=44100, seed=0, inst_rate=0.01, data_limit=None, predict_vocals=False, time_scaling=True, vocal_threshold=0.001, vout_bands=4, predict_phase=False, n_mels=256, batch_augment=False):
         self.is_validation = is_validation
         self.vocal_list = []
         self.curr_list = []
@@ -37,6 +65,7 @@ class VoxAugDataset(torch.utils.data.Dataset):
         self.vout_bands = vout_bands
         self.predict_phase = predict_phase
         self.n_mels = n_mels
+        self.batch_augment = batch_augment
 
         self.max_bin = n_fft // 2
         self.sr = sr
@@ -46,26 +75,18 @@ class VoxAugDataset(torch.utils.data.Dataset):
 
         self.random = random.Random(seed)
 
-        for mp in instrumental_lib:
-            mixes = [os.path.join(mp, f) for f in os.listdir(mp) if os.path.isfile(os.path.join(mp, f))]
+        # libft2gan.device_sampler.DeviceIOStats, set by the training script to time instrumental reads per device
+        self.io_stats = None
 
-            for m in mixes:
-                if m.endswith('.npz'):
-                    self.curr_list.append(m)
+        for mp in instrumental_lib:
+            self.curr_list.extend(list_patches(mp))
             
         if not is_validation and len(vocal_lib) != 0:
             for vp in vocal_lib:
-                vox = [os.path.join(vp, f) for f in os.listdir(vp) if os.path.isfile(os.path.join(vp, f))]
-
-                for v in vox:
-                    if v.endswith('.npz'):
-                        self.vocal_list.append(v)
-
-        def key(p):
-            return os.path.basename(p)
+                self.vocal_list.extend(list_patches(vp))
         
-        self.vocal_list.sort(key=key)
-        self.curr_list.sort(key=key)
+        self.vocal_list.sort(key=patch_name)
+        self.curr_list.sort(key=patch_name)
         self.random.shuffle(self.vocal_list)
         self.random.shuffle(self.curr_list)
 
@@ -77,35 +98,38 @@ class VoxAugDataset(torch.utils.data.Dataset):
     def __len__(self):
         return len(self.curr_list)
 
+    def _crop_range(self, n):
+        if (n // self.hop_length) > self.cropsize:
+            start = self.random.randint(0, (n // self.hop_length) - self.cropsize - 1)
+            return start * self.hop_length, (start + self.cropsize) * self.hop_length
+
+        return 0, n
+
     def _get_vocals(self, idx):
-        path = str(self.vocal_list[(self.epoch + idx) % len(self.vocal_list)])
-        vdata = np.load(path, allow_pickle=True)
+        vdata = load_patch(self.vocal_list[(self.epoch + idx) % len(self.vocal_list)])
             
-        W, Vc = vdata['XW'][:2], vdata['c']
-        
-        if (W.shape[1] // self.hop_length) > self.cropsize:
-            start = self.random.randint(0, (W.shape[1] // self.hop_length) - self.cropsize - 1)
-            ws = start * self.hop_length
-            we = (start + self.cropsize) * self.hop_length
-            W = W[:, ws:we]
-
-        augmentations = [
-            (0.2, pedalboard.Compressor(threshold_db=np.random.uniform(-30,-10), ratio=np.random.uniform(1.5, 10.0), attack_ms=np.random.uniform(1,50), release_ms=np.random.uniform(50,500))),
-            (0.2, pedalboard.Distortion(drive_db=np.random.uniform(0,15))),
-            (0.1, pedalboard.HighpassFilter(cutoff_frequency_hz=np.random.uniform(0,1000))),
-            (0.2, pedalboard.LowpassFilter(cutoff_frequency_hz=np.random.uniform(2000,10000))),
-            (0.1, pedalboard.HighShelfFilter(cutoff_frequency_hz=np.random.uniform(1000, 16000), gain_db=np.random.uniform(-6,6), q=np.random.uniform(0.5, 2) )),
-            (0.1, pedalboard.LowShelfFilter(cutoff_frequency_hz=np.random.uniform(1, 1000), gain_db=np.random.uniform(-6,6), q=np.random.uniform(0.5, 2) )),
-            (0.25, pedalboard.PeakFilter(cutoff_frequency_hz=np.random.uniform(25,500), gain_db=np.random.uniform(-6,6), q=np.random.uniform(0.5,2))),
-            (0.25, pedalboard.PeakFilter(cutoff_frequency_hz=np.random.uniform(300,1200), gain_db=np.random.uniform(-6,6), q=np.random.uniform(0.5,2))),
-            (0.25, pedalboard.PeakFilter(cutoff_frequency_hz=np.random.uniform(1000,4000), gain_db=np.random.uniform(-6,6), q=np.random.uniform(0.5,2))),
-            (0.25, pedalboard.PeakFilter(cutoff_frequency_hz=np.random.uniform(4000,12000), gain_db=np.random.uniform(-6,6), q=np.random.uniform(0.5,2))),
-            (0., pedalboard.Limiter(threshold_db=np.random.uniform(-12,-3), release_ms=np.random.uniform(50,200))),
-            (0.2, pedalboard.NoiseGate(threshold_db=np.random.uniform(-100,-20), ratio=np.random.uniform(1,10), attack_ms=np.random.uniform(0.1, 10), release_ms=np.random.uniform(20, 200))),
-            (0.2, pedalboard.PitchShift(np.random.uniform(-12,12))),
-            # (0.2, pedalboard.MP3Compressor(vbr_quality=np.random.uniform(1,6))),
-            # (0.2, pedalboard.Invert())
-        ] 
+        W, Vc = load_crop(vdata, 'XW', self._crop_range)[:2], vdata['c']
+
+        if self.batch_augment:
+            augmentations = []
+        else:
+            augmentations = [
+                (0.2, pedalboard.Compressor(threshold_db=np.random.uniform(-30,-10), ratio=np.random.uniform(1.5, 10.0), attack_ms=np.random.uniform(1,50), release_ms=np.random.uniform(50,500))),
+                (0.2, pedalboard.Distortion(drive_db=np.random.uniform(0,15))),
+                (0.1, pedalboard.HighpassFilter(cutoff_frequency_hz=np.random.uniform(0,1000))),
+                (0.2, pedalboard.LowpassFilter(cutoff_frequency_hz=np.random.uniform(2000,10000))),
+                (0.1, pedalboard.HighShelfFilter(cutoff_frequency_hz=np.random.uniform(1000, 16000), gain_db=np.random.uniform(-6,6), q=np.random.uniform(0.5, 2) )),
+                (0.1, pedalboard.LowShelfFilter(cutoff_frequency_hz=np.random.uniform(1, 1000), gain_db=np.random.uniform(-6,6), q=np.random.uniform(0.5, 2) )),
+                (0.25, pedalboard.PeakFilter(cutoff_frequency_hz=np.random.uniform(25,500), gain_db=np.random.uniform(-6,6), q=np.random.uniform(0.5,2))),
+                (0.25, pedalboard.PeakFilter(cutoff_frequency_hz=np.random.uniform(300,1200), gain_db=np.random.uniform(-6,6), q=np.random.uniform(0.5,2))),
+                (0.25, pedalboard.PeakFilter(cutoff_frequency_hz=np.random.uniform(1000,4000), gain_db=np.random.uniform(-6,6), q=np.random.uniform(0.5,2))),
+                (0.25, pedalboard.PeakFilter(cutoff_frequency_hz=np.random.uniform(4000,12000), gain_db=np.random.uniform(-6,6), q=np.random.uniform(0.5,2))),
+                (0., pedalboard.Limiter(threshold_db=np.random.uniform(-12,-3), release_ms=np.random.uniform(50,200))),
+                (0.2, pedalboard.NoiseGate(threshold_db=np.random.uniform(-100,-20), ratio=np.random.uniform(1,10), attack_ms=np.random.uniform(0.1, 10), release_ms=np.random.uniform(20, 200))),
+                (0.2, pedalboard.PitchShift(np.random.uniform(-12,12))),
+                # (0.2, pedalboard.MP3Compressor(vbr_quality=np.random.uniform(1,6))),
+                # (0.2, pedalboard.Invert())
+            ]
 
         random.shuffle(augmentations)
 
@@ -142,28 +166,28 @@ class VoxAugDataset(torch.utils.data.Dataset):
         return W#, WP, VP
 
     def _augment_instruments(self, W):
-        if (W.shape[1] // self.hop_length) > self.cropsize:
-            start = self.random.randint(0, (W.shape[1] // self.hop_length) - self.cropsize - 1)
-            ws = start * self.hop_length
-            we = (start + self.cropsize) * self.hop_length
-            W = W[:, ws:we]
-
-        augmentations = [
-            # (0.1, pedalboard.Compressor(threshold_db=np.random.uniform(-30,-10), ratio=np.random.uniform(1.5, 10.0), attack_ms=np.random.uniform(1,50), release_ms=np.random.uniform(50,500))),
-            # (0.1, pedalboard.Distortion(drive_db=np.random.uniform(0,15))),
-            # (0.1, pedalboard.HighpassFilter(cutoff_frequency_hz=np.random.uniform(0,1000))),
-            # (0.1, pedalboard.LowpassFilter(cutoff_frequency_hz=np.random.uniform(2000,10000))),
-            # (0.1, pedalboard.HighShelfFilter(cutoff_frequency_hz=np.random.uniform(1000, 16000), gain_db=np.random.uniform(-6,6), q=np.random.uniform(0.5, 2) )),
-            # (0.1, pedalboard.LowShelfFilter(cutoff_frequency_hz=np.random.uniform(1, 1000), gain_db=np.random.uniform(-6,6), q=np.random.uniform(0.5, 2) )),
-            (0.2, pedalboard.PeakFilter(cutoff_frequency_hz=np.random.uniform(25,500), gain_db=np.random.uniform(-6,6), q=np.random.uniform(0.5,2))),
-            (0.2, pedalboard.PeakFilter(cutoff_frequency_hz=np.random.uniform(300,1200), gain_db=np.random.uniform(-6,6), q=np.random.uniform(0.5,2))),
-            (0.2, pedalboard.PeakFilter(cutoff_frequency_hz=np.random.uniform(1000,4000), gain_db=np.random.uniform(-6,6), q=np.random.uniform(0.5,2))),
-            (0.2, pedalboard.PeakFilter(cutoff_frequency_hz=np.random.uniform(4000,12000), gain_db=np.random.uniform(-6,6), q=np.random.uniform(0.5,2))),
-            # (0.2, pedalboard.Invert()),
-            # (0.1, pedalboard.Limiter(threshold_db=np.random.uniform(-12,-3), release_ms=np.random.uniform(50,200))),
-            # (0.1, pedalboard.NoiseGate(threshold_db=np.random.unifmorm(-100,-20), ratio=np.random.uniform(1,10), attack_ms=np.random.uniform(0.1, 10), release_ms=np.random.uniform(20, 200))),
-            (0.2, pedalboard.PitchShift(np.random.uniform(-4,4))),
-        ] 
+        ws, we = self._crop_range(W.shape[1])
+        W = W[:, ws:we]
+
+        if self.batch_augment:
+            augmentations = []
+        else:
+            augmentations = [
+                # (0.1, pedalboard.Compressor(threshold_db=np.random.uniform(-30,-10), ratio=np.random.uniform(1.5, 10.0), attack_ms=np.random.uniform(1,50), release_ms=np.random.uniform(50,500))),
+                # (0.1, pedalboard.Distortion(drive_db=np.random.uniform(0,15))),
+                # (0.1, pedalboard.HighpassFilter(cutoff_frequency_hz=np.random.uniform(0,1000))),
+                # (0.1, pedalboard.LowpassFilter(cutoff_frequency_hz=np.random.uniform(2000,10000))),
+                # (0.1, pedalboard.HighShelfFilter(cutoff_frequency_hz=np.random.uniform(1000, 16000), gain_db=np.random.uniform(-6,6), q=np.random.uniform(0.5, 2) )),
+                # (0.1, pedalboard.LowShelfFilter(cutoff_frequency_hz=np.random.uniform(1, 1000), gain_db=np.random.uniform(-6,6), q=np.random.uniform(0.5, 2) )),
+                (0.2, pedalboard.PeakFilter(cutoff_frequency_hz=np.random.uniform(25,500), gain_db=np.random.uniform(-6,6), q=np.random.uniform(0.5,2))),
+                (0.2, pedalboard.PeakFilter(cutoff_frequency_hz=np.random.uniform(300,1200), gain_db=np.random.uniform(-6,6), q=np.random.uniform(0.5,2))),
+                (0.2, pedalboard.PeakFilter(cutoff_frequency_hz=np.random.uniform(1000,4000), gain_db=np.random.uniform(-6,6), q=np.random.uniform(0.5,2))),
+                (0.2, pedalboard.PeakFilter(cutoff_frequency_hz=np.random.uniform(4000,12000), gain_db=np.random.uniform(-6,6), q=np.random.uniform(0.5,2))),
+                # (0.2, pedalboard.Invert()),
+                # (0.1, pedalboard.Limiter(threshold_db=np.random.uniform(-12,-3), release_ms=np.random.uniform(50,200))),
+                # (0.1, pedalboard.NoiseGate(threshold_db=np.random.unifmorm(-100,-20), ratio=np.random.uniform(1,10), attack_ms=np.random.uniform(0.1, 10), release_ms=np.random.uniform(20, 200))),
+                (0.2, pedalboard.PitchShift(np.random.uniform(-4,4))),
+            ]
 
         random.shuffle(augmentations)
 
@@ -182,27 +206,59 @@ class VoxAugDataset(torch.utils.data.Dataset):
             W = W[::-1]
 
         return W
+
+    def _training_item(self, idx, YW, c):
+        YW = self._augment_instruments(YW)
+        VW = self._get_vocals(idx)
+
+        if self.batch_augment:
+            # mixed on the device after WaveformAugmentation, see libft2gan.waveform_augmentation.mix_vocals
+            return YW.astype(np.float32), VW.astype(np.float32), c.astype(np.float32)
+
+        XW = normalize_waveform(YW) + normalize_waveform(VW)
+        XW = normalize_waveform(XW, YW)
+        YW = normalize_waveform(YW, XW)
+
+        return XW.astype(np.float32), YW.astype(np.float32), c.astype(np.float32)
+
+    def item_crops(self, idx, count):
+        # count training items cut from one read of patch idx, each with its own crop, augmentation and vocals; used
+        # by libft2gan.crop_stream.CropStream
+        patch = self.curr_list[idx % len(self.curr_list)]
+        start = time.perf_counter()
+        data = load_patch(patch)
+        W, c = data['XW'][:2], data['c']
+
+        if self.io_stats is not None:
+            self.io_stats.record(patch, time.perf_counter() - start)
+
+        for k in range(count):
+            ws, we = self._crop_range(W.shape[1])
+
+            # augmentations write into their input, so every crop gets its own copy
+            yield self._training_item(idx * count + k, W[:, ws:we].copy(), c)
     
     def __getitem__(self, idx):
-        path = str(self.curr_list[idx % len(self.curr_list)])
-        data = np.load(path, allow_pickle=True)
+        patch = self.curr_list[idx % len(self.curr_list)]
+        start = time.perf_counter()
+        data = load_patch(patch)
         aug = 'YW' not in data.files
-
-        XW, c = data['XW'][:2], data['c']
-        YW  = XW if aug else data['YW'][:2]
+        c = data['c']
 
         if not self.is_validation:
-            YW = self._augment_instruments(XW)
-            VW = self._get_vocals(idx)
-            XW = normalize_waveform(YW) + normalize_waveform(VW)
-            
-        elif self.is_validation:
-            if (XW.shape[1] // self.hop_length) > self.cropsize:
-                start = self.random.randint(0, (XW.shape[1] // self.hop_length) - self.cropsize - 1)
-                ws = start * self.hop_length
-                we = (start + self.cropsize) * self.hop_length
-                XW = XW[:, ws:we]
-                YW = YW[:, ws:we]
+            YW = load_crop(data, 'XW', self._crop_range)[:2]
+
+            if self.io_stats is not None:
+                self.io_stats.record(patch, time.perf_counter() - start)
+
+            return self._training_item(idx, YW, c)
+
+        XW = data['XW'][:2]
+        YW = XW if aug else data['YW'][:2]
+
+        ws, we = self._crop_range(XW.shape[1])
+        XW = XW[:, ws:we]
+        YW = YW[:, ws:we]
 
         XW = normalize_waveform(XW, YW)
         YW = normalize_waveform(YW, XW)
@@ -0,0 +1,125 @@
+import math
+import os
+import random
+import torch
+import torch.distributed
+import torch.utils.data
+
+from libft2gan.patch_shards import patch_library
+
+def library_device(library):
+    # st_dev identifies the filesystem a library lives on, the volume serial number for drive letters on windows
+    return os.stat(library).st_dev
+
+class DeviceIOStats(object):
+    # per device read counts and seconds, kept in shared memory so the dataloader workers that time the reads and
+    # the sampler in the main process see the same numbers. updates from concurrent workers are not locked; the
+    # counters only steer the sampler
+    def __init__(self, patches):
+        devices = {}
+        self.library_devices = {}
+        self.device_names = []
+
+        for patch in patches:
+            library = patch_library(patch)
+
+            if library not in self.library_devices:
+                dev = library_device(library)
+
+                if dev not in devices:
+                    devices[dev] = len(devices)
+                    self.device_names.append(library)
+
+                self.library_devices[library] = devices[dev]
+
+        self.counters = torch.zeros((len(devices), 2), dtype=torch.float64).share_memory_()
+
+    def __len__(self):
+        return self.counters.shape[0]
+
+    def device(self, patch):
+        return self.library_devices[patch_library(patch)]
+
+    def record(self, patch, seconds):
+        d = self.device(patch)
+        self.counters[d, 0] += 1
+        self.counters[d, 1] += seconds
+
+    def reads_per_second(self, min_reads=16):
+        # None for devices without enough reads yet
+        reads, seconds = self.counters[:, 0].tolist(), self.counters[:, 1].tolist()
+        return [r / s if r >= min_reads and s > 0 else None for r, s in zip(reads, seconds)]
+
+    def summary(self):
+        rates = self.reads_per_second(min_reads=1)
+        return ', '.join(f'{self.device_names[d]} {int(self.counters[d, 0])} reads {rate:.1f}/s' for d, rate in enumerate(rates) if rate is not None)
+
+class DeviceBalancedSampler(torch.utils.data.Sampler):
+    # a shuffled permutation of the dataset per epoch (split across ranks like DistributedSampler) that is reordered
+    # so consecutive reads alternate between the devices the patches live on. devices take turns by smooth weighted
+    # round robin with weights equal to their remaining reads, so a device with more patches is visited more often
+    # instead of being left alone at the end of the epoch. with weighted=True the weights are also scaled by each
+    # device's reads per second as measured when set_epoch was called, which moves reads to faster devices earlier
+    # in the epoch. the rates are frozen so every iteration of an epoch (one per CropStream worker) gives the same order
+    def __init__(self, patches, stats, weighted=False, num_replicas=None, rank=None, seed=0, refresh=256):
+        if num_replicas is None:
+            num_replicas = torch.distributed.get_world_size() if torch.distributed.is_available() and torch.distributed.is_initialized() else 1
+
+        if rank is None:
+            rank = torch.distributed.get_rank() if torch.distributed.is_available() and torch.distributed.is_initialized() else 0
+
+        self.stats = stats
+        self.devices = [stats.device(p) for p in patches]
+        self.weighted = weighted
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.refresh = refresh
+        self.epoch = 0
+        self.rates = [None] * len(stats)
+        self.num_samples = math.ceil(len(self.devices) / num_replicas)
+        self.total_size = self.num_samples * num_replicas
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+        if self.weighted:
+            self.rates = self.stats.reads_per_second()
+
+    def __len__(self):
+        return self.num_samples
+
+    def _weights(self, queues):
+        known = [r for r in self.rates if r is not None]
+        mean = sum(known) / len(known) if len(known) > 0 else 1
+
+        return [len(q) * (self.rates[d] / mean if self.rates[d] is not None else 1) for d, q in enumerate(queues)]
+
+    def __iter__(self):
+        g = random.Random(self.seed + self.epoch)
+        indices = list(range(len(self.devices)))
+        g.shuffle(indices)
+
+        indices += indices[:self.total_size - len(indices)]
+        indices = indices[self.rank:self.total_size:self.num_replicas]
+
+        queues = [[] for _ in range(len(self.stats))]
+        for i in indices:
+            queues[self.devices[i]].append(i)
+
+        for q in queues:
+            q.reverse()
+
+        current = [0.] * len(queues)
+        for n in range(len(indices)):
+            if n % self.refresh == 0:
+                weights = self._weights(queues)
+
+            for d, w in enumerate(weights):
+                if len(queues[d]) > 0:
+                    current[d] += w
+
+            d = max((d for d in range(len(queues)) if len(queues[d]) > 0), key=lambda d: current[d])
+            current[d] -= sum(w for w, q in zip(weights, queues) if len(q) > 0)
+
+            yield queues[d].pop()
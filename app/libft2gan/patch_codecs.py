@@ -0,0 +1,95 @@
+import functools
+import numpy as np
+
+# storage codecs for patch shards. every codec works elementwise, so it is applied after the writer has chosen the
+# array layout and a crop can be decoded on its own. complex codecs add a trailing axis of 2 to the stored array
+CODECS = {
+    'raw': None,
+    'f16': np.float16,
+    'logmag8': np.uint8,
+    'logmag16': np.uint16,
+    'pcm16': np.int16,
+}
+
+# range of magnitudes kept below the loudest bin of the array; quieter bins decode to exactly zero
+LOGMAG_RANGE_DB = {
+    'logmag8': 96,
+    'logmag16': 160,
+}
+
+def storage(codec, dtype, shape):
+    dtype = np.dtype(dtype)
+
+    if codec == 'raw':
+        return dtype, tuple(shape)
+
+    pair = np.issubdtype(dtype, np.complexfloating)
+    return np.dtype(CODECS[codec]), tuple(shape) + ((2,) if pair else ())
+
+def encode(codec, X):
+    # returns (stored array, (p0, p1)) where the two parameters are what decode needs to invert the codec
+    complex_input = np.iscomplexobj(X)
+
+    if codec == 'raw':
+        return X, (0., 0.)
+    elif codec == 'f16':
+        if complex_input:
+            return np.stack((X.real, X.imag), axis=-1).astype(np.float16), (0., 0.)
+
+        return X.astype(np.float16), (0., 0.)
+    elif codec in LOGMAG_RANGE_DB:
+        if not complex_input:
+            raise ValueError(f'{codec} stores complex spectrograms, got {X.dtype}')
+
+        levels = np.iinfo(CODECS[codec]).max + 1
+        M = np.abs(X)
+        peak = M.max()
+        hi = float(np.log(peak)) if peak > 0 else 0.
+        lo = hi - LOGMAG_RANGE_DB[codec] * np.log(10) / 20
+
+        # code 0 is silence, 1..levels-1 cover [lo, hi] in the log domain
+        with np.errstate(divide='ignore'):
+            L = np.log(M)
+
+        m = np.clip(np.round((L - lo) / (hi - lo) * (levels - 2)) + 1, 0, levels - 1)
+        m = np.where(L >= lo, m, 0)
+        p = np.round((np.angle(X) + np.pi) / (2 * np.pi) * levels) % levels
+
+        return np.stack((m, p), axis=-1).astype(CODECS[codec]), (lo, hi)
+    elif codec == 'pcm16':
+        if complex_input:
+            raise ValueError(f'pcm16 stores real waveforms, got {X.dtype}')
+
+        peak = float(np.abs(X).max())
+        scale = peak if peak > 0 else 1.
+
+        return np.round(X / scale * 32767).astype(np.int16), (scale, 0.)
+
+    raise ValueError(f'unknown patch codec: {codec}')
+
+@functools.lru_cache(maxsize=64)
+def _logmag_tables(codec, lo, hi):
+    levels = np.iinfo(CODECS[codec]).max + 1
+    mag = np.zeros(levels, dtype=np.float32)
+    mag[1:] = np.exp(lo + np.arange(levels - 1) / (levels - 2) * (hi - lo))
+    phase = np.exp(1.j * (np.arange(levels) / levels * 2 * np.pi - np.pi)).astype(np.complex64)
+
+    return mag, phase
+
+def decode(codec, S, params, dtype):
+    dtype = np.dtype(dtype)
+
+    if codec == 'raw':
+        return S
+    elif codec == 'f16':
+        if np.issubdtype(dtype, np.complexfloating):
+            return S.astype(np.float32).view(np.complex64)[..., 0].astype(dtype, copy=False)
+
+        return S.astype(dtype)
+    elif codec in LOGMAG_RANGE_DB:
+        mag, phase = _logmag_tables(codec, float(params[0]), float(params[1]))
+        return (mag[S[..., 0]] * phase[S[..., 1]]).astype(dtype, copy=False)
+    elif codec == 'pcm16':
+        return (S * np.float32(params[0] / 32767)).astype(dtype, copy=False)
+
+    raise ValueError(f'unknown patch codec: {codec}')
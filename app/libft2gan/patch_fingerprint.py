@@ -0,0 +1,242 @@
+import multiprocessing
+import os
+import numpy as np
+import librosa
+
+from tqdm import tqdm
+
+from libft2gan.patch_shards import library_entries, open_patch
+
+# compact spectral fingerprints of patches for finding the same audio under different names or encodings. each
+# fingerprint frame is 32 bits: the signs of the change over time of the energy differences between 33 log spaced
+# bands, which survive gain changes and lossy re-encoding. fingerprints are cached per library in a sidecar that is
+# updated incrementally like the statistics index
+FINGERPRINT_NAME = 'fingerprints.index'
+BANDS = 33
+WEIGHTS = (1 << np.arange(BANDS - 1, dtype=np.uint64)).astype(np.uint64)
+
+# copies that were trimmed or decoded a fraction of a hop apart flip 10-20% of the bits, so whole 32 bit frames
+# rarely match exactly. lookups use overlapping 24 bit slices of each frame instead (banded lsh), and candidates are
+# verified on the full frames
+SUBKEY_BITS = 24
+SUBKEY_SHIFTS = [0, 4, 8]
+
+def fingerprint_path(library):
+    return os.path.join(library, FINGERPRINT_NAME)
+
+def band_edges(num_bins, sr=44100, fmin=300, fmax=5000):
+    n_fft = (num_bins - 1) * 2
+    edges = np.round(np.geomspace(fmin, fmax, BANDS + 1) * n_fft / sr).astype(int)
+
+    # the lowest bands are narrower than a bin at small n_fft
+    for i in range(1, len(edges)):
+        edges[i] = max(edges[i], edges[i - 1] + 1)
+
+    return edges
+
+def fingerprint(X, pool=4, sr=44100, silence_db=-40):
+    # X is a [channels, bins, frames] spectrogram; returns one uint32 for every pool frames (less the first) and a
+    # mask of the frames loud enough to be matched on. band energies are smoothed over 2 * pool frames first so a
+    # shift of part of a hop changes few bits
+    M = np.abs(X).mean(axis=0) ** 2
+    edges = band_edges(M.shape[0], sr)
+
+    if edges[-1] >= M.shape[0] or M.shape[1] < 2 * pool + pool:
+        return np.zeros(0, dtype=np.uint32), np.zeros(0, dtype=bool)
+
+    E = np.add.reduceat(M, edges, axis=0)[:BANDS]
+    E = np.cumsum(np.pad(E, ((0, 0), (1, 0))), axis=1)
+    E = (E[:, 2 * pool:] - E[:, :-2 * pool])[:, ::pool]
+
+    D = E[:-1] - E[1:]
+    bits = (D[:, 1:] - D[:, :-1]) > 0
+    values = (bits.T.astype(np.uint64) @ WEIGHTS).astype(np.uint32)
+
+    total = E.sum(axis=0)[1:]
+    valid = total > total.max() * 10 ** (silence_db / 10) if total.max() > 0 else np.zeros(len(total), dtype=bool)
+    valid &= (values != 0) & (values != np.iinfo(np.uint32).max)
+
+    return values, valid
+
+def _fingerprint_patch(task):
+    library, key, pool, sr, n_fft, hop_length = task
+    data = open_patch(library, key)
+
+    if 'X' in data.files:
+        return key, fingerprint(data['X'], pool, sr)
+
+    # waveform patches are brought to the spectrogram frame rate of the other libraries first
+    W = data['XW'][:2]
+    return key, fingerprint(librosa.stft(W.mean(axis=0), n_fft=n_fft, hop_length=hop_length)[None], pool, sr)
+
+class FingerprintIndex(object):
+    def __init__(self, library):
+        self.library = library
+        self.params = None
+        self.names, self.songs, self.stamps = [], [], []
+        self.offsets = np.zeros(1, dtype=np.int64)
+        self.values = np.zeros(0, dtype=np.uint32)
+        self.valid = np.zeros(0, dtype=bool)
+
+        if os.path.exists(fingerprint_path(library)):
+            with np.load(fingerprint_path(library)) as index:
+                self.params = index['params'].tolist()
+                self.names = index['names'].tolist()
+                self.songs = index['songs'].tolist()
+                self.stamps = index['stamps'].tolist()
+                self.offsets = index['offsets']
+                self.values = index['values']
+                self.valid = index['valid']
+
+        self.lookup = { n: i for i, n in enumerate(self.names) }
+
+    def __len__(self):
+        return len(self.names)
+
+    def get(self, i):
+        start, stop = self.offsets[i], self.offsets[i + 1]
+        return self.values[start:stop], self.valid[start:stop]
+
+    def save(self, params, names, songs, stamps, fingerprints):
+        tmp = fingerprint_path(self.library) + '.tmp'
+        offsets = np.cumsum([0] + [len(v) for v, _ in fingerprints])
+
+        with open(tmp, 'wb') as f:
+            np.savez(
+                f, params=np.array(params), names=np.array(names, dtype=str), songs=np.array(songs, dtype=str), stamps=np.array(stamps), offsets=offsets,
+                values=np.concatenate([v for v, _ in fingerprints] + [np.zeros(0, dtype=np.uint32)]),
+                valid=np.concatenate([m for _, m in fingerprints] + [np.zeros(0, dtype=bool)]))
+
+        os.replace(tmp, fingerprint_path(self.library))
+
+def update_fingerprints(library, pool=4, sr=44100, n_fft=2048, hop_length=1024, num_workers=None):
+    index = FingerprintIndex(library)
+    params = [pool, sr, n_fft, hop_length]
+    reuse = index.params == params
+
+    entries = library_entries(library)
+    names = [n for n, _, _, _ in entries]
+    keys = { n: k for n, k, _, _ in entries }
+    songs = { n: s for n, _, s, _ in entries }
+    stamps = { n: t for n, _, _, t in entries }
+
+    fingerprints = {}
+    if reuse:
+        for n in names:
+            i = index.lookup.get(n)
+
+            if i is not None and index.stamps[i] == stamps[n]:
+                fingerprints[n] = index.get(i)
+
+    tasks = [(library, keys[n], pool, sr, n_fft, hop_length) for n in names if n not in fingerprints]
+    print(f'{library}: {len(tasks)} patches to fingerprint, {len(fingerprints)} up to date')
+
+    if len(tasks) > 0:
+        lookup = { keys[n]: n for n in names }
+
+        with multiprocessing.Pool(num_workers if num_workers is not None else os.cpu_count()) as workers:
+            for key, fp in tqdm(workers.imap_unordered(_fingerprint_patch, tasks, chunksize=16), total=len(tasks)):
+                fingerprints[lookup[key]] = fp
+
+    names = sorted(names)
+    index.save(params, names, [songs[n] for n in names], [stamps[n] for n in names], [fingerprints[n] for n in names])
+
+    return FingerprintIndex(library)
+
+def bit_error_rate(a, b):
+    return np.unpackbits(np.bitwise_xor(a, b).view(np.uint8)).mean()
+
+def find_matches(indexes, max_bucket=32, min_votes=2, min_overlap=16, max_ber=0.35):
+    # near duplicate patches across and within libraries. every valid fingerprint frame gives a few hash keys;
+    # patches of different songs that share keys vote for a frame offset between them, and the best offsets are
+    # verified by the bit error rate over the overlap. returns (library a, patch a, library b, patch b, offset, ber)
+    patches = [(l, i) for l, index in enumerate(indexes) for i in range(len(index))]
+    song_ids = {}
+    song_of = np.array([song_ids.setdefault((l, indexes[l].songs[i]), len(song_ids)) for l, i in patches], dtype=np.int64)
+
+    values, owners, frames = [], [], []
+    for p, (l, i) in enumerate(patches):
+        v, m = indexes[l].get(i)
+        f = np.nonzero(m)[0]
+
+        for k, shift in enumerate(SUBKEY_SHIFTS):
+            values.append((k << SUBKEY_BITS) | ((v[f] >> shift) & ((1 << SUBKEY_BITS) - 1)))
+            owners.append(np.full(len(f), p, dtype=np.int64))
+            frames.append(f)
+
+    if len(values) == 0:
+        return []
+
+    values, owners, frames = np.concatenate(values), np.concatenate(owners), np.concatenate(frames)
+    order = np.argsort(values, kind='stable')
+    values, owners, frames = values[order], owners[order], frames[order]
+
+    # keys shared by too many frames (sustained tones, digital silence that slipped through) carry no information
+    _, counts = np.unique(values, return_counts=True)
+    small = np.repeat(counts <= max_bucket, counts)
+
+    pairs = []
+    for d in range(1, max_bucket):
+        a = np.nonzero((values[:-d] == values[d:]) & small[:-d])[0]
+
+        if len(a) == 0:
+            break
+
+        b = a + d
+        other = song_of[owners[a]] != song_of[owners[b]]
+        a, b = a[other], b[other]
+        swap = owners[a] > owners[b]
+        a, b = np.where(swap, b, a), np.where(swap, a, b)
+        pairs.append(np.stack((owners[a], owners[b], frames[b] - frames[a]), axis=1))
+
+    if len(pairs) == 0:
+        return []
+
+    candidates, votes = np.unique(np.concatenate(pairs), axis=0, return_counts=True)
+
+    matches, seen = [], set()
+    for (pa, pb, offset), v in sorted(zip(candidates[votes >= min_votes].tolist(), votes[votes >= min_votes].tolist()), key=lambda x: -x[1]):
+        if (pa, pb) in seen:
+            continue
+
+        (la, ia), (lb, ib) = patches[pa], patches[pb]
+        va, _ = indexes[la].get(ia)
+        vb, _ = indexes[lb].get(ib)
+
+        # frame f of a lines up with frame f + offset of b
+        start, stop = max(0, -offset), min(len(va), len(vb) - offset)
+
+        if stop - start < min_overlap:
+            continue
+
+        ber = bit_error_rate(va[start:stop], vb[start + offset:stop + offset])
+
+        if ber <= max_ber:
+            seen.add((pa, pb))
+            matches.append((la, ia, lb, ib, offset, float(ber)))
+
+    return matches
+
+def song_duplicates(indexes, matches, min_fraction=0.5):
+    # groups patch matches by song pair; a pair is reported when enough of the smaller song's patches matched
+    lengths = {}
+    for l, index in enumerate(indexes):
+        for s in index.songs:
+            lengths[(l, s)] = lengths.get((l, s), 0) + 1
+
+    grouped = {}
+    for la, ia, lb, ib, offset, ber in matches:
+        key = ((la, indexes[la].songs[ia]), (lb, indexes[lb].songs[ib]))
+        patches_a, patches_b, bers = grouped.setdefault(key, (set(), set(), []))
+        patches_a.add(ia)
+        patches_b.add(ib)
+        bers.append(ber)
+
+    duplicates = []
+    for (a, b), (patches_a, patches_b, bers) in grouped.items():
+        fraction = max(len(patches_a) / lengths[a], len(patches_b) / lengths[b])
+
+        if fraction >= min_fraction:
+            duplicates.append((a, b, fraction, float(np.mean(bers))))
+
+    return sorted(duplicates, key=lambda d: (-d[2], d[3]))
@@ -0,0 +1,385 @@
+import os
+import numpy as np
+
+from libft2gan.patch_codecs import decode, encode, storage
+
+INDEX_NAME = 'index.npz'
+ALIGNMENT = 4096
+MAX_DIMS = 4
+
+def is_shard_library(path):
+    return os.path.isfile(os.path.join(path, INDEX_NAME))
+
+def _align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+class PatchShardWriter(object):
+    # append-only writer for a patch library: array data goes into shard_NNNNN.bin files of up to shard_size bytes and
+    # everything else (patch names, source songs, scalar values like c/cr/ci, array offsets/shapes/dtypes) into index.npz,
+    # which is written on close. opening an existing library appends new shards without touching the old ones.
+    # with time_major the last (frame or sample) axis of each array is stored first, so a crop is one contiguous range.
+    # arrays can be stored through a codec from patch_codecs; with measure the writer keeps per-key byte counts and
+    # signal/error energy in self.stats for reporting compression ratio and SNR
+    def __init__(self, path, shard_size=2 ** 32, time_major=False, measure=False):
+        os.makedirs(path, exist_ok=True)
+
+        self.path = path
+        self.shard_size = shard_size
+        self.time_major = time_major
+        self.measure = measure
+        self.stats = {}
+        self.names, self.songs, self.shards = [], [], []
+        self.scalars = {}
+        self.entries = []
+
+        if is_shard_library(path):
+            reader = PatchShardReader(path)
+            self.names = list(reader.names)
+            self.songs = list(reader.songs)
+            self.shards = list(reader.shards)
+            self.scalars = { k: list(v) for k, v in reader.scalars.items() }
+            self.entries = [tuple(e) for e in zip(reader.entry_patch, reader.entry_key, reader.entry_shard, reader.entry_offset, reader.entry_dtype, reader.entry_ndim, reader.entry_shape, reader.entry_time_major, reader.entry_codec, reader.entry_params)]
+
+        self.file = None
+        self.offset = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _next_shard(self):
+        if self.file is not None:
+            self.file.close()
+
+        name = f'shard_{len(self.shards):05d}.bin'
+        self.shards.append(name)
+        self.file = open(os.path.join(self.path, name), 'wb')
+        self.offset = 0
+
+    def add(self, name, song, arrays, codecs={}):
+        patch = len(self.names)
+        self.names.append(name)
+        self.songs.append(song)
+
+        for key, value in arrays.items():
+            value = np.asarray(value)
+
+            if value.ndim == 0:
+                if key not in self.scalars:
+                    self.scalars[key] = [np.nan] * patch
+
+                self.scalars[key].append(value.item())
+                continue
+
+            if value.ndim > MAX_DIMS:
+                raise ValueError(f'{name}/{key}: arrays with more than {MAX_DIMS} dimensions are not supported')
+
+            codec = codecs.get(key, 'raw')
+            time_major = self.time_major and value.ndim > 1
+            stored, params = encode(codec, np.moveaxis(value, -1, 0) if time_major else value)
+            stored = np.ascontiguousarray(stored)
+
+            if self.measure:
+                stats = self.stats.setdefault(key, { 'codec': codec, 'raw_bytes': 0, 'stored_bytes': 0, 'signal': 0., 'noise': 0. })
+                decoded = decode(codec, stored, params, value.dtype)
+                reference = np.moveaxis(value, -1, 0) if time_major else value
+                stats['raw_bytes'] += value.nbytes
+                stats['stored_bytes'] += stored.nbytes
+                stats['signal'] += float(np.sum(np.abs(reference) ** 2))
+                stats['noise'] += float(np.sum(np.abs(reference - decoded) ** 2))
+
+            if self.file is None or (self.offset > 0 and self.offset + stored.nbytes > self.shard_size):
+                self._next_shard()
+
+            self.file.seek(self.offset)
+            self.file.write(stored.tobytes())
+
+            shape = tuple(value.shape) + (0,) * (MAX_DIMS - value.ndim)
+            self.entries.append((patch, key, len(self.shards) - 1, self.offset, value.dtype.str, value.ndim, shape, time_major, codec, params))
+            self.offset = _align(self.offset + stored.nbytes)
+
+        for values in self.scalars.values():
+            if len(values) < len(self.names):
+                values.append(np.nan)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+        columns = {
+            'names': np.array(self.names, dtype=str),
+            'songs': np.array(self.songs, dtype=str),
+            'shards': np.array(self.shards, dtype=str),
+            'entry_patch': np.array([e[0] for e in self.entries], dtype=np.int64),
+            'entry_key': np.array([e[1] for e in self.entries], dtype=str),
+            'entry_shard': np.array([e[2] for e in self.entries], dtype=np.int32),
+            'entry_offset': np.array([e[3] for e in self.entries], dtype=np.int64),
+            'entry_dtype': np.array([e[4] for e in self.entries], dtype=str),
+            'entry_ndim': np.array([e[5] for e in self.entries], dtype=np.int8),
+            'entry_shape': np.array([e[6] for e in self.entries], dtype=np.int64).reshape(-1, MAX_DIMS),
+            'entry_time_major': np.array([e[7] for e in self.entries], dtype=bool),
+            'entry_codec': np.array([e[8] for e in self.entries], dtype=str),
+            'entry_params': np.array([e[9] for e in self.entries], dtype=np.float64).reshape(-1, 2),
+        }
+
+        for key, values in self.scalars.items():
+            columns[f'scalar_{key}'] = np.array(values, dtype=np.float64)
+
+        # written next to the old index and renamed so readers never see a partial one
+        tmp = os.path.join(self.path, f'{INDEX_NAME}.tmp.npz')
+        np.savez(tmp, **columns)
+        os.replace(tmp, os.path.join(self.path, INDEX_NAME))
+
+    def report(self):
+        for key, stats in self.stats.items():
+            ratio = stats['raw_bytes'] / max(stats['stored_bytes'], 1)
+            quality = float('inf') if stats['noise'] == 0 else 10 * np.log10(stats['signal'] / stats['noise'])
+            print(f'  {key}: {stats["codec"]}, {stats["raw_bytes"] / 2 ** 20:.1f} MiB -> {stats["stored_bytes"] / 2 ** 20:.1f} MiB ({ratio:.2f}x), SNR {quality:.1f} dB')
+
+class ShardPatch(object):
+    # the subset of NpzFile that the datasets use: .files, [key] and `in`
+    def __init__(self, reader, patch):
+        self.reader = reader
+        self.patch = patch
+        self.entries = reader.patch_entries(patch)
+        self.files = list(self.entries.keys()) + [k for k, v in reader.scalars.items() if not np.isnan(v[patch])]
+
+    def __contains__(self, key):
+        return key in self.files
+
+    def __getitem__(self, key):
+        if key in self.entries:
+            return self.reader.read_entry(self.entries[key])
+
+        if key in self.files:
+            return np.array(self.reader.scalars[key][self.patch])
+
+        raise KeyError(f'{key} is not a file in the archive')
+
+    def shape(self, key):
+        return self.reader.entry_info(self.entries[key])[1]
+
+    def crop(self, key, start, stop):
+        return self.reader.read_crop(self.entries[key], start, stop)
+
+class PatchShardReader(object):
+    # loads the whole index up front; whole arrays are read with one seek + readinto and crops through a read-only
+    # memory map of the shard, so only the pages under the cropped frames are touched. file handles and maps are opened
+    # lazily per process so a reader can be handed to dataloader workers
+    def __init__(self, path):
+        self.path = path
+
+        index = np.load(os.path.join(path, INDEX_NAME))
+        self.names = index['names']
+        self.songs = index['songs']
+        self.shards = index['shards']
+        self.entry_patch = index['entry_patch']
+        self.entry_key = index['entry_key']
+        self.entry_shard = index['entry_shard']
+        self.entry_offset = index['entry_offset']
+        self.entry_dtype = index['entry_dtype']
+        self.entry_ndim = index['entry_ndim']
+        self.entry_shape = index['entry_shape']
+        self.entry_time_major = index['entry_time_major'] if 'entry_time_major' in index.files else np.zeros(len(self.entry_patch), dtype=bool)
+        self.entry_codec = index['entry_codec'] if 'entry_codec' in index.files else np.full(len(self.entry_patch), 'raw')
+        self.entry_params = index['entry_params'] if 'entry_params' in index.files else np.zeros((len(self.entry_patch), 2))
+        self.scalars = { k[len('scalar_'):]: index[k] for k in index.files if k.startswith('scalar_') }
+
+        # entries are written patch by patch, so each patch owns a contiguous slice
+        self.entry_start = np.searchsorted(self.entry_patch, np.arange(len(self.names) + 1))
+
+        self.files = {}
+        self.maps = {}
+        self.pid = None
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['files'] = {}
+        state['maps'] = {}
+        state['pid'] = None
+        return state
+
+    def _file(self, shard):
+        if self.pid != os.getpid():
+            self.files = {}
+            self.maps = {}
+            self.pid = os.getpid()
+
+        if shard not in self.files:
+            self.files[shard] = open(os.path.join(self.path, self.shards[shard]), 'rb', buffering=0)
+
+        return self.files[shard]
+
+    def _map(self, shard):
+        self._file(shard)
+
+        if shard not in self.maps:
+            self.maps[shard] = np.memmap(os.path.join(self.path, self.shards[shard]), dtype=np.uint8, mode='r')
+
+        return self.maps[shard]
+
+    def _storage(self, entry):
+        dtype, shape = self.entry_info(entry)
+        shape = (shape[-1],) + shape[:-1] if self.entry_time_major[entry] else shape
+
+        return storage(self.entry_codec[entry], dtype, shape)
+
+    def _decode(self, entry, S):
+        dtype, _ = self.entry_info(entry)
+        return decode(self.entry_codec[entry], S, self.entry_params[entry], dtype)
+
+    def patch_entries(self, patch):
+        return { str(self.entry_key[e]): e for e in range(self.entry_start[patch], self.entry_start[patch + 1]) }
+
+    def entry_info(self, entry):
+        return np.dtype(self.entry_dtype[entry]), tuple(self.entry_shape[entry, :self.entry_ndim[entry]])
+
+    def read_entry(self, entry):
+        dtype, shape = self._storage(entry)
+        S = np.empty(shape, dtype=dtype)
+
+        f = self._file(self.entry_shard[entry])
+        f.seek(self.entry_offset[entry])
+        n = f.readinto(memoryview(S.reshape(-1)).cast('B'))
+
+        # a truncated shard would otherwise leave the end of the uninitialized buffer in the patch
+        if n != S.nbytes:
+            raise ValueError(f'{self.shards[self.entry_shard[entry]]}: {self.names[self.entry_patch[entry]]}/{self.entry_key[entry]} is truncated, read {n} of {S.nbytes} bytes')
+
+        X = self._decode(entry, S)
+
+        if self.entry_time_major[entry]:
+            X = np.ascontiguousarray(np.moveaxis(X, 0, -1))
+
+        return X
+
+    def read_crop(self, entry, start, stop):
+        # equivalent to read_entry(entry)[..., start:stop], always returned as a writable copy
+        dtype, shape = self._storage(entry)
+        offset = self.entry_offset[entry]
+        nbytes = int(np.prod(shape)) * dtype.itemsize
+        S = self._map(self.entry_shard[entry])[offset:offset + nbytes].view(dtype).reshape(shape)
+
+        if self.entry_time_major[entry]:
+            X = self._decode(entry, S[start:stop])
+            return np.array(np.moveaxis(X, 0, -1), order='C')
+
+        # codecs that store complex values as pairs keep the pair on a trailing axis after the frame axis
+        pair = len(shape) - self.entry_ndim[entry]
+        S = np.array(S[(Ellipsis, slice(start, stop)) + (slice(None),) * pair])
+
+        return self._decode(entry, S)
+
+    def read(self, patch, key):
+        return self.load(patch)[key]
+
+    def load(self, patch):
+        return ShardPatch(self, patch)
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+
+        self.files = {}
+        self.maps = {}
+
+def list_patches(path):
+    # a library directory is either a shard library or a directory of npz patches; entries are paths for the latter
+    # and (reader, index) pairs for the former
+    if is_shard_library(path):
+        reader = PatchShardReader(path)
+        return [(reader, i) for i in range(len(reader))]
+
+    return [os.path.join(path, f) for f in os.listdir(path) if f.endswith('.npz') and os.path.isfile(os.path.join(path, f))]
+
+def patch_name(patch):
+    if isinstance(patch, tuple):
+        reader, i = patch
+        return f'{reader.names[i]}.npz'
+
+    return os.path.basename(patch)
+
+def song_name(name):
+    # patches are written as {basename}_p{j}.npz by lib/dataset.py
+    return name.rsplit('_p', 1)[0] if '_p' in name else name
+
+def patch_song(patch):
+    if isinstance(patch, tuple):
+        reader, i = patch
+        return str(reader.songs[i])
+
+    return song_name(os.path.splitext(os.path.basename(patch))[0])
+
+def patch_library(patch):
+    if isinstance(patch, tuple):
+        return patch[0].path
+
+    return os.path.dirname(patch)
+
+def load_patch(patch):
+    if isinstance(patch, tuple):
+        reader, i = patch
+        return reader.load(i)
+
+    return np.load(patch, allow_pickle=True)
+
+def library_entries(library):
+    # (name, key, song, stamp) for every patch of a library, used by the sidecar indexes to find new or changed
+    # patches. key is what open_patch takes: the entry index for shard libraries and the patch name for npz
+    # directories. npz patches are replaced in place when the dataset builder reruns so their mtime is the stamp;
+    # shard entries never change once written
+    if is_shard_library(library):
+        reader = PatchShardReader(library)
+        return [(str(n), i, str(s), 0.) for i, (n, s) in enumerate(zip(reader.names, reader.songs))]
+
+    entries = []
+    for path in list_patches(library):
+        name = os.path.splitext(os.path.basename(path))[0]
+        entries.append((name, name, song_name(name), os.path.getmtime(path)))
+
+    return entries
+
+_readers = {}
+
+def open_patch(library, key):
+    # loads a patch from a library by library_entries key, keeping one reader per shard library in each process
+    if is_shard_library(library):
+        reader = _readers.get(library)
+
+        if reader is None:
+            reader = PatchShardReader(library)
+            _readers[library] = reader
+
+        return reader.load(key)
+
+    return np.load(os.path.join(library, f'{key}.npz'), allow_pickle=True)
+
+def array_shape(data, key):
+    # shape of one array of a loaded patch without reading it; npz members only have their npy header parsed
+    if isinstance(data, ShardPatch):
+        return data.shape(key)
+
+    with data.zip.open(f'{key}.npy') as f:
+        version = np.lib.format.read_magic(f)
+        read_header = np.lib.format.read_array_header_1_0 if version == (1, 0) else np.lib.format.read_array_header_2_0
+        shape, _, _ = read_header(f)
+
+    return shape
+
+def load_crop(data, key, crop_range):
+    # data[key][..., start:stop] with (start, stop) = crop_range(length of the last axis). for shard patches only the
+    # cropped frames are read; npz patches are still loaded whole
+    if isinstance(data, ShardPatch):
+        start, stop = crop_range(data.shape(key)[-1])
+        return data.crop(key, start, stop)
+
+    X = data[key]
+    start, stop = crop_range(X.shape[-1])
+
+    return X[..., start:stop]
@@ -0,0 +1,171 @@
+import multiprocessing
+import os
+import numpy as np
+
+from tqdm import tqdm
+
+from libft2gan.patch_shards import library_entries, open_patch, patch_library, patch_name, patch_song
+
+# per patch and per song statistics for a library, kept as one sidecar file next to the patches (or the shard index)
+# instead of being written into every npz. datasets load it once at startup. the name deliberately does not end in
+# .npz so that loaders listing a directory for patches skip it
+STATS_NAME = 'stats.index'
+COLUMNS = ['coef', 'cr', 'ci', 'rms', 'activity', 'frames', 'duration']
+
+def stats_path(library):
+    return os.path.join(library, STATS_NAME)
+
+def patch_statistics(task):
+    # activity is the fraction of frames whose mean level relative to the song coefficient is over vocal_threshold,
+    # which for vocal stems is the fraction of the patch with vocals
+    library, patch, hop_length, sr, vocal_threshold = task
+    data = open_patch(library, patch)
+
+    if 'X' in data.files:
+        X = data['X']
+        M = np.abs(X)
+        coef = float(data['c']) if 'c' in data.files else float(M.max())
+        cr, ci = float(np.abs(X.real).max()), float(np.abs(X.imag).max())
+        rms = float(np.sqrt(np.mean(M ** 2)))
+        level = M.mean(axis=(0, 1))
+        frames = X.shape[-1]
+        duration = frames * hop_length / sr
+    else:
+        W = data['XW'][:2]
+        coef = float(data['c']) if 'c' in data.files else float(np.abs(W).max())
+        cr, ci = np.nan, np.nan
+        rms = float(np.sqrt(np.mean(W ** 2)))
+        frames = W.shape[-1] // hop_length
+        level = np.abs(W[:, :frames * hop_length]).reshape((W.shape[0], frames, hop_length)).mean(axis=(0, 2))
+        duration = W.shape[-1] / sr
+
+    activity = float(np.mean(level / coef > vocal_threshold)) if coef > 0 and frames > 0 else 0.
+
+    return patch, [coef, cr, ci, rms, activity, frames, duration]
+
+def song_statistics(rows):
+    # coef and the maxima are taken over the song; rms and activity are frame weighted
+    rows = np.array(rows, dtype=np.float64)
+    coef, cr, ci, rms, activity, frames, duration = rows.T
+    total = frames.sum()
+
+    return [
+        coef.max(), np.max(cr), np.max(ci),
+        np.sqrt(np.sum(rms ** 2 * frames) / total) if total > 0 else 0.,
+        np.sum(activity * frames) / total if total > 0 else 0.,
+        total, duration.sum()
+    ]
+
+class PatchStats(object):
+    def __init__(self, library):
+        self.library = library
+        self.params = None
+        self.names, self.stamps, self.rows = [], [], np.zeros((0, len(COLUMNS)))
+        self.songs, self.song_rows = [], np.zeros((0, len(COLUMNS)))
+
+        if os.path.exists(stats_path(library)):
+            with np.load(stats_path(library)) as stats:
+                self.params = stats['params'].tolist()
+                self.names = stats['names'].tolist()
+                self.stamps = stats['stamps'].tolist()
+                self.rows = stats['rows']
+                self.songs = stats['songs'].tolist()
+                self.song_rows = stats['song_rows']
+
+        self.lookup = { n: i for i, n in enumerate(self.names) }
+        self.song_lookup = { s: i for i, s in enumerate(self.songs) }
+
+    def __contains__(self, name):
+        return name in self.lookup
+
+    def patch(self, name):
+        return dict(zip(COLUMNS, self.rows[self.lookup[name]]))
+
+    def song(self, song):
+        return dict(zip(COLUMNS, self.song_rows[self.song_lookup[song]]))
+
+    def save(self, params, names, stamps, rows, songs, song_rows):
+        tmp = stats_path(self.library) + '.tmp'
+
+        with open(tmp, 'wb') as f:
+            np.savez(
+                f, params=np.array(params), names=np.array(names, dtype=str), stamps=np.array(stamps), rows=np.array(rows).reshape((-1, len(COLUMNS))),
+                songs=np.array(songs, dtype=str), song_rows=np.array(song_rows).reshape((-1, len(COLUMNS))))
+
+        os.replace(tmp, stats_path(self.library))
+
+def update_stats(library, hop_length=1024, sr=44100, vocal_threshold=0.001, num_workers=None):
+    # only patches that are new or were rewritten since the last update are read; removed patches are dropped
+    stats = PatchStats(library)
+    params = [hop_length, sr, vocal_threshold]
+    reuse = stats.params == params
+
+    entries = library_entries(library)
+    names = [n for n, _, _, _ in entries]
+    keys = { n: k for n, k, _, _ in entries }
+    songs = { n: s for n, _, s, _ in entries }
+    stamps = { n: t for n, _, _, t in entries }
+
+    rows = {}
+    if reuse:
+        for n in names:
+            i = stats.lookup.get(n)
+
+            if i is not None and stats.stamps[i] == stamps[n]:
+                rows[n] = stats.rows[i].tolist()
+
+    tasks = [(library, keys[n], hop_length, sr, vocal_threshold) for n in names if n not in rows]
+    print(f'{library}: {len(tasks)} patches to scan, {len(rows)} up to date')
+
+    if len(tasks) > 0:
+        lookup = { keys[n]: n for n in names }
+
+        with multiprocessing.Pool(num_workers if num_workers is not None else os.cpu_count()) as pool:
+            for patch, row in tqdm(pool.imap_unordered(patch_statistics, tasks, chunksize=16), total=len(tasks)):
+                rows[lookup[patch]] = row
+
+    names = sorted(names)
+    grouped = {}
+    for n in names:
+        grouped.setdefault(songs[n], []).append(rows[n])
+
+    song_names = sorted(grouped.keys())
+    stats.save(params, names, [stamps[n] for n in names], [rows[n] for n in names], song_names, [song_statistics(grouped[s]) for s in song_names])
+
+    return PatchStats(library)
+
+class LibraryStats(object):
+    # statistics for the patches of several libraries, looked up with the entries returned by list_patches
+    def __init__(self, libraries):
+        self.libraries = {}
+
+        for library in libraries:
+            stats = PatchStats(library)
+
+            if stats.params is not None:
+                self.libraries[os.path.normpath(library)] = stats
+
+    def _stats(self, patch):
+        return self.libraries.get(os.path.normpath(patch_library(patch)))
+
+    def patch(self, patch):
+        stats = self._stats(patch)
+        name = os.path.splitext(patch_name(patch))[0]
+
+        return stats.patch(name) if stats is not None and name in stats else None
+
+    def song(self, patch):
+        stats = self._stats(patch)
+        song = patch_song(patch)
+
+        return stats.song(song) if stats is not None and song in stats.song_lookup else None
+
+    def song_scale(self, patch, data):
+        # (cr, ci) maxima over the patch's song; libraries rewritten by the old update-dataset.py store them in
+        # every patch instead
+        song = self.song(patch)
+
+        if song is None:
+            return data['cr'], data['ci']
+
+        return song['cr'], song['ci']
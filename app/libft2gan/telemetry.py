@@ -0,0 +1,150 @@
+import json
+import sys
+import time
+import numpy as np
+import torch
+
+def peak_rss_mb():
+    # peak resident memory of this process, or None where neither resource (unix) nor psutil is available.
+    # ru_maxrss is kilobytes on linux and bytes on macos; psutil only reports a peak on windows
+    try:
+        import resource
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return rss / 1024 ** 2 if sys.platform == 'darwin' else rss / 1024
+    except ImportError:
+        pass
+
+    try:
+        import psutil
+        info = psutil.Process().memory_info()
+        return getattr(info, 'peak_wset', info.rss) / 1024 ** 2
+    except ImportError:
+        return None
+
+class TrainingTelemetry(object):
+    # per-iteration timing of the training loop written as JSONL; each phase is the wall time since the previous mark,
+    # so 'data' is how long the loop waited on the dataloader. cuda is synchronized at every mark when sync is set,
+    # otherwise asynchronous kernels are attributed to whichever phase next blocks
+    phases = ['data', 'h2d', 'preprocess', 'forward', 'backward', 'optimizer']
+
+    def __init__(self, path, device, use_wandb=False, sync=True, profile_steps=None, trace_path='trace.json', epoch=0):
+        self.file = open(path, 'a') if path is not None else None
+        self.device = device
+        self.cuda = device.type == 'cuda'
+        self.use_wandb = use_wandb
+        self.sync = sync and self.cuda
+        self.profile_steps = profile_steps
+        self.trace_path = trace_path
+        self.profiler = None
+        self.epoch = epoch - 1
+        self.records = []
+        self.last = None
+        self.current = None
+
+    def _now(self):
+        if self.sync:
+            torch.cuda.synchronize(self.device)
+
+        return time.perf_counter()
+
+    def _write(self, record):
+        if self.file is not None:
+            self.file.write(json.dumps(record) + '\n')
+            self.file.flush()
+
+    def start_epoch(self):
+        self.epoch = self.epoch + 1
+        self.records = []
+        self.last = self._now()
+        self.current = {}
+
+        if self.cuda:
+            torch.cuda.reset_peak_memory_stats(self.device)
+
+    def mark(self, phase):
+        now = self._now()
+        self.current[phase] = self.current.get(phase, 0) + now - self.last
+        self.last = now
+
+    def end_step(self, step, samples, frames):
+        record = { 'type': 'step', 'epoch': self.epoch, 'step': step }
+        record.update({ p: self.current.get(p, 0) for p in self.phases })
+        total = sum(record[p] for p in self.phases)
+
+        record['total'] = total
+        record['samples'] = samples
+        record['frames'] = frames
+        record['samples_per_sec'] = samples / total if total > 0 else 0
+        record['frames_per_sec'] = frames / total if total > 0 else 0
+        record['peak_rss_mb'] = peak_rss_mb()
+
+        if self.cuda:
+            record['peak_cuda_mb'] = torch.cuda.max_memory_allocated(self.device) / 2 ** 20
+
+        self.records.append(record)
+        self._write(record)
+        self.current = {}
+
+    def profile(self, step):
+        if self.profile_steps is None:
+            return
+
+        start, stop = self.profile_steps
+        if self.profiler is None and start <= step < stop:
+            activities = [torch.profiler.ProfilerActivity.CPU] + ([torch.profiler.ProfilerActivity.CUDA] if self.cuda else [])
+            self.profiler = torch.profiler.profile(activities=activities, record_shapes=True, profile_memory=True)
+            self.profiler.start()
+        elif self.profiler is not None and step >= stop:
+            self.stop_profiler()
+        else:
+            return
+
+        # starting or stopping the profiler is not part of the step
+        self.last = self._now()
+
+    def stop_profiler(self):
+        if self.profiler is not None:
+            self.profiler.stop()
+            self.profiler.export_chrome_trace(self.trace_path)
+            print(f'wrote profiler trace for steps {self.profile_steps[0]}:{self.profile_steps[1]} to {self.trace_path}')
+            self.profiler = None
+            self.profile_steps = None
+
+    def end_epoch(self):
+        if len(self.records) == 0:
+            return None
+
+        summary = { 'type': 'epoch', 'epoch': self.epoch, 'steps': len(self.records) }
+        for key in self.phases + ['total']:
+            values = np.array([r[key] for r in self.records])
+            summary[f'{key}_mean'] = float(values.mean())
+            summary[f'{key}_p95'] = float(np.percentile(values, 95))
+
+        total = sum(r['total'] for r in self.records)
+        summary['data_wait_fraction'] = sum(r['data'] for r in self.records) / total
+        summary['samples_per_sec'] = sum(r['samples'] for r in self.records) / total
+        summary['frames_per_sec'] = sum(r['frames'] for r in self.records) / total
+        summary['peak_rss_mb'] = max((r['peak_rss_mb'] for r in self.records if r['peak_rss_mb'] is not None), default=None)
+
+        if self.cuda:
+            summary['peak_cuda_mb'] = max(r['peak_cuda_mb'] for r in self.records)
+
+        self._write(summary)
+
+        if self.use_wandb:
+            import wandb
+            wandb.log({ f'telemetry/{k}': v for k, v in summary.items() if k != 'type' and v is not None })
+
+        print(
+            f'  * {summary["samples_per_sec"]:.2f} samples/s, {summary["frames_per_sec"]:.0f} frames/s, '
+            f'data wait {summary["data_wait_fraction"] * 100:.1f}%, '
+            + ', '.join(f'{p} {summary[f"{p}_mean"] * 1000:.1f}ms' for p in self.phases)
+        )
+
+        return summary
+
+    def close(self):
+        self.stop_profiler()
+
+        if self.file is not None:
+            self.file.close()
@@ -0,0 +1,65 @@
+import torch
+import torch.distributed
+
+def shard_indices(length, rank, world_size):
+    return range(rank, length, world_size)
+
+def spectrogram_inputs(XW, YW, c, to_spec):
+    c = c.unsqueeze(-1).unsqueeze(-1).unsqueeze(-1)
+    YS = torch.abs(to_spec(YW))[:, :, :-1]
+    XC = to_spec(XW)[:, :, :-1]
+    XS = torch.abs(XC)
+    XP = (torch.angle(XC) + torch.pi) / (2 * torch.pi)
+
+    return torch.cat((XS / c, XP), dim=1), YS / c
+
+class ValidationCache(object):
+    # fixed validation crops kept as model inputs and targets so an epoch of validation is only forward passes.
+    # storage is 'device' or 'cpu' (pinned when cuda is available); batch_size shrinks on the first OOM and stays there
+    def __init__(self, dataloader, device, to_spec, storage='device', batch_size=8):
+        self.device = device
+        self.batch_size = batch_size
+
+        X, Y = [], []
+        with torch.no_grad():
+            for XW, YW, c in dataloader:
+                XB, YB = spectrogram_inputs(XW.to(device), YW.to(device), c.to(device), to_spec)
+                X.append(XB if storage == 'device' else XB.cpu())
+                Y.append(YB if storage == 'device' else YB.cpu())
+
+        self.X = torch.cat(X, dim=0)
+        self.Y = torch.cat(Y, dim=0)
+
+        if storage != 'device' and torch.cuda.is_available():
+            self.X = self.X.pin_memory()
+            self.Y = self.Y.pin_memory()
+
+    def __len__(self):
+        return self.X.shape[0]
+
+    def run(self, fn):
+        i = 0
+        while i < len(self):
+            b = self.batch_size
+
+            # the copy to the device can run out of memory too
+            try:
+                fn(self.X[i:i+b].to(self.device, non_blocking=True), self.Y[i:i+b].to(self.device, non_blocking=True))
+            except torch.cuda.OutOfMemoryError:
+                if b == 1:
+                    raise
+
+                self.batch_size = b // 2
+                print(f'validation batch size {b} does not fit; retrying with {self.batch_size}')
+                torch.cuda.empty_cache()
+                continue
+
+            i = i + b
+
+def all_reduce_sum(values, device, distributed):
+    totals = torch.stack([torch.as_tensor(v, dtype=torch.float64, device=device) for v in values])
+
+    if distributed:
+        torch.distributed.all_reduce(totals)
+
+    return totals.tolist()
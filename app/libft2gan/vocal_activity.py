@@ -0,0 +1,139 @@
+import multiprocessing
+import os
+import numpy as np
+
+from tqdm import tqdm
+
+from libft2gan.patch_shards import library_entries, open_patch, patch_library, patch_name
+
+# per frame, per band vocal levels of every vocal patch: the band means of |V| / c that VoxAugDataset thresholds into
+# its VP targets. levels are stored once per library as a flat [frames, channels, bands] float16 array that every
+# dataloader worker memory maps, with the patch offsets in a small index next to it
+ACTIVITY_NAME = 'activity.index'
+LEVELS_NAME = 'activity.levels'
+
+def band_levels(X, c, vout_bands):
+    # the VP computation of VoxAugDataset before its threshold, as [frames, channels, bands]
+    M = np.abs(X[:, :-1, :]) / c if c > 0 else np.zeros((X.shape[0], X.shape[1] - 1, X.shape[2]))
+    levels = M.reshape((M.shape[0], vout_bands, M.shape[1] // vout_bands, M.shape[2])).mean(axis=2)
+
+    return levels.transpose(2, 0, 1).astype(np.float16)
+
+def _patch_levels(task):
+    library, key, vout_bands = task
+    data = open_patch(library, key)
+
+    return key, band_levels(data['X'], float(data['c']), vout_bands)
+
+class VocalActivityIndex(object):
+    def __init__(self, library):
+        self.library = library
+        self.params = None
+        self.names, self.stamps = [], []
+        self.offsets = np.zeros(1, dtype=np.int64)
+        self.levels = None
+
+        if os.path.exists(os.path.join(library, ACTIVITY_NAME)):
+            with np.load(os.path.join(library, ACTIVITY_NAME)) as index:
+                self.params = index['params'].tolist()
+                self.names = index['names'].tolist()
+                self.stamps = index['stamps'].tolist()
+                self.offsets = index['offsets']
+
+            self.levels = np.load(os.path.join(library, LEVELS_NAME), mmap_mode='r')
+
+        self.lookup = { n: i for i, n in enumerate(self.names) }
+
+    def __contains__(self, name):
+        return name in self.lookup
+
+    def get(self, name):
+        i = self.lookup[name]
+        return self.levels[self.offsets[i]:self.offsets[i + 1]]
+
+    def save(self, params, names, stamps, levels):
+        # the levels are written before the index so a reader never sees offsets past the end of the array
+        offsets = np.cumsum([0] + [len(l) for l in levels])
+        tmp = os.path.join(self.library, LEVELS_NAME + '.tmp')
+
+        with open(tmp, 'wb') as f:
+            np.save(f, np.concatenate(levels) if len(levels) > 0 else np.zeros((0, 0, 0), dtype=np.float16))
+
+        os.replace(tmp, os.path.join(self.library, LEVELS_NAME))
+        tmp = os.path.join(self.library, ACTIVITY_NAME + '.tmp')
+
+        with open(tmp, 'wb') as f:
+            np.savez(f, params=np.array(params), names=np.array(names, dtype=str), stamps=np.array(stamps), offsets=offsets)
+
+        os.replace(tmp, os.path.join(self.library, ACTIVITY_NAME))
+
+def update_activity(library, vout_bands=4, num_workers=None):
+    index = VocalActivityIndex(library)
+    params = [vout_bands]
+    reuse = index.params == params
+
+    entries = library_entries(library)
+    names = [n for n, _, _, _ in entries]
+    keys = { n: k for n, k, _, _ in entries }
+    stamps = { n: t for n, _, _, t in entries }
+
+    levels = {}
+    if reuse:
+        for n in names:
+            i = index.lookup.get(n)
+
+            if i is not None and index.stamps[i] == stamps[n]:
+                levels[n] = np.array(index.get(n))
+
+    tasks = [(library, keys[n], vout_bands) for n in names if n not in levels]
+    print(f'{library}: {len(tasks)} vocal patches to index, {len(levels)} up to date')
+
+    if len(tasks) > 0:
+        lookup = { keys[n]: n for n in names }
+
+        with multiprocessing.Pool(num_workers if num_workers is not None else os.cpu_count()) as pool:
+            for key, l in tqdm(pool.imap_unordered(_patch_levels, tasks, chunksize=16), total=len(tasks)):
+                levels[lookup[key]] = l
+
+    # the old memory map has to be released before its file is replaced on windows
+    index.levels = None
+    names = sorted(names)
+    index.save(params, names, [stamps[n] for n in names], [levels[n] for n in names])
+
+    return VocalActivityIndex(library)
+
+class VocalActivity(object):
+    # vocal levels for the patches of several libraries, looked up with the entries returned by list_patches.
+    # libraries without an index (or indexed with other vout_bands) are simply absent
+    def __init__(self, libraries, vout_bands=4):
+        self.libraries = {}
+
+        for library in libraries:
+            index = VocalActivityIndex(library)
+
+            if index.params == [vout_bands]:
+                self.libraries[os.path.normpath(library)] = index
+
+    def levels(self, patch):
+        index = self.libraries.get(os.path.normpath(patch_library(patch)))
+        name = os.path.splitext(patch_name(patch))[0]
+
+        return index.get(name) if index is not None and name in index else None
+
+    def vp(self, patch, start, stop, threshold):
+        # the [channels, bands, frames] VP target of a crop, or None when the patch is not indexed
+        levels = self.levels(patch)
+
+        if levels is None:
+            return None
+
+        return (levels[start:stop] > threshold).transpose(1, 2, 0).astype(np.float32)
+
+    def density(self, patch, start, stop, threshold):
+        # fraction of the crop's frames where any channel and band is over the threshold
+        levels = self.levels(patch)
+
+        if levels is None:
+            return None
+
+        return float((levels[start:stop] > threshold).any(axis=(1, 2)).mean()) if stop > start else 0.
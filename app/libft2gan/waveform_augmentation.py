@@ -0,0 +1,227 @@
+import math
+import random
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from libft2gan.dataset_utils import apply_pitch_shift_batch
+
+def normalize_waveform_batch(W, W2=None):
+    peak = torch.amax(torch.abs(W), dim=(1, 2), keepdim=True)
+
+    if W2 is not None:
+        peak = torch.maximum(peak, torch.amax(torch.abs(W2), dim=(1, 2), keepdim=True))
+
+    return W / torch.clamp(peak, min=1)
+
+def mix_vocals(YW, VW):
+    XW = normalize_waveform_batch(YW) + normalize_waveform_batch(VW)
+    XW = normalize_waveform_batch(XW, YW)
+    YW = normalize_waveform_batch(YW, XW)
+
+    return XW, YW
+
+# biquad coefficients are [B, 6] as (b0, b1, b2, a0, a1, a2), one filter per batch item
+def _first_order(cutoff, sample_rate, highpass):
+    k = torch.tan(torch.pi * cutoff / sample_rate)
+    zero, one = torch.zeros_like(k), torch.ones_like(k)
+
+    if highpass:
+        b = [one / (1 + k), -one / (1 + k), zero]
+    else:
+        b = [k / (1 + k), k / (1 + k), zero]
+
+    return torch.stack(b + [one, (k - 1) / (k + 1), zero], dim=1)
+
+def highpass_coefficients(cutoff, sample_rate):
+    return _first_order(cutoff, sample_rate, highpass=True)
+
+def lowpass_coefficients(cutoff, sample_rate):
+    return _first_order(cutoff, sample_rate, highpass=False)
+
+def peak_coefficients(cutoff, gain_db, q, sample_rate):
+    A = 10 ** (gain_db / 40)
+    w0 = 2 * torch.pi * cutoff / sample_rate
+    alpha = torch.sin(w0) / (2 * q)
+    cos = torch.cos(w0)
+
+    return torch.stack([1 + alpha * A, -2 * cos, 1 - alpha * A, 1 + alpha / A, -2 * cos, 1 - alpha / A], dim=1)
+
+def low_shelf_coefficients(cutoff, gain_db, q, sample_rate):
+    A = 10 ** (gain_db / 40)
+    w0 = 2 * torch.pi * cutoff / sample_rate
+    alpha = torch.sin(w0) / (2 * q)
+    cos = torch.cos(w0)
+    sq = 2 * torch.sqrt(A) * alpha
+
+    return torch.stack([
+        A * ((A + 1) - (A - 1) * cos + sq),
+        2 * A * ((A - 1) - (A + 1) * cos),
+        A * ((A + 1) - (A - 1) * cos - sq),
+        (A + 1) + (A - 1) * cos + sq,
+        -2 * ((A - 1) + (A + 1) * cos),
+        (A + 1) + (A - 1) * cos - sq
+    ], dim=1)
+
+def high_shelf_coefficients(cutoff, gain_db, q, sample_rate):
+    A = 10 ** (gain_db / 40)
+    w0 = 2 * torch.pi * cutoff / sample_rate
+    alpha = torch.sin(w0) / (2 * q)
+    cos = torch.cos(w0)
+    sq = 2 * torch.sqrt(A) * alpha
+
+    return torch.stack([
+        A * ((A + 1) + (A - 1) * cos + sq),
+        -2 * A * ((A - 1) + (A + 1) * cos),
+        A * ((A + 1) + (A - 1) * cos - sq),
+        (A + 1) - (A - 1) * cos + sq,
+        2 * ((A - 1) - (A + 1) * cos),
+        (A + 1) - (A - 1) * cos - sq
+    ], dim=1)
+
+def biquad_response(coefficients, n_fft):
+    w = torch.linspace(0, torch.pi, n_fft // 2 + 1, device=coefficients.device, dtype=coefficients.dtype)
+    z1 = torch.exp(-1.j * w).unsqueeze(0)
+    z2 = z1 * z1
+    c = coefficients.to(z1.dtype).unsqueeze(-1)
+
+    return (c[:, 0] + c[:, 1] * z1 + c[:, 2] * z2) / (c[:, 3] + c[:, 4] * z1 + c[:, 5] * z2)
+
+def apply_frequency_response(W, response, n_fft):
+    X = torch.fft.rfft(W, n=n_fft)
+    return torch.fft.irfft(X * response.unsqueeze(1), n=n_fft)[..., :W.shape[-1]]
+
+def _envelope_gain(W, sample_rate, gain_computer, attack_ms, release_ms, block_size, attack_on_decrease=True):
+    b, _, n = W.shape
+    num_blocks = math.ceil(n / block_size)
+
+    level = torch.amax(torch.abs(W), dim=1)
+    level = F.pad(level, (0, num_blocks * block_size - n)).reshape(b, num_blocks, block_size)
+    level_db = 20 * torch.log10(torch.clamp(torch.amax(level, dim=2), min=1e-8))
+    target_db = gain_computer(level_db)
+
+    attack = torch.exp(-block_size / (attack_ms * 1e-3 * sample_rate))
+    release = torch.exp(-block_size / (release_ms * 1e-3 * sample_rate))
+
+    g = torch.zeros(b, device=W.device, dtype=W.dtype)
+    gains = []
+    for i in range(num_blocks):
+        t = target_db[:, i]
+        coef = torch.where((t < g) if attack_on_decrease else (t > g), attack, release)
+        g = coef * g + (1 - coef) * t
+        gains.append(g)
+
+    gains = torch.stack(gains, dim=1).unsqueeze(1)
+    gains = F.interpolate(gains, size=num_blocks * block_size, mode='linear', align_corners=False)[:, :, :n]
+
+    return W * (10 ** (gains / 20))
+
+def compress(W, sample_rate, threshold_db, ratio, attack_ms, release_ms, block_size=256):
+    def gain_computer(level_db):
+        over = torch.clamp(level_db - threshold_db.unsqueeze(1), min=0)
+        return over * (1 / ratio.unsqueeze(1) - 1)
+
+    return _envelope_gain(W, sample_rate, gain_computer, attack_ms, release_ms, block_size)
+
+def limit(W, sample_rate, threshold_db, release_ms, block_size=256):
+    def gain_computer(level_db):
+        return -torch.clamp(level_db - threshold_db.unsqueeze(1), min=0)
+
+    return _envelope_gain(W, sample_rate, gain_computer, torch.ones_like(release_ms), release_ms, block_size)
+
+def noise_gate(W, sample_rate, threshold_db, ratio, attack_ms, release_ms, block_size=256):
+    def gain_computer(level_db):
+        under = torch.clamp(threshold_db.unsqueeze(1) - level_db, min=0)
+        return torch.clamp(-under * (ratio.unsqueeze(1) - 1), min=-100)
+
+    return _envelope_gain(W, sample_rate, gain_computer, attack_ms, release_ms, block_size, attack_on_decrease=False)
+
+def distort(W, drive_db):
+    return torch.tanh(W * (10 ** (drive_db / 20))[:, None, None])
+
+def pitch_shift(W, semitones, n_fft=2048, hop_length=512):
+    b, c, n = W.shape
+    window = torch.hann_window(n_fft, device=W.device)
+    X = torch.stft(W.reshape(b * c, n), n_fft, hop_length=hop_length, window=window, return_complex=True)
+    X = X.reshape(b, c, X.shape[1], X.shape[2])
+    M, P = apply_pitch_shift_batch(torch.abs(X), torch.angle(X), semitones)
+    X = torch.polar(M, P).reshape(b * c, X.shape[2], X.shape[3])
+
+    return torch.istft(X, n_fft, hop_length=hop_length, window=window, length=n).reshape(b, c, n)
+
+class WaveformAugmentation(nn.Module):
+    # augmentations are (p, name, { param: (low, high) }) the same way the datasets list their per-item augmentations;
+    # parameters are drawn per batch item and every linear filter is folded into one frequency response
+    filters = {
+        'highpass': lambda p, sr: highpass_coefficients(torch.clamp(p['cutoff_frequency_hz'], min=1), sr),
+        'lowpass': lambda p, sr: lowpass_coefficients(p['cutoff_frequency_hz'], sr),
+        'peak': lambda p, sr: peak_coefficients(p['cutoff_frequency_hz'], p['gain_db'], p['q'], sr),
+        'low_shelf': lambda p, sr: low_shelf_coefficients(torch.clamp(p['cutoff_frequency_hz'], min=1), p['gain_db'], p['q'], sr),
+        'high_shelf': lambda p, sr: high_shelf_coefficients(p['cutoff_frequency_hz'], p['gain_db'], p['q'], sr),
+    }
+
+    def __init__(self, augmentations, sample_rate=44100, block_size=256, normalize=True):
+        super().__init__()
+
+        self.augmentations = augmentations
+        self.sample_rate = sample_rate
+        self.block_size = block_size
+        self.normalize = normalize
+
+    def _sample(self, ranges, b, device):
+        return { k: torch.empty(b, device=device).uniform_(lo, hi) for k, (lo, hi) in ranges.items() }
+
+    def _apply_filters(self, W, filters):
+        n_fft = 2 ** math.ceil(math.log2(2 * W.shape[-1]))
+        response = None
+
+        for p, name, ranges in filters:
+            params = self._sample(ranges, W.shape[0], W.device)
+            enabled = torch.rand(W.shape[0], device=W.device) < p
+            r = biquad_response(self.filters[name](params, self.sample_rate), n_fft)
+            r = torch.where(enabled.unsqueeze(1), r, torch.ones_like(r))
+            response = r if response is None else response * r
+
+        return apply_frequency_response(W, response, n_fft)
+
+    def _apply(self, W, name, params):
+        if name == 'compressor':
+            return compress(W, self.sample_rate, params['threshold_db'], params['ratio'], params['attack_ms'], params['release_ms'], self.block_size)
+        elif name == 'limiter':
+            return limit(W, self.sample_rate, params['threshold_db'], params['release_ms'], self.block_size)
+        elif name == 'noise_gate':
+            return noise_gate(W, self.sample_rate, params['threshold_db'], params['ratio'], params['attack_ms'], params['release_ms'], self.block_size)
+        elif name == 'distortion':
+            return distort(W, params['drive_db'])
+        elif name == 'pitch_shift':
+            return pitch_shift(W, params['semitones'])
+
+        raise ValueError(f'unknown waveform augmentation: {name}')
+
+    def forward(self, W):
+        filters = [a for a in self.augmentations if a[1] in self.filters and a[0] > 0]
+        stages = [a for a in self.augmentations if a[1] not in self.filters and a[0] > 0]
+
+        # linear filters commute, so they run as one stage placed randomly among the nonlinear ones
+        if len(filters) > 0:
+            stages.append((1, 'filters', filters))
+
+        random.shuffle(stages)
+
+        for p, name, ranges in stages:
+            if name == 'filters':
+                W = self._apply_filters(W, ranges)
+            else:
+                # only the items that drew this stage are processed
+                idx = torch.nonzero(torch.rand(W.shape[0], device=W.device) < p).squeeze(1)
+
+                if idx.shape[0] == 0:
+                    continue
+
+                W = W.clone()
+                W[idx] = self._apply(W[idx], name, self._sample(ranges, idx.shape[0], W.device))
+
+            if self.normalize:
+                W = normalize_waveform_batch(W)
+
+        return W
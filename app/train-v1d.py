@@ -159,6 +159,7 @@ def main():
     p.add_argument('--instrumental_lib', type=str, default="/home/ben/cs2048_sr44100_hl1024_nf2048_of0|/media/ben/internal-nvme-b/cs2048_sr44100_hl1024_nf2048_of0")
     p.add_argument('--vocal_lib', type=str, default="/home/ben/cs2048_sr44100_hl1024_nf2048_of0_VOCALS")
     p.add_argument('--validation_lib', type=str, default="/media/ben/internal-nvme-b/cs2048_sr44100_hl1024_nf2048_of0_VALIDATION")
+    p.add_argument('--min_vocal_activity', type=float, default=None, help='needs the activity index from update-dataset.py --vocal_activity true')
 
     p.add_argument('--curr_step', type=int, default=0)
     p.add_argument('--curr_epoch', type=int, default=0)
@@ -234,7 +235,8 @@ def main():
         vocal_lib=args.vocal_lib,
         is_validation=False,
         n_fft=args.n_fft,
-        hop_length=args.hop_length
+        hop_length=args.hop_length,
+        min_vocal_activity=args.min_vocal_activity
     )
 
     train_sampler = torch.utils.data.DistributedSampler(train_dataset) if args.distributed else None
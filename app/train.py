@@ -1,5 +1,6 @@
 import argparse
 import logging
+import math
 import os
 import random
 import numpy as np
@@ -11,7 +12,12 @@ import torch.distributed
 from tqdm import tqdm
 import wandb
 
-from libft2gan.dataset_voxaug_new import VoxAugDataset
+from libft2gan.dataset_voxaug_new import VoxAugDataset, BATCH_VOCAL_AUGMENTATIONS, BATCH_INSTRUMENT_AUGMENTATIONS
+from libft2gan.waveform_augmentation import WaveformAugmentation, mix_vocals
+from libft2gan.telemetry import TrainingTelemetry
+from libft2gan.crop_stream import CropStream
+from libft2gan.device_sampler import DeviceBalancedSampler, DeviceIOStats
+from libft2gan.validation_cache import ValidationCache, shard_indices, spectrogram_inputs, all_reduce_sum
 from libft2gan.frame_transformer4 import FrameTransformerGenerator
 from libft2gan.lr_scheduler_linear_warmup import LinearWarmupScheduler
 from libft2gan.lr_scheduler_polynomial_decay import PolynomialDecayScheduler
@@ -36,7 +42,7 @@ def apply_mixup(X, Y, c, alpha=1.0):
 
     return XM, YM, c
 
-def train_epoch(dataloader, model, device, optimizer, accumulation_steps, progress_bar, lr_warmup=None, grad_scaler=None, step=0, max_bin=0, use_wandb=False, predict_mask=True, predict_phase=False, quantizer_levels=128):
+def train_epoch(dataloader, model, device, optimizer, accumulation_steps, progress_bar, lr_warmup=None, grad_scaler=None, step=0, max_bin=0, use_wandb=False, predict_mask=True, predict_phase=False, quantizer_levels=128, instrument_augmentation=None, vocal_augmentation=None, telemetry=None):
     model.train()
 
     batch_loss = 0
@@ -49,13 +55,27 @@ def train_epoch(dataloader, model, device, optimizer, accumulation_steps, progre
     to_spec = T.Spectrogram(n_fft=2048, hop_length=1024, power=None, return_complex=True).to(device)
     to_mel = MelScale(n_filters=128, sample_rate=44100, n_stft=1024).to(device)
 
+    if telemetry is not None:
+        telemetry.start_epoch()
+
     pbar = tqdm(dataloader) if progress_bar else dataloader
     for itr, (XW, YW, c) in enumerate(pbar):
+        if telemetry is not None:
+            telemetry.mark('data')
+            telemetry.profile(step)
+
         XW = XW.to(device)
         YW = YW.to(device)
         c = c.to(device).unsqueeze(-1)
 
+        if telemetry is not None:
+            telemetry.mark('h2d')
+
         with torch.no_grad():
+            if vocal_augmentation is not None:
+                # batch_augment datasets yield unmixed instruments and vocals
+                XW, YW = mix_vocals(instrument_augmentation(XW), vocal_augmentation(YW))
+
             XW, YW, c = apply_mixup(XW, YW, c)
             XC = to_spec(XW)[:, :, :-1]
             YC = to_spec(YW)[:, :, :-1]
@@ -67,6 +87,9 @@ def train_epoch(dataloader, model, device, optimizer, accumulation_steps, progre
             c = torch.max(torch.cat((c, csrc, ctgt), dim=1), dim=1, keepdim=True).values.unsqueeze(-1).unsqueeze(-1)
             YS = YS / c
             XS = XS / c
+
+        if telemetry is not None:
+            telemetry.mark('preprocess')
         
         with torch.cuda.amp.autocast_mode.autocast(enabled=grad_scaler is not None):
             pred = torch.sigmoid(model(torch.cat((XS, XP), dim=1)))
@@ -84,11 +107,17 @@ def train_epoch(dataloader, model, device, optimizer, accumulation_steps, progre
             print('nan training loss; aborting')
             quit()
 
+        if telemetry is not None:
+            telemetry.mark('forward')
+
         if grad_scaler is not None:
             grad_scaler.scale(accum_loss).backward()
         else:
             accum_loss.backward()
 
+        if telemetry is not None:
+            telemetry.mark('backward')
+
         if (itr + 1) % accumulation_steps == 0:
             if progress_bar:                
                 pbar.set_description(f'{step}: mag={batch_loss / accumulation_steps}')
@@ -111,51 +140,53 @@ def train_epoch(dataloader, model, device, optimizer, accumulation_steps, progre
             sum_loss = sum_loss + batch_loss
             batch_loss = 0
 
+        if telemetry is not None:
+            telemetry.mark('optimizer')
+            telemetry.end_step(step, samples=XS.shape[0], frames=XS.shape[0] * XS.shape[-1])
+
+    if telemetry is not None:
+        telemetry.end_epoch()
+
     return sum_loss / batches, step
 
-def validate_epoch(dataloader, model, device, max_bin=0, use_wandb=False, predict_mask=True, predict_phase=False, quantizer_levels=128):
+def validate_epoch(dataloader, model, device, max_bin=0, use_wandb=False, predict_mask=True, predict_phase=False, quantizer_levels=128, cache=None, distributed=False):
     model.eval()
-    crit = nn.L1Loss()
 
-    sum_spec = 0
-    sum_wave = 0
-
-    batches = 0
+    sum_wave = torch.zeros(1, device=device)
+    items = 0
 
     model.zero_grad()
     torch.cuda.empty_cache()
     to_spec = T.Spectrogram(n_fft=2048, hop_length=1024, power=None, return_complex=True).to(device)
 
+    def validate_batch(X, YS):
+        nonlocal sum_wave, items
+
+        with torch.cuda.amp.autocast_mode.autocast():
+            pred = torch.sigmoid(model(X))
+
+        # wave_loss = F.cross_entropy(PQ.reshape(-1, 256), YQ.long().reshape(-1))
+        mag_loss = F.l1_loss(X[:, :YS.shape[1]] * pred, YS)
+        # wave_loss = mag_loss #F.l1_loss(PW, YW)
+
+        sum_wave = sum_wave + mag_loss.detach() * X.shape[0]
+        items = items + X.shape[0]
+
     with torch.no_grad():
-        for itr, (XW, YW, c) in enumerate(dataloader):
-            XW = XW.to(device)
-            YW = YW.to(device)
-            c = c.to(device).unsqueeze(-1).unsqueeze(-1).unsqueeze(-1)
-            YS = torch.abs(to_spec(YW))[:, :, :-1]
-            XC = to_spec(XW)[:, :, :-1]
-            XS = torch.abs(XC)
-            XP = (torch.angle(XC) + torch.pi) / (2 * torch.pi)
-            
-            XS = XS / c
-            YS = YS / c
-            
-            with torch.cuda.amp.autocast_mode.autocast():
-                pred = torch.sigmoid(model(torch.cat((XS, XP), dim=1)))
+        if cache is not None:
+            cache.run(validate_batch)
+        else:
+            for itr, (XW, YW, c) in enumerate(dataloader):
+                validate_batch(*spectrogram_inputs(XW.to(device), YW.to(device), c.to(device), to_spec))
 
-            # wave_loss = F.cross_entropy(PQ.reshape(-1, 256), YQ.long().reshape(-1))
-            mag_loss = F.l1_loss(XS * pred, YS)
-            # wave_loss = mag_loss #F.l1_loss(PW, YW)
-            
-            loss = mag_loss
+    sum_wave, items = all_reduce_sum([sum_wave[0], items], device, distributed)
+    loss = sum_wave / items
 
-            if torch.logical_or(loss.isnan(), loss.isinf()):
-                print('nan validation loss; aborting')
-                quit()
-            else:
-                sum_wave += mag_loss.item()
-                batches += 1
+    if math.isnan(loss) or math.isinf(loss):
+        print('nan validation loss; aborting')
+        quit()
 
-    return sum_wave / batches
+    return loss
 
 def main():
     p = argparse.ArgumentParser()
@@ -208,6 +239,17 @@ def main():
     p.add_argument('--accumulation_steps', '-A', type=str, default='4,8')
     p.add_argument('--gpu', '-g', type=int, default=-1)
     p.add_argument('--optimizer', type=str.lower, choices=['adam', 'adamw', 'sgd', 'radam', 'rmsprop'], default='adam')
+    p.add_argument('--batch_augment', type=str, default='false')
+    p.add_argument('--validation_cache', type=str.lower, choices=['none', 'cpu', 'device'], default='none')
+    p.add_argument('--validation_batch_size', type=int, default=1)
+    p.add_argument('--initial_validation', type=str, default='false')
+    p.add_argument('--telemetry', type=str, default=None)
+    p.add_argument('--telemetry_sync', type=str, default='true')
+    p.add_argument('--profile_steps', type=str, default=None)
+    p.add_argument('--profile_trace', type=str, default='trace.json')
+    p.add_argument('--io_sampler', type=str.lower, choices=['none', 'balanced', 'weighted'], default='none', help='interleave reads across the drives the libraries live on')
+    p.add_argument('--crops_per_patch', type=int, default=1, help='training items cut from each patch read; above 1 the patches are streamed through libft2gan.crop_stream')
+    p.add_argument('--shuffle_buffer', type=int, default=64)
     p.add_argument('--prefetch_factor', type=int, default=4)
     p.add_argument('--num_workers', '-w', type=int, default=8)
     p.add_argument('--epoch', '-E', type=int, default=40)
@@ -234,6 +276,10 @@ def main():
     args.predict_phase = str.lower(args.predict_phase) == 'true'
     args.predict_mask = str.lower(args.predict_mask) == 'true'
     args.wandb = str.lower(args.wandb) == 'true'
+    args.batch_augment = str.lower(args.batch_augment) == 'true'
+    args.initial_validation = str.lower(args.initial_validation) == 'true'
+    args.telemetry_sync = str.lower(args.telemetry_sync) == 'true'
+    args.profile_steps = [int(s) for s in args.profile_steps.split(':')] if args.profile_steps is not None else None
 
     args.model_dir = os.path.join(args.model_dir, "")
 
@@ -255,11 +301,19 @@ def main():
         is_validation=False,
         n_fft=args.n_fft,
         hop_length=args.hop_length,
-        predict_phase=args.predict_phase
+        predict_phase=args.predict_phase,
+        batch_augment=args.batch_augment
     )
 
     train_sampler = torch.utils.data.DistributedSampler(train_dataset) if args.distributed else None
 
+    if args.io_sampler != 'none':
+        train_dataset.io_stats = DeviceIOStats(train_dataset.curr_list)
+        train_sampler = DeviceBalancedSampler(train_dataset.curr_list, train_dataset.io_stats, weighted=args.io_sampler == 'weighted', seed=args.seed)
+        print(f'io sampler over {len(train_dataset.io_stats)} devices: {", ".join(train_dataset.io_stats.device_names)}')
+
+    train_stream = CropStream(train_dataset, crops_per_patch=args.crops_per_patch, shuffle_buffer=args.shuffle_buffer, sampler=train_sampler, seed=args.seed) if args.crops_per_patch > 1 else None
+
     val_dataset = VoxAugDataset(
         instrumental_lib=[args.validation_lib],
         vocal_lib=None,
@@ -267,13 +321,6 @@ def main():
         predict_phase=args.predict_phase
     )
 
-    val_dataloader = torch.utils.data.DataLoader(
-        dataset=val_dataset,
-        batch_size=1,
-        shuffle=False,
-        num_workers=args.num_workers
-    )
-    
     random.seed(args.seed)
     np.random.seed(args.seed)
     torch.manual_seed(args.seed)
@@ -286,6 +333,11 @@ def main():
         device = torch.device('cuda:{}'.format(args.gpu))
         generator.to(device)
 
+    instrument_augmentation, vocal_augmentation = None, None
+    if args.batch_augment:
+        instrument_augmentation = WaveformAugmentation(BATCH_INSTRUMENT_AUGMENTATIONS, sample_rate=args.sr).to(device)
+        vocal_augmentation = WaveformAugmentation(BATCH_VOCAL_AUGMENTATIONS, sample_rate=args.sr).to(device)
+
     if args.distributed:
         generator = nn.parallel.DistributedDataParallel(generator, device_ids=[args.gpu])
 
@@ -314,15 +366,30 @@ def main():
         PolynomialDecayScheduler(optimizer_gen, target=args.lr_scheduler_decay_target, power=args.lr_scheduler_decay_power, num_decay_steps=args.decay_steps, start_step=args.warmup_steps, current_step=step, verbose_skip_steps=args.lr_verbosity)
     ])
 
+    telemetry = None
+    if args.telemetry is not None or args.profile_steps is not None:
+        suffix = f'.rank{torch.distributed.get_rank()}' if args.distributed else ''
+        telemetry_path = f'{args.telemetry}{suffix}' if args.telemetry is not None else None
+        telemetry = TrainingTelemetry(telemetry_path, device, use_wandb=args.wandb, sync=args.telemetry_sync, profile_steps=args.profile_steps, trace_path=f'{args.profile_trace}{suffix}', epoch=epoch)
+
     val_dataset.cropsize = 2048
+    if args.distributed:
+        val_dataset = torch.utils.data.Subset(val_dataset, shard_indices(len(val_dataset), torch.distributed.get_rank(), torch.distributed.get_world_size()))
+
     val_dataloader = torch.utils.data.DataLoader(
         dataset=val_dataset,
-        batch_size=1,
+        batch_size=args.validation_batch_size if args.validation_cache == 'none' else 1,
         shuffle=False,
         num_workers=args.num_workers
     )
 
-    wave = validate_epoch(val_dataloader, generator, device, max_bin=args.n_fft // 2, predict_mask=args.predict_mask, predict_phase=args.predict_phase)
+    val_cache = None
+    if args.validation_cache != 'none':
+        val_cache = ValidationCache(val_dataloader, device, T.Spectrogram(n_fft=2048, hop_length=1024, power=None, return_complex=True).to(device), storage=args.validation_cache, batch_size=args.validation_batch_size)
+        print(f'cached {len(val_cache)} validation items on {args.validation_cache}')
+
+    if args.initial_validation:
+        wave = validate_epoch(val_dataloader, generator, device, max_bin=args.n_fft // 2, predict_mask=args.predict_mask, predict_phase=args.predict_phase, cache=val_cache, distributed=args.distributed)
 
     best_loss = float('inf')
     while step < args.stages[-1]:
@@ -341,10 +408,10 @@ def main():
 
             train_dataset.cropsize = cropsize
             train_dataloader = torch.utils.data.DataLoader(
-                dataset=train_dataset,
+                dataset=train_stream if train_stream is not None else train_dataset,
                 batch_size=batch_size,
-                shuffle=False if args.distributed else True,
-                sampler=train_sampler if args.distributed else None,
+                shuffle=train_sampler is None and train_stream is None,
+                sampler=train_sampler if train_stream is None else None,
                 num_workers=args.num_workers,
                 prefetch_factor=args.prefetch_factor,
                 pin_memory=True
@@ -352,13 +419,16 @@ def main():
 
         print('# epoch {}'.format(epoch))
         train_dataloader.dataset.set_epoch(epoch)
-        train_loss_mag, step = train_epoch(train_dataloader, generator, device, optimizer=optimizer_gen, accumulation_steps=accum_steps, progress_bar=args.progress_bar, lr_warmup=scheduler_gen, grad_scaler=grad_scaler_gen, step=step, max_bin=args.n_fft // 2, use_wandb=args.wandb, predict_mask=args.predict_mask, predict_phase=args.predict_phase)
-        wave = validate_epoch(val_dataloader, generator, device, max_bin=args.n_fft // 2, predict_mask=args.predict_mask, predict_phase=args.predict_phase)
+        train_loss_mag, step = train_epoch(train_dataloader, generator, device, optimizer=optimizer_gen, accumulation_steps=accum_steps, progress_bar=args.progress_bar, lr_warmup=scheduler_gen, grad_scaler=grad_scaler_gen, step=step, max_bin=args.n_fft // 2, use_wandb=args.wandb, predict_mask=args.predict_mask, predict_phase=args.predict_phase, instrument_augmentation=instrument_augmentation, vocal_augmentation=vocal_augmentation, telemetry=telemetry)
+        wave = validate_epoch(val_dataloader, generator, device, max_bin=args.n_fft // 2, predict_mask=args.predict_mask, predict_phase=args.predict_phase, cache=val_cache, distributed=args.distributed)
 
         print(
             '  * training loss = {:.6f}, validation loss = {:6f}'
             .format(train_loss_mag, wave)
         )
+
+        if train_dataset.io_stats is not None:
+            print(f'  * reads: {train_dataset.io_stats.summary()}')
         
         if wave < best_loss:
             best_loss = wave
@@ -369,6 +439,9 @@ def main():
             torch.save(generator.state_dict(), f'{model_path}.stg1.{"phase" if args.predict_phase else "mag"}.pth')
         epoch += 1
 
+    if telemetry is not None:
+        telemetry.close()
+
     if args.distributed:
         torch.distributed.destroy_process_group()
 
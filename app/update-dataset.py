@@ -0,0 +1,29 @@
+import argparse
+
+from libft2gan.patch_stats import update_stats
+from libft2gan.vocal_activity import update_activity
+
+# builds or refreshes the statistics sidecar (stats.index) of each library. this replaces rewriting every patch with
+# its song's cr/ci; datasets read those from the sidecar instead. --vocal_activity true also indexes per frame vocal
+# levels, for vocal libraries
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument('--library', type=str, default='./')
+    p.add_argument('--hop_length', type=int, default=1024)
+    p.add_argument('--sr', type=int, default=44100)
+    p.add_argument('--vocal_threshold', type=float, default=0.001)
+    p.add_argument('--vocal_activity', type=str, default='false')
+    p.add_argument('--vout_bands', type=int, default=4)
+    p.add_argument('--num_workers', type=int, default=None)
+    args = p.parse_args()
+
+    args.vocal_activity = str.lower(args.vocal_activity) == 'true'
+
+    for library in args.library.split('|'):
+        update_stats(library, hop_length=args.hop_length, sr=args.sr, vocal_threshold=args.vocal_threshold, num_workers=args.num_workers)
+
+        if args.vocal_activity:
+            update_activity(library, vout_bands=args.vout_bands, num_workers=args.num_workers)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+import json
+import os
+import time
+import torch
+import torch.distributed
+
+from concurrent.futures import ThreadPoolExecutor
+
+class CheckpointUploader(object):
+    # uploads saved checkpoints on a background thread, one at a time in the order they were saved, so training
+    # carries on while they upload. failed uploads are retried with exponential backoff; wait() blocks until
+    # everything queued is uploaded and returns the names that could not be
+    def __init__(self, storage, retries=5, backoff=2):
+        self.storage = storage
+        self.retries = retries
+        self.backoff = backoff
+        self.executor = ThreadPoolExecutor(1)
+        self.futures = []
+
+    def _upload(self, name, filename):
+        for attempt in range(self.retries + 1):
+            try:
+                start = time.time()
+                self.storage.upload(name, filename)
+                print(f'uploaded {name} in {time.time() - start:.1f}s')
+                return True
+            except Exception as e:
+                print(f'upload of {name} failed ({e}), attempt {attempt + 1} of {self.retries + 1}')
+
+                if attempt < self.retries:
+                    time.sleep(self.backoff ** attempt)
+
+        return False
+
+    def upload(self, name, filename):
+        self.futures.append((name, self.executor.submit(self._upload, name, filename)))
+
+    def wait(self):
+        failed = [name for name, future in self.futures if not future.result()]
+        self.futures = []
+        return failed
+
+def _source(path):
+    # the (size, generation) path was downloaded from, if it is still that size
+    try:
+        with open(f'{path}.source') as f:
+            source = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+    return source if os.path.exists(path) and os.path.getsize(path) == source[0] else None
+
+def fetch_checkpoint(storage, name, path, local_rank, device_ids=None):
+    # downloads a checkpoint to path once per node, by its local rank 0, while the other local ranks wait at a
+    # barrier and then read the same file. a file already at path is only reused when {path}.source records that it
+    # was downloaded from the current (size, generation) of the checkpoint; anything else at path is replaced. when
+    # the checkpoint does not exist in storage, a file at path is used as it is, and None is returned without one
+    if local_rank == 0:
+        stat = storage.stat(name)
+
+        if stat is not None and _source(path) != list(stat):
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            storage.download(name, f'{path}.tmp')
+            os.replace(f'{path}.tmp', path)
+
+            with open(f'{path}.source', 'w') as f:
+                json.dump(list(stat), f)
+
+    if torch.distributed.is_available() and torch.distributed.is_initialized():
+        torch.distributed.barrier(device_ids=device_ids)
+
+    return path if os.path.exists(path) else None
@@ -4,30 +4,22 @@ import torch
 import torch.utils.data
 
 from io import BytesIO
-from google.cloud import storage
-
-client = storage.Client()
-bucket = client.bucket('your-bucket-name')
+from lib.storage import open_storage
 
 class VocalRemoverCloudDataset(torch.utils.data.Dataset):
-    def __init__(self, dataset, vocal_dataset, num_training_items=None, force_voxaug=True, is_validation=False, mixup_alpha=1, mixup_rate=0.5):
+    # storage is a url for lib.storage.open_storage (gs://bucket, or a local directory standing in for one) or an
+    # already opened storage; dataset and vocal_dataset are name prefixes within it. dataset can be None when the
+    # patches are streamed from shards instead (lib.shards.ShardStream), which only calls process
+    def __init__(self, dataset, vocal_dataset, storage, cache_dir=None, cache_size=None, num_training_items=None, force_voxaug=True, is_validation=False, mixup_alpha=1, mixup_rate=0.5):
+        self.storage = open_storage(storage, cache_dir=cache_dir, cache_size=cache_size) if isinstance(storage, str) else storage
         self.num_training_items = num_training_items
         self.force_voxaug = force_voxaug
         self.is_validation = is_validation
         self.mixup_alpha = mixup_alpha
         self.mixup_rate = mixup_rate
 
-        blobs = list(client.list_blobs(bucket, prefix=dataset))
-
-        patch_list = []
-        for blob in blobs:
-            patch_list.append(blob.name)
-
-        vocal_blobs = list(client.list_blobs(bucket, prefix=vocal_dataset))
-
-        vocal_list = []
-        for blob in vocal_blobs:
-            vocal_list.append(blob.name)
+        patch_list = [name for name in self.storage.list(dataset) if name.endswith('.npz')] if dataset is not None else []
+        vocal_list = [name for name in self.storage.list(vocal_dataset) if name.endswith('.npz')]
 
         self.full_list = patch_list
         self.patch_list = patch_list
@@ -43,13 +35,16 @@ class VocalRemoverCloudDataset(torch.utils.data.Dataset):
     def __len__(self):
         return len(self.patch_list)
 
+    def prefetch(self, indices):
+        self.storage.prefetch([self.patch_list[idx] for idx in indices])
+
+    def _load(self, name):
+        return np.load(BytesIO(self.storage.read(name)))
+
     def __getitem__(self, idx):
-        path = self.patch_list[idx]
-        blob = bucket.get_blob(path)
-        blob_data = blob.download_as_bytes()         
-        resource = BytesIO(blob_data)
-        data = np.load(resource)
+        return self.process(self._load(self.patch_list[idx]))
 
+    def process(self, data):
         aug = 'Y' not in data.files
         X, Xc = data['X'], data['c']
         Y = X if aug else data['Y']
@@ -87,7 +82,7 @@ class VocalRemoverCloudDataset(torch.utils.data.Dataset):
         X = np.abs(X) / c
         Y = np.abs(Y) / c
 
-        if np.random.uniform() < self.mixup_rate:
+        if len(self.patch_list) > 0 and np.random.uniform() < self.mixup_rate:
             MX, MY = self.__getitem__(np.random.randint(len(self.patch_list)))
             a = np.random.beta(self.mixup_alpha, self.mixup_alpha)
             X = X * a + (1 - a) * MX
@@ -97,11 +92,7 @@ class VocalRemoverCloudDataset(torch.utils.data.Dataset):
 
     def _get_vocals(self):
         vidx = np.random.randint(len(self.vocal_list))            
-        vpath = self.vocal_list[vidx]
-        vblob = bucket.get_blob(vpath)
-        vblob_data = vblob.download_as_bytes()
-        vres = BytesIO(vblob_data)
-        vdata = np.load(vres)
+        vdata = self._load(self.vocal_list[vidx])
         V, Vc = vdata['X'], vdata['c']
 
         if np.random.uniform() < 0.5:
@@ -120,11 +111,7 @@ class VocalRemoverCloudDataset(torch.utils.data.Dataset):
 
         if np.random.uniform() < 0.5:
             vidx2 = np.random.randint(len(self.vocal_list))                
-            vpath2 = self.vocal_list[vidx2]
-            vblob2 = bucket.get_blob(vpath2)
-            vblob_data2 = vblob2.download_as_bytes()
-            vres2 = BytesIO(vblob_data2)
-            vdata2 = np.load(vres2)
+            vdata2 = self._load(self.vocal_list[vidx2])
             V2, Vc2 = vdata2['X'], vdata2['c']
 
             if np.random.uniform() < 0.5:
@@ -147,4 +134,30 @@ class VocalRemoverCloudDataset(torch.utils.data.Dataset):
             Vc = (Vc * a) + (Vc2 * inv)
             V = (V * a) + (V2 * inv)
 
-        return V, Vc
\ No newline at end of file
+        return V, Vc
+
+class PrefetchSampler(torch.utils.data.Sampler):
+    # passes the indices of another sampler through while the dataset's storage fetches the patches of the next
+    # lookahead indices into its cache (lib.storage.CachedStorage), ahead of the dataloader workers reading them
+    def __init__(self, sampler, dataset, lookahead=256):
+        self.sampler = sampler
+        self.dataset = dataset
+        self.lookahead = lookahead
+
+    def set_epoch(self, epoch):
+        if hasattr(self.sampler, 'set_epoch'):
+            self.sampler.set_epoch(epoch)
+
+    def __len__(self):
+        return len(self.sampler)
+
+    def __iter__(self):
+        indices = list(self.sampler)
+
+        for i, idx in enumerate(indices):
+            # between one and two windows of indices are always on their way into the cache
+            if i % self.lookahead == 0:
+                start = i + self.lookahead if i > 0 else 0
+                self.dataset.prefetch(indices[start:i + 2 * self.lookahead])
+
+            yield idx
@@ -0,0 +1,186 @@
+import io
+import json
+import math
+import random
+import tarfile
+import numpy as np
+import torch
+import torch.distributed
+import torch.utils.data
+
+# a library of patches as a few large tar files instead of one blob per patch, read sequentially in one request
+# each. every member is one patch saved as {key}.npz (webdataset style, one file per sample), and index.json next to
+# the shards records each shard's item count so nothing has to be listed at startup
+INDEX_NAME = 'index.json'
+
+class ShardWriter(object):
+    def __init__(self, storage, prefix, max_bytes=256 * 1024 ** 2):
+        self.storage = storage
+        self.prefix = prefix if prefix.endswith('/') else prefix + '/'
+        self.max_bytes = max_bytes
+        self.shards = []
+        self.buffer = None
+        self.tar = None
+        self.items = 0
+
+    def _flush(self):
+        if self.tar is not None:
+            self.tar.close()
+            name = f'shard-{len(self.shards):06d}.tar'
+            self.storage.write(self.prefix + name, self.buffer.getvalue())
+            self.shards.append({ 'name': name, 'items': self.items })
+            self.tar = None
+
+    def write(self, key, data):
+        if self.tar is not None and self.buffer.tell() + len(data) > self.max_bytes:
+            self._flush()
+
+        if self.tar is None:
+            self.buffer = io.BytesIO()
+            self.tar = tarfile.open(fileobj=self.buffer, mode='w')
+            self.items = 0
+
+        info = tarfile.TarInfo(f'{key}.npz')
+        info.size = len(data)
+        self.tar.addfile(info, io.BytesIO(data))
+        self.items += 1
+
+    def close(self):
+        # the index goes last, so a library is only usable once all of its shards are written
+        self._flush()
+        self.storage.write(self.prefix + INDEX_NAME, json.dumps({ 'shards': self.shards }, indent=1).encode())
+
+def load_index(storage, prefix):
+    prefix = prefix if prefix.endswith('/') else prefix + '/'
+    return [(prefix + s['name'], s['items']) for s in json.loads(storage.read(prefix + INDEX_NAME))['shards']]
+
+def read_shard(storage, name):
+    with tarfile.open(fileobj=io.BytesIO(storage.read(name)), mode='r') as tar:
+        for member in tar:
+            if member.isfile() and member.name.endswith('.npz'):
+                yield member.name[:-len('.npz')], np.load(io.BytesIO(tar.extractfile(member).read()))
+
+class ShardStream(torch.utils.data.IterableDataset):
+    # streams the patches of a sharded library through dataset.process (lib.dataset.VocalRemoverCloudDataset). each
+    # epoch the shards are permuted by seed and epoch and dealt out to ranks. every rank yields the same number of
+    # items (len(self)) so distributed training never waits on a rank that ran out: a rank with fewer items cycles
+    # through its shards and one with more stops partway, which makes the rank's list of (shard, first, count)
+    # reads. those reads are dealt out to dataloader workers whole, so no two workers read the same items unless the
+    # rank itself had to repeat some. each worker reads its shards one after another while the next one is
+    # prefetched, and items pass through a shuffle buffer.
+    #
+    # set_epoch(epoch, skip, batch_size) resumes an epoch after the rank's dataloader delivered skip items, in
+    # batches of batch_size taken from its workers in turn. each worker works out how many of its own items those
+    # were, does not read the shards they covered again and drops the consumed items of a partly read shard
+    # before they reach the shuffle buffer, so the resumed epoch yields exactly the items that were not read. with
+    # a shuffle buffer, items read but still buffered when training stopped are not replayed
+    def __init__(self, storage, prefix, dataset, shuffle_buffer=256, seed=0, num_replicas=None, rank=None):
+        if num_replicas is None:
+            num_replicas = torch.distributed.get_world_size() if torch.distributed.is_available() and torch.distributed.is_initialized() else 1
+
+        if rank is None:
+            rank = torch.distributed.get_rank() if torch.distributed.is_available() and torch.distributed.is_initialized() else 0
+
+        self.storage = storage
+        self.shards = load_index(storage, prefix)
+        self.dataset = dataset
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+        self.skip = 0
+        self.batch_size = 1
+
+    def set_epoch(self, epoch, skip=0, batch_size=1):
+        self.epoch = epoch
+        self.skip = skip
+        self.batch_size = batch_size
+
+    def __len__(self):
+        return sum(items for _, items in self.shards) // self.num_replicas
+
+    def _rank_reads(self):
+        # (name, first, count) reads covering exactly len(self) items of this rank's shards
+        shards = list(self.shards)
+        random.Random(self.seed + self.epoch).shuffle(shards)
+        shards = [s for s in (shards[self.rank::self.num_replicas] or shards) if s[1] > 0]
+
+        reads, remaining, position = [], len(self), 0
+        while remaining > 0 and len(shards) > 0:
+            name, items = shards[position % len(shards)]
+            reads.append((name, 0, min(items, remaining)))
+            remaining -= reads[-1][2]
+            position += 1
+
+        return reads
+
+    def _skipped(self, quotas, worker):
+        # the dataloader takes one batch from each worker in turn, passing over workers that have run out
+        batches = [math.ceil(q / self.batch_size) for q in quotas]
+        taken = [0] * len(quotas)
+
+        remaining = min(self.skip // self.batch_size, sum(batches))
+        w = 0
+        while remaining > 0:
+            if taken[w] < batches[w]:
+                taken[w] += 1
+                remaining -= 1
+
+            w = (w + 1) % len(quotas)
+
+        return min(taken[worker] * self.batch_size, quotas[worker])
+
+    def __iter__(self):
+        info = torch.utils.data.get_worker_info()
+        worker, num_workers = (info.id, info.num_workers) if info is not None else (0, 1)
+
+        # the dataset augments with np.random, which the dataloader does not reseed in its workers
+        np.random.seed(random.Random(f'{self.seed}-{self.epoch}-{self.rank}-{worker}').getrandbits(32))
+        g = random.Random(f'{self.seed}-{self.epoch}-{self.rank}-{worker}-buffer')
+
+        rank_reads = self._rank_reads()
+        quotas = [sum(count for _, _, count in rank_reads[w::num_workers]) for w in range(num_workers)]
+        skip = self._skipped(quotas, worker)
+
+        # reads wholly consumed before the resume are dropped, and the first remaining one starts after its
+        # consumed items
+        reads = rank_reads[worker::num_workers]
+        while len(reads) > 0 and skip >= reads[0][2]:
+            skip -= reads[0][2]
+            reads = reads[1:]
+
+        if len(reads) == 0:
+            return
+
+        name, first, count = reads[0]
+        reads[0] = (name, first + skip, count - skip)
+
+        def items():
+            for i, (name, first, count) in enumerate(reads):
+                if i + 1 < len(reads):
+                    self.storage.prefetch([reads[i + 1][0]])
+
+                for k, (_, data) in enumerate(read_shard(self.storage, name)):
+                    if k >= first + count:
+                        break
+
+                    if k >= first:
+                        yield self.dataset.process(data)
+
+        buffer = []
+        for item in items():
+            if self.shuffle_buffer <= 0:
+                yield item
+                continue
+
+            if len(buffer) < self.shuffle_buffer:
+                buffer.append(item)
+                continue
+
+            i = g.randrange(len(buffer))
+            yield buffer[i]
+            buffer[i] = item
+
+        g.shuffle(buffer)
+        yield from buffer
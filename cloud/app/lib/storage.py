@@ -0,0 +1,289 @@
+import os
+import shutil
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+class LocalStorage(object):
+    # a directory standing in for a bucket, for tests and single machine runs. names are '/' separated paths under
+    # the root, the same as blob names
+    def __init__(self, root):
+        self.root = root
+
+    def _path(self, name):
+        return os.path.join(self.root, *name.split('/'))
+
+    def list(self, prefix=''):
+        # prefixes match names like blob prefixes do, not only whole directories
+        base = self._path(prefix.rsplit('/', 1)[0]) if '/' in prefix else self.root
+        names = []
+
+        for dirpath, _, filenames in os.walk(base):
+            for filename in filenames:
+                name = os.path.relpath(os.path.join(dirpath, filename), self.root).replace(os.sep, '/')
+
+                if name.startswith(prefix):
+                    names.append(name)
+
+        return sorted(names)
+
+    def read(self, name):
+        with open(self._path(name), 'rb') as f:
+            return f.read()
+
+    def write(self, name, data):
+        path = self._path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        with open(f'{path}.{os.getpid()}.tmp', 'wb') as f:
+            f.write(data)
+
+        os.replace(f'{path}.{os.getpid()}.tmp', path)
+
+    def exists(self, name):
+        return os.path.isfile(self._path(name))
+
+    def stat(self, name):
+        # (size, generation) or None when the name does not exist; the generation changes whenever it is rewritten
+        try:
+            st = os.stat(self._path(name))
+            return st.st_size, st.st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def upload(self, name, filename):
+        path = self._path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        shutil.copyfile(filename, f'{path}.{os.getpid()}.tmp')
+        os.replace(f'{path}.{os.getpid()}.tmp', path)
+
+    def download(self, name, filename):
+        shutil.copyfile(self._path(name), filename)
+
+    def prefetch(self, names):
+        pass
+
+class GCSStorage(object):
+    # a google cloud storage bucket, optionally below a root prefix. the client is created on first use in each
+    # process and kept: it holds the http connections, which are not safe to carry across the fork of a dataloader
+    # worker. files (checkpoints) are uploaded and downloaded in chunks of chunk_size, a multiple of 256 KiB, without
+    # holding them in memory
+    chunk_size = 64 * 1024 * 1024
+
+    def __init__(self, bucket, root=''):
+        self.bucket_name = bucket
+        self.root = root if root == '' or root.endswith('/') else root + '/'
+        self._bucket = None
+        self._pid = None
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['_bucket'] = None
+        state['_pid'] = None
+        return state
+
+    def bucket(self):
+        if self._pid != os.getpid():
+            from google.cloud import storage
+
+            self._bucket = storage.Client().bucket(self.bucket_name)
+            self._pid = os.getpid()
+
+        return self._bucket
+
+    def list(self, prefix=''):
+        bucket = self.bucket()
+        blobs = bucket.client.list_blobs(bucket, prefix=self.root + prefix)
+
+        # folder placeholders are zero byte blobs ending in '/'
+        return sorted(b.name[len(self.root):] for b in blobs if not b.name.endswith('/'))
+
+    def read(self, name):
+        # bucket.blob skips the metadata request that bucket.get_blob makes before every download
+        return self.bucket().blob(self.root + name).download_as_bytes()
+
+    def write(self, name, data):
+        self.bucket().blob(self.root + name).upload_from_string(data)
+
+    def exists(self, name):
+        return self.bucket().blob(self.root + name).exists()
+
+    def stat(self, name):
+        blob = self.bucket().get_blob(self.root + name)
+        return (blob.size, blob.generation) if blob is not None else None
+
+    def upload(self, name, filename):
+        self.bucket().blob(self.root + name, chunk_size=self.chunk_size).upload_from_filename(filename)
+
+    def download(self, name, filename):
+        self.bucket().blob(self.root + name, chunk_size=self.chunk_size).download_to_filename(filename)
+
+    def prefetch(self, names):
+        pass
+
+class CachedStorage(object):
+    # keeps what is read from another storage in a local directory, up to max_bytes, evicting the least recently
+    # used files (by mtime, which every hit refreshes). the directory can be shared by every process on a machine;
+    # files appear atomically, and each process only counts its own writes between rescans, so the budget is
+    # approximate. prefetch fetches names on background threads so later reads find them on disk
+    def __init__(self, storage, cache_dir, max_bytes=None, threads=8):
+        self.storage = storage
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.threads = threads
+        self.size = None
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._executor = None
+        self._pid = None
+
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['_lock'] = None
+        state['_pending'] = {}
+        state['_executor'] = None
+        state['_pid'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _path(self, name):
+        return os.path.join(self.cache_dir, *name.split('/'))
+
+    def list(self, prefix=''):
+        return self.storage.list(prefix)
+
+    def read(self, name):
+        path = self._path(name)
+
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+
+            os.utime(path)
+            return data
+        except FileNotFoundError:
+            pass
+
+        with self._lock:
+            future = self._pending.get(name)
+
+        if future is not None and future.exception() is None:
+            return future.result()
+
+        data = self.storage.read(name)
+        self._store(name, data)
+
+        return data
+
+    def write(self, name, data):
+        self.storage.write(name, data)
+        self._store(name, data)
+
+    def exists(self, name):
+        return self.storage.exists(name)
+
+    def stat(self, name):
+        return self.storage.stat(name)
+
+    # files bypass the cache, they are already local
+    def upload(self, name, filename):
+        self.storage.upload(name, filename)
+
+    def download(self, name, filename):
+        self.storage.download(name, filename)
+
+    def prefetch(self, names):
+        if self._pid != os.getpid():
+            self._executor = ThreadPoolExecutor(self.threads)
+            self._pending = {}
+            self._pid = os.getpid()
+
+        with self._lock:
+            for name in names:
+                if name not in self._pending and not os.path.exists(self._path(name)):
+                    self._pending[name] = self._executor.submit(self._fetch, name)
+
+    def _fetch(self, name):
+        try:
+            data = self.storage.read(name)
+            self._store(name, data)
+            return data
+        finally:
+            with self._lock:
+                self._pending.pop(name, None)
+
+    def _store(self, name, data):
+        # files larger than the whole budget are passed through without being cached
+        if self.max_bytes is not None and len(data) > self.max_bytes:
+            return
+
+        path = self._path(name)
+        tmp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        with open(tmp, 'wb') as f:
+            f.write(data)
+
+        os.replace(tmp, path)
+
+        if self.max_bytes is not None:
+            with self._lock:
+                self.size = (self.size if self.size is not None else self._scan_size()) + len(data)
+
+                if self.size > self.max_bytes:
+                    self._evict(keep=path)
+
+    def _files(self):
+        files = []
+        for dirpath, _, filenames in os.walk(self.cache_dir):
+            for filename in filenames:
+                if not filename.endswith('.tmp'):
+                    try:
+                        stat = os.stat(os.path.join(dirpath, filename))
+                        files.append((stat.st_mtime, stat.st_size, os.path.join(dirpath, filename)))
+                    except FileNotFoundError:
+                        pass
+
+        return files
+
+    def _scan_size(self):
+        return sum(size for _, size, _ in self._files())
+
+    def _evict(self, keep=None):
+        # down to 90% of the budget so the directory is not rescanned on every write. keep, the file just written,
+        # is never evicted even when it alone is over 90% of the budget
+        files = sorted(self._files())
+        total = sum(size for _, size, _ in files)
+
+        for _, size, path in files:
+            if total <= self.max_bytes * 0.9:
+                break
+
+            if keep is not None and os.path.normpath(path) == os.path.normpath(keep):
+                continue
+
+            try:
+                os.remove(path)
+                total -= size
+            except FileNotFoundError:
+                pass
+
+        self.size = total
+
+def open_storage(url, cache_dir=None, cache_size=None, threads=8):
+    # gs://bucket[/root] for google cloud storage, file:///path or a plain path for a local directory
+    if url.startswith('gs://'):
+        bucket, _, root = url[len('gs://'):].partition('/')
+        storage = GCSStorage(bucket, root)
+    else:
+        storage = LocalStorage(url[len('file://'):] if url.startswith('file://') else url)
+
+    if cache_dir is not None:
+        storage = CachedStorage(storage, cache_dir, cache_size, threads)
+
+    return storage
@@ -0,0 +1,41 @@
+import argparse
+import random
+
+from concurrent.futures import ThreadPoolExecutor
+from tqdm import tqdm
+from lib.shards import ShardWriter
+from lib.storage import open_storage
+
+# packs a library of npz patches (e.g. cs2048_sr44100_hl1024_nf2048_of0/) into tar shards for lib.shards.ShardStream.
+# patches are shuffled before packing so each shard mixes many songs
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument('--storage', type=str, default='gs://bc-vocal-remover')
+    p.add_argument('--dest_storage', type=str, default=None)
+    p.add_argument('--source', type=str, default='cs2048_sr44100_hl1024_nf2048_of0/')
+    p.add_argument('--dest', type=str, default='cs2048_sr44100_hl1024_nf2048_of0_SHARDS/')
+    p.add_argument('--shard_size', type=float, default=256, help='megabytes')
+    p.add_argument('--threads', type=int, default=16)
+    p.add_argument('--seed', type=int, default=0)
+    args = p.parse_args()
+
+    source = open_storage(args.storage)
+    dest = open_storage(args.dest_storage) if args.dest_storage is not None else source
+
+    names = [name for name in source.list(args.source) if name.endswith('.npz')]
+    random.Random(args.seed).shuffle(names)
+
+    writer = ShardWriter(dest, args.dest, max_bytes=int(args.shard_size * 1024 ** 2))
+    chunk = args.threads * 4
+
+    with ThreadPoolExecutor(args.threads) as pool, tqdm(total=len(names)) as pbar:
+        for i in range(0, len(names), chunk):
+            for name, data in zip(names[i:i + chunk], pool.map(source.read, names[i:i + chunk])):
+                writer.write(name[len(args.source):-len('.npz')].lstrip('/'), data)
+                pbar.update(1)
+
+    writer.close()
+    print(f'{len(names)} patches in {len(writer.shards)} shards')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,154 @@
+import os
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from lib.checkpoint import CheckpointUploader, fetch_checkpoint
+from lib.storage import LocalStorage
+
+class GatedStorage(LocalStorage):
+    # uploads block until the gate opens, so a test can tell whether upload() waited for them
+    def __init__(self, root):
+        super().__init__(root)
+        self.gate = threading.Event()
+
+    def upload(self, name, filename):
+        self.gate.wait(10)
+        super().upload(name, filename)
+
+class FlakyStorage(LocalStorage):
+    # the first failures uploads raise, like a dropped connection
+    def __init__(self, root, failures):
+        super().__init__(root)
+        self.failures = failures
+        self.attempts = []
+
+    def upload(self, name, filename):
+        self.attempts.append(name)
+
+        if len(self.attempts) <= self.failures:
+            raise ConnectionError('connection reset')
+
+        super().upload(name, filename)
+
+class CountingStorage(LocalStorage):
+    def __init__(self, root):
+        super().__init__(root)
+        self.downloads = 0
+
+    def download(self, name, filename):
+        self.downloads += 1
+        super().download(name, filename)
+
+class CheckpointTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.local = os.path.join(self.tmp.name, 'local')
+        self.remote = os.path.join(self.tmp.name, 'remote')
+        os.makedirs(self.local)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def checkpoint(self, name, data):
+        path = os.path.join(self.local, name)
+
+        with open(path, 'wb') as f:
+            f.write(data)
+
+        return path
+
+    def test_upload_runs_in_the_background(self):
+        storage = GatedStorage(self.remote)
+        uploader = CheckpointUploader(storage)
+
+        uploader.upload('models/a.pth', self.checkpoint('a.pth', b'a' * 100))
+        uploader.upload('models/b.pth', self.checkpoint('b.pth', b'b' * 100))
+
+        # upload() returned while the transfer is still held at the gate
+        self.assertFalse(storage.exists('models/a.pth'))
+
+        storage.gate.set()
+        self.assertEqual(uploader.wait(), [])
+        self.assertEqual(storage.read('models/a.pth'), b'a' * 100)
+        self.assertEqual(storage.read('models/b.pth'), b'b' * 100)
+
+    def test_upload_retries_with_backoff(self):
+        storage = FlakyStorage(self.remote, failures=2)
+        uploader = CheckpointUploader(storage, retries=3, backoff=2)
+
+        with mock.patch('lib.checkpoint.time.sleep') as sleep:
+            uploader.upload('models/a.pth', self.checkpoint('a.pth', b'a' * 100))
+            self.assertEqual(uploader.wait(), [])
+
+        self.assertEqual(len(storage.attempts), 3)
+        self.assertEqual([c.args[0] for c in sleep.call_args_list], [1, 2])
+        self.assertEqual(storage.read('models/a.pth'), b'a' * 100)
+
+    def test_upload_reports_what_failed(self):
+        storage = FlakyStorage(self.remote, failures=100)
+        uploader = CheckpointUploader(storage, retries=2)
+
+        with mock.patch('lib.checkpoint.time.sleep'):
+            uploader.upload('models/a.pth', self.checkpoint('a.pth', b'a' * 100))
+            self.assertEqual(uploader.wait(), ['models/a.pth'])
+
+        self.assertEqual(len(storage.attempts), 3)
+        self.assertFalse(storage.exists('models/a.pth'))
+
+    def test_fetch_downloads_once(self):
+        storage = CountingStorage(self.remote)
+        storage.write('models/a.pth', b'a' * 100)
+        path = os.path.join(self.local, 'models', 'a.pth')
+
+        self.assertEqual(fetch_checkpoint(storage, 'models/a.pth', path, local_rank=0), path)
+        self.assertEqual(fetch_checkpoint(storage, 'models/a.pth', path, local_rank=0), path)
+
+        self.assertEqual(storage.downloads, 1)
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), b'a' * 100)
+
+    def test_fetch_replaces_a_stale_file(self):
+        storage = CountingStorage(self.remote)
+        storage.write('models/a.pth', b'a' * 100)
+        path = self.checkpoint('a.pth', b'old')
+
+        # a file from another run with the same name, not downloaded from this checkpoint
+        fetch_checkpoint(storage, 'models/a.pth', path, local_rank=0)
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), b'a' * 100)
+
+        # the checkpoint is rewritten in storage
+        storage.write('models/a.pth', b'b' * 200)
+        fetch_checkpoint(storage, 'models/a.pth', path, local_rank=0)
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), b'b' * 200)
+
+        # the local copy is truncated
+        with open(path, 'wb') as f:
+            f.write(b'b' * 10)
+
+        fetch_checkpoint(storage, 'models/a.pth', path, local_rank=0)
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), b'b' * 200)
+
+        self.assertEqual(storage.downloads, 3)
+
+    def test_fetch_missing_checkpoint(self):
+        storage = CountingStorage(self.remote)
+        path = os.path.join(self.local, 'missing.pth')
+
+        self.assertIsNone(fetch_checkpoint(storage, 'models/missing.pth', path, local_rank=0))
+        self.assertEqual(storage.downloads, 0)
+
+    def test_fetch_other_local_ranks_do_not_download(self):
+        storage = CountingStorage(self.remote)
+        storage.write('models/a.pth', b'a' * 100)
+        path = os.path.join(self.local, 'a.pth')
+
+        self.assertIsNone(fetch_checkpoint(storage, 'models/a.pth', path, local_rank=1))
+        self.assertEqual(storage.downloads, 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+import io
+import tempfile
+import unittest
+import numpy as np
+import torch.utils.data
+
+from lib.shards import ShardStream, ShardWriter
+from lib.storage import LocalStorage
+
+class KeyDataset(object):
+    # stands in for VocalRemoverCloudDataset; every item is the index stored in its patch
+    def process(self, data):
+        return int(data['i'])
+
+def write_library(storage, items, max_bytes):
+    writer = ShardWriter(storage, 'train', max_bytes=max_bytes)
+
+    for i in range(items):
+        buffer = io.BytesIO()
+        np.savez(buffer, i=np.int64(i), pad=np.zeros(64, dtype=np.float32))
+        writer.write(f'patch{i}', buffer.getvalue())
+
+    writer.close()
+
+class ShardStreamTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.storage = LocalStorage(self.tmp.name)
+
+        # 53 items over shards of uneven size, so resumes land inside a shard
+        write_library(self.storage, 53, max_bytes=8 * 1024)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def stream(self, **kwargs):
+        return ShardStream(self.storage, 'train', KeyDataset(), **kwargs)
+
+    def test_shards_are_uneven(self):
+        sizes = [items for _, items in self.stream().shards]
+
+        self.assertGreater(len(sizes), 3)
+        self.assertGreater(len(set(sizes)), 1)
+        self.assertEqual(sum(sizes), 53)
+
+    def test_epoch_is_a_permutation(self):
+        stream = self.stream(shuffle_buffer=8)
+        self.assertEqual(sorted(stream), list(range(53)))
+
+    def test_resume_yields_the_remainder(self):
+        stream = self.stream(shuffle_buffer=0)
+        full = list(stream)
+
+        for skip in [1, 2, 20, 37, 52]:
+            stream.set_epoch(0, skip=skip)
+            self.assertEqual(list(stream), full[skip:], f'skip {skip}')
+
+    def test_resume_with_a_shuffle_buffer_reads_the_remainder(self):
+        unbuffered = self.stream(shuffle_buffer=0)
+        full = list(unbuffered)
+
+        stream = self.stream(shuffle_buffer=8)
+        stream.set_epoch(0, skip=20)
+        self.assertEqual(sorted(stream), sorted(full[20:]))
+
+    def load(self, stream, num_workers, batch_size=4):
+        return [int(i) for batch in torch.utils.data.DataLoader(stream, batch_size=batch_size, num_workers=num_workers) for i in batch]
+
+    def test_workers_do_not_repeat_items(self):
+        # 16 workers is more than there are shards, so some workers have nothing to read
+        for num_workers in [2, 3, 8, 16]:
+            self.assertEqual(sorted(self.load(self.stream(shuffle_buffer=8), num_workers)), list(range(53)), f'{num_workers} workers')
+
+    def test_resume_across_workers(self):
+        stream = self.stream(shuffle_buffer=0)
+        full = self.load(stream, 2)
+        self.assertEqual(sorted(full), list(range(53)))
+
+        for skip in [4, 20, 36]:
+            stream.set_epoch(0, skip=skip, batch_size=4)
+            self.assertEqual(sorted(self.load(stream, 2)), sorted(full[skip:]), f'skip {skip}')
+
+    def test_ranks_split_the_shards(self):
+        ranks = [list(self.stream(num_replicas=2, rank=rank, shuffle_buffer=0)) for rank in range(2)]
+
+        for items in ranks:
+            self.assertEqual(len(items), 53 // 2)
+
+        # a rank with fewer items than its share cycles through its own shards, never into the other rank's
+        self.assertEqual(set(ranks[0]) & set(ranks[1]), set())
+
+    def test_ranks_and_workers(self):
+        ranks = [self.load(self.stream(num_replicas=2, rank=rank, shuffle_buffer=8), 3) for rank in range(2)]
+
+        for items in ranks:
+            self.assertEqual(len(items), 53 // 2)
+
+        self.assertEqual(set(ranks[0]) & set(ranks[1]), set())
+
+        # the workers of a rank together read what the rank reads in a single process, so only a rank that ran
+        # short of items repeats any
+        for rank, items in enumerate(ranks):
+            self.assertEqual(sorted(items), sorted(self.stream(num_replicas=2, rank=rank, shuffle_buffer=0)))
+
+    def test_epochs_reorder_the_shards(self):
+        stream = self.stream(shuffle_buffer=0)
+        first = list(stream)
+
+        stream.set_epoch(1)
+        self.assertNotEqual(list(stream), first)
+        self.assertEqual(sorted(stream), list(range(53)))
+
+if __name__ == '__main__':
+    unittest.main()
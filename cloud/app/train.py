@@ -1,6 +1,5 @@
 import argparse
 import datetime
-from io import BytesIO
 import time
 import random
 import numpy as np
@@ -10,10 +9,12 @@ from torch.utils.data import DataLoader
 from torch.nn.utils import clip_grad_norm_
 from torch.utils.data.dataloader import DataLoader
 from lib.frame_transformer import FrameTransformer
-from lib.dataset import VocalRemoverCloudDataset
+from lib.checkpoint import CheckpointUploader, fetch_checkpoint
+from lib.dataset import VocalRemoverCloudDataset, PrefetchSampler
+from lib.shards import ShardStream
+from lib.storage import open_storage
 from lib.warmup_lr import WarmupLR
 import multiprocessing
-from google.cloud import storage
 from tqdm import tqdm
 import os
 from torch.utils.data.distributed import DistributedSampler
@@ -136,19 +137,38 @@ def node_main(idx, args):
     np.random.seed(args.seed + rank)
     torch.manual_seed(args.seed + rank)
 
-    train_dataset = VocalRemoverCloudDataset(dataset=args.train_dataset, vocal_dataset=args.vocal_dataset, num_training_items=args.num_training_items)
-    train_sampler = DistributedSampler(train_dataset, shuffle=True)
-
-    train_dataloader = DataLoader(
-        train_dataset,
-        sampler=train_sampler,
-        batch_size=args.batch_size,
-        num_workers=args.num_workers,
-        shuffle=False,
-        drop_last=True
-    )
-
-    val_dataset = VocalRemoverCloudDataset(dataset=args.validation_dataset, vocal_dataset=args.vocal_dataset, num_training_items=args.num_training_items)
+    # one cache directory per node, shared by its ranks and their dataloader workers
+    storage = open_storage(args.storage, cache_dir=args.cache_dir, cache_size=int(args.cache_size * 1024 ** 3) if args.cache_dir is not None else None)
+
+    if args.train_shards is not None:
+        # streamed from tar shards (make_shards.py), the patch library itself is never listed
+        train_dataset = VocalRemoverCloudDataset(dataset=None, vocal_dataset=args.vocal_dataset, storage=storage)
+        train_stream = ShardStream(storage, args.train_shards, train_dataset, shuffle_buffer=args.shuffle_buffer, seed=args.seed, num_replicas=args.world_size, rank=rank)
+
+        train_dataloader = DataLoader(
+            train_stream,
+            batch_size=args.batch_size,
+            num_workers=args.num_workers,
+            drop_last=True
+        )
+    else:
+        train_dataset = VocalRemoverCloudDataset(dataset=args.train_dataset, vocal_dataset=args.vocal_dataset, storage=storage, num_training_items=args.num_training_items)
+        train_sampler = DistributedSampler(train_dataset, shuffle=True)
+        train_stream = None
+
+        if args.cache_dir is not None and args.prefetch > 0:
+            train_sampler = PrefetchSampler(train_sampler, train_dataset, lookahead=args.prefetch)
+
+        train_dataloader = DataLoader(
+            train_dataset,
+            sampler=train_sampler,
+            batch_size=args.batch_size,
+            num_workers=args.num_workers,
+            shuffle=False,
+            drop_last=True
+        )
+
+    val_dataset = VocalRemoverCloudDataset(dataset=args.validation_dataset, vocal_dataset=args.vocal_dataset, storage=storage, num_training_items=args.num_training_items)
     val_sampler = DistributedSampler(val_dataset, shuffle=False)
 
     val_dataloader = DataLoader(
@@ -173,26 +193,19 @@ def node_main(idx, args):
 
     grad_scaler = torch.cuda.amp.grad_scaler.GradScaler() if args.mixed_precision else None
     
-    client = storage.Client()
-    bucket = client.bucket('bc-vocal-remover')
-
-    if bucket.get_blob('models/') == None:
-        blob = bucket.blob('models/')
-        blob.upload_from_string("")
-
     if not os.path.exists('models'):
-        os.makedirs('models')
+        os.makedirs('models', exist_ok=True)
 
     if args.checkpoint is not None:
-        blob = bucket.get_blob(f'models/{args.checkpoint}.pth')
-        
-        if blob != None:
-            blob_data = blob.download_as_bytes()
-            bytes = BytesIO(blob_data)
+        # streamed to disk once per node and read from there by each of its ranks
+        checkpoint_path = fetch_checkpoint(storage, f'models/{args.checkpoint}.pth', f'models/{args.checkpoint}.pth', local_rank=idx, device_ids=[idx])
+
+        if checkpoint_path is not None:
             print(f'{rank} loading checkpoint')
-            model.load_state_dict(torch.load(bytes))
-            blob = bucket.blob('models/')
+            model.module.load_state_dict(torch.load(checkpoint_path, map_location=device))
             print(f'{rank} loaded checkpoint')
+
+    uploader = CheckpointUploader(storage, retries=args.upload_retries) if rank == 0 else None
     
     optimizer = torch.optim.Adam(
         filter(lambda p: p.requires_grad, model.parameters()),
@@ -211,7 +224,11 @@ def node_main(idx, args):
 
     lr_warmup = WarmupLR(optimizer, target_lr=args.learning_rate, num_steps=args.lr_warmup_steps, current_step=args.lr_warmup_current_step, verbose=True) if args.lr_warmup_steps > 0 else None
 
-    for epoch in range(args.epochs):
+    for epoch in range(args.start_epoch, args.epochs):
+        if train_stream is not None:
+            # a resumed epoch picks up after the items of its first start_batch batches
+            train_stream.set_epoch(epoch, skip=args.start_batch * args.batch_size if epoch == args.start_epoch else 0, batch_size=args.batch_size)
+
         train_loss = train_epoch(train_dataloader, model, device, optimizer, args.accumulation_steps, grad_scaler, args.progress_bar, args.mixup_rate, args.mixup_alpha, lr_warmup=lr_warmup)
         val_loss = validate_epoch(val_dataloader, model, device, grad_scaler)
 
@@ -220,13 +237,18 @@ def node_main(idx, args):
         if rank == 0:
             model_path = f'{args.job_name}.i{epoch}.pth'
             torch.save(model.module.state_dict(), f'models/{model_path}')
-            model_blob = bucket.blob(f'models/{model_path}')
-            model_blob.upload_from_filename(f'models/{model_path}')
+            uploader.upload(f'models/{model_path}', f'models/{model_path}')
 
         print_master(f'Epoch {epoch} loss: total={train_loss}')
         print_master(f'Epoch {epoch} validation loss: {val_loss}')
         print_master("")
     
+    if uploader is not None:
+        failed = uploader.wait()
+
+        if len(failed) > 0:
+            print(f'checkpoints not uploaded, still in models/: {", ".join(failed)}')
+
     print_master('destroying group')
     torch.distributed.destroy_process_group()
     print('Training session complete!')
@@ -251,6 +273,15 @@ def main():
     p.add_argument('--train_dataset', type=str, default='cs2048_sr44100_hl1024_nf2048_of0/')
     p.add_argument('--vocal_dataset', type=str, default='cs2048_sr44100_hl1024_nf2048_of0_VOCALS/')
     p.add_argument('--checkpoint', type=str, default=None)
+    p.add_argument('--upload_retries', type=int, default=5)
+    p.add_argument('--storage', type=str, default='gs://bc-vocal-remover')
+    p.add_argument('--cache_dir', type=str, default=None)
+    p.add_argument('--cache_size', type=float, default=64, help='gigabytes')
+    p.add_argument('--prefetch', type=int, default=256)
+    p.add_argument('--train_shards', type=str, default=None)
+    p.add_argument('--shuffle_buffer', type=int, default=256)
+    p.add_argument('--start_epoch', type=int, default=0)
+    p.add_argument('--start_batch', type=int, default=0)
     p.add_argument('--num_training_items', type=int, default=None)
     p.add_argument('--epochs', type=int, default=1)
     p.add_argument('--gpus', type=int, default=1)
@@ -14,8 +14,10 @@ import hashlib
 
 try:
     from lib import spec_utils
+    from lib.dataset_builder import build_dataset, make_padding
 except ModuleNotFoundError:
     import spec_utils
+    from dataset_builder import build_dataset, make_padding
 
 class VocalAutoregressiveDataset(torch.utils.data.Dataset):
     def __init__(self, path, extra_path=None, pair_path=None, mix_path=None, vocal_path="", is_validation=False, mul=1, downsamples=0, epoch_size=None, pair_mul=1, slide=True, cropsize=256, mixup_rate=0, mixup_alpha=1):
@@ -647,16 +649,6 @@ def train_val_split(dataset_dir, val_filelist, val_size=-1, train_size=-1, selec
 
     return train_filelist, val_filelist
 
-def make_padding(width, cropsize, offset):
-    left = offset
-    roi_size = cropsize - offset * 2
-    if roi_size == 0:
-        roi_size = cropsize
-    right = roi_size - (width % roi_size) + left
-
-    return left, right, roi_size
-
-
 def make_training_set(filelist, sr, hop_length, n_fft):
     ret = []
     for X_path, y_path in tqdm(filelist):
@@ -678,7 +670,7 @@ def get_oracle_data(X, y, oracle_loss, oracle_rate, oracle_drop_rate):
 
     return oracle_X, oracle_y, indices
 
-def make_vocal_stems(dataset, cropsize=1024, sr=44100, hop_length=512, n_fft=1024, offset=0, root=''):
+def make_vocal_stems(dataset, cropsize=1024, sr=44100, hop_length=512, n_fft=1024, offset=0, root='', num_workers=None):
     input_exts = ['.wav', '.m4a', '.mp3', '.mp4', '.flac']
 
     filelist = sorted([
@@ -686,92 +678,16 @@ def make_vocal_stems(dataset, cropsize=1024, sr=44100, hop_length=512, n_fft=102
         for fname in os.listdir(dataset)
         if os.path.splitext(fname)[1] in input_exts])
 
-    for i, X_path in enumerate(tqdm(filelist)):
-        basename = os.path.splitext(os.path.basename(X_path))[0]
-        xw, _ = spec_utils.load_wave(X_path, X_path, sr)
-
-        patch_dir = '{}cs{}_sr{}_hl{}_nf{}_of{}{}'.format(root, cropsize, sr, hop_length, n_fft, 0, "_VOCALS")
-        os.makedirs(patch_dir, exist_ok=True)
-
-        X, _ = spec_utils.to_spec(xw, xw, hop_length=hop_length, n_fft=n_fft)
-        coef = np.abs(xw).max()
-
-        l, r, roi_size = make_padding(X.shape[2], cropsize, offset)
-        X_pad = np.pad(X, ((0, 0), (0, 0), (l, r)), mode='constant')
+    patch_dir = '{}cs{}_sr{}_hl{}_nf{}_of{}{}'.format(root, cropsize, sr, hop_length, n_fft, 0, "_VOCALS")
+    build_dataset([(X_path, X_path) for X_path in filelist], patch_dir, mode='vocals', cropsize=cropsize, sr=sr, hop_length=hop_length, n_fft=n_fft, offset=offset, num_workers=num_workers)
 
-        len_dataset = int(np.ceil(X.shape[2] / roi_size))
-        for j in range(len_dataset):
-            outpath = os.path.join(patch_dir, '{}_p{}.npz'.format(basename, j))
-
-            start = j * roi_size
-            if coef != 0:
-                xp = X_pad[:, :, start:start + cropsize]
-                xc = np.abs(xp).mean()
-
-                if xc > 0:
-                    np.savez(
-                        outpath,
-                        X=xp,
-                        c=coef)
-
-def make_dataset(filelist, cropsize, sr, hop_length, n_fft, offset=0, is_validation=False, suffix='', root=''):
-    patch_list = []    
+def make_dataset(filelist, cropsize, sr, hop_length, n_fft, offset=0, is_validation=False, suffix='', root='', num_workers=None):
     patch_dir = f'{root}cs{cropsize}_sr{sr}_hl{hop_length}_nf{n_fft}_of{offset}{suffix}'
-    os.makedirs(patch_dir, exist_ok=True)
-
-    for X_path, Y_path in tqdm(filelist):
-        basename = os.path.splitext(os.path.basename(X_path))[0]
-
-        voxaug = X_path == Y_path
+    build_dataset(filelist, patch_dir, mode='pairs', cropsize=cropsize, sr=sr, hop_length=hop_length, n_fft=n_fft, offset=offset, num_workers=num_workers)
 
-        X, Y = spec_utils.load(X_path, Y_path, sr, hop_length, n_fft)
-
-        coef = np.max([np.abs(X).max(), np.abs(Y).max()])
-
-        l, r, roi_size = make_padding(X.shape[2], cropsize, offset)
-        X_pad = np.pad(X, ((0, 0), (0, 0), (l, r)), mode='constant')
-        Y_pad = np.pad(Y, ((0, 0), (0, 0), (l, r)), mode='constant')
-
-        len_dataset = int(np.ceil(X.shape[2] / roi_size))
-        for j in range(len_dataset):
-            outpath = os.path.join(patch_dir, '{}_p{}.npz'.format(basename, j))
-            patch_list.append(outpath)
-
-            start = j * roi_size
-            if not os.path.exists(outpath):
-                if voxaug:
-                    np.savez(
-                        outpath,
-                        X=X_pad[:, :, start:start + cropsize],
-                        c=coef.item())
-                else:
-                    np.savez(
-                        outpath,
-                        X=X_pad[:, :, start:start + cropsize],
-                        Y=Y_pad[:, :, start:start + cropsize],
-                        c=coef.item())
-
-def make_validation_set(filelist, sr, hop_length, n_fft, offset=0, root=''):
-    patch_list = []    
+def make_validation_set(filelist, sr, hop_length, n_fft, offset=0, root='', num_workers=None):
     patch_dir = f'{root}_sr{sr}_hl{hop_length}_nf{n_fft}_of{offset}_VALIDATION'
-    os.makedirs(patch_dir, exist_ok=True)
-
-    for X_path, Y_path in tqdm(filelist):
-        basename = os.path.splitext(os.path.basename(X_path))[0]
-
-        X, Y = spec_utils.load(X_path, Y_path, sr, hop_length, n_fft)
-
-        coef = np.max([np.abs(X).max(), np.abs(Y).max()])
-
-        outpath = os.path.join(patch_dir, '{}.npz'.format(basename))
-        patch_list.append(outpath)
-
-        if not os.path.exists(outpath):
-            np.savez(
-                outpath,
-                X=X,
-                Y=Y,
-                c=coef.item())
+    build_dataset(filelist, patch_dir, mode='validation', sr=sr, hop_length=hop_length, n_fft=n_fft, offset=offset, num_workers=num_workers)
 
 if __name__ == "__main__":
     import sys
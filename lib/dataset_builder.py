@@ -0,0 +1,261 @@
+import hashlib
+import json
+import multiprocessing
+import os
+import re
+import time
+
+import numpy as np
+from tqdm import tqdm
+
+try:
+    from lib import spec_utils
+except ModuleNotFoundError:
+    import spec_utils
+
+MANIFEST_NAME = 'manifest.json'
+TMP_SUFFIX = '.tmp'
+
+def file_hash(path, chunk_size=2 ** 20):
+    h = hashlib.sha1()
+
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+
+    return h.hexdigest()
+
+def source_hash(paths, params):
+    h = hashlib.sha1(json.dumps(params, sort_keys=True).encode())
+
+    for p in paths:
+        h.update(file_hash(p).encode())
+
+    return h.hexdigest()
+
+def make_padding(width, cropsize, offset):
+    left = offset
+    roi_size = cropsize - offset * 2
+    if roi_size == 0:
+        roi_size = cropsize
+    right = roi_size - (width % roi_size) + left
+
+    return left, right, roi_size
+
+def save_patch(outpath, **arrays):
+    # a patch only appears under its final name once it has been completely written
+    tmp = outpath + TMP_SUFFIX
+
+    with open(tmp, 'wb') as f:
+        np.savez(f, **arrays)
+
+    os.replace(tmp, outpath)
+
+def build_song(task):
+    X_path, Y_path = task['X_path'], task['Y_path']
+    mode, name, patch_dir = task['mode'], task['name'], task['patch_dir']
+    cropsize, sr, hop_length, n_fft, offset = task['cropsize'], task['sr'], task['hop_length'], task['n_fft'], task['offset']
+
+    if mode == 'vocals':
+        xw, _ = spec_utils.load_wave(X_path, X_path, sr)
+        X, _ = spec_utils.to_spec(xw, xw, hop_length=hop_length, n_fft=n_fft)
+        Y = X
+        coef = np.abs(xw).max()
+    else:
+        X, Y = spec_utils.load(X_path, Y_path, sr, hop_length, n_fft)
+        coef = np.max([np.abs(X).max(), np.abs(Y).max()])
+
+    if mode == 'validation':
+        outname = f'{name}.npz'
+        save_patch(os.path.join(patch_dir, outname), X=X, Y=Y, c=coef.item())
+        return [outname]
+
+    patches = []
+    l, r, roi_size = make_padding(X.shape[2], cropsize, offset)
+    X_pad = np.pad(X, ((0, 0), (0, 0), (l, r)), mode='constant')
+    Y_pad = X_pad if Y is X else np.pad(Y, ((0, 0), (0, 0), (l, r)), mode='constant')
+
+    len_dataset = int(np.ceil(X.shape[2] / roi_size))
+    for j in range(len_dataset):
+        outname = f'{name}_p{j}.npz'
+        outpath = os.path.join(patch_dir, outname)
+        start = j * roi_size
+
+        if mode == 'vocals':
+            xp = X_pad[:, :, start:start + cropsize]
+
+            if coef != 0 and np.abs(xp).mean() > 0:
+                save_patch(outpath, X=xp, c=coef)
+                patches.append(outname)
+        elif X_path == Y_path:
+            save_patch(outpath, X=X_pad[:, :, start:start + cropsize], c=coef.item())
+            patches.append(outname)
+        else:
+            save_patch(outpath, X=X_pad[:, :, start:start + cropsize], Y=Y_pad[:, :, start:start + cropsize], c=coef.item())
+            patches.append(outname)
+
+    return patches
+
+def _build(task):
+    # returns (task, hash, patches, error); patches is None when the content is unchanged since the last build
+    try:
+        h = source_hash(task['paths'], task['params'])
+
+        if h == task['previous_hash']:
+            return task, h, None, None
+
+        return task, h, build_song(task), None
+    except Exception as e:
+        return task, None, [], f'{type(e).__name__}: {e}'
+
+class Manifest(object):
+    # per-song build state kept as manifest.json in the patch directory, keyed by the source file pair. songs are
+    # rebuilt when the content hash of their source files or the build parameters change
+    def __init__(self, patch_dir):
+        self.patch_dir = patch_dir
+        self.path = os.path.join(patch_dir, MANIFEST_NAME)
+        self.songs = {}
+        self.exists = os.path.exists(self.path)
+
+        if self.exists:
+            with open(self.path) as f:
+                self.songs = json.load(f)['songs']
+
+    def save(self):
+        tmp = self.path + TMP_SUFFIX
+
+        with open(tmp, 'w') as f:
+            json.dump({ 'songs': self.songs }, f, indent=1)
+
+        os.replace(tmp, self.path)
+
+    def complete(self, key, params):
+        # the previous build of this song, if it finished with the same parameters and all its patches still exist
+        entry = self.songs.get(key)
+
+        if entry is None or entry['status'] != 'done' or entry['params'] != params:
+            return None
+
+        if not all(os.path.exists(os.path.join(self.patch_dir, p)) for p in entry['patches']):
+            return None
+
+        return entry
+
+    def seed(self, filelist, params):
+        # a library built before the manifest existed: songs whose patches are already in the directory are recorded
+        # as done with their current size and mtime instead of being rebuilt. the build parameters are part of the
+        # directory name, so existing patches were made with the same ones. there is no hash, so a song whose
+        # source later changes is rebuilt
+        patches = {}
+        for f in os.listdir(self.patch_dir):
+            m = re.match(r'^(.*)_p(\d+)\.npz$', f) if params['mode'] != 'validation' else re.match(r'^(.*)\.npz$', f)
+
+            if m is not None:
+                patches.setdefault(m.group(1), []).append(f)
+
+        for X_path, Y_path in filelist:
+            key = song_key(X_path, Y_path)
+            name = os.path.splitext(os.path.basename(X_path))[0]
+
+            if key in self.songs or name not in patches:
+                continue
+
+            paths = sorted(set([X_path, Y_path]))
+            stats = [[os.path.getsize(p), os.path.getmtime(p)] for p in paths]
+            self.songs[key] = { 'name': name, 'status': 'done', 'hash': None, 'stats': stats, 'params': params, 'patches': sorted(patches.pop(name)) }
+
+        if len(self.songs) > 0:
+            print(f'{self.patch_dir}: adopted the existing patches of {len(self.songs)} songs, {sum(len(p) for p in patches.values())} patches belong to no song in the filelist')
+            self.save()
+
+def song_key(X_path, Y_path):
+    return X_path if X_path == Y_path else f'{X_path}|{Y_path}'
+
+def unique_name(basename, key, taken):
+    # songs from different directories can share a basename; the later one gets a suffix derived from its source path
+    # instead of the old _p{j}.{i}.npz renaming, and the manifest keeps each song's name fixed across reruns
+    if basename not in taken or taken[basename] == key:
+        return basename
+
+    return f'{basename}.{hashlib.sha1(key.encode()).hexdigest()[:8]}'
+
+def build_dataset(filelist, patch_dir, mode='pairs', cropsize=2048, sr=44100, hop_length=1024, n_fft=2048, offset=0, num_workers=None, maxtasksperchild=8):
+    # builds patches for (X_path, Y_path) pairs with one song per task on a process pool; mode is 'pairs' (X and
+    # optionally Y patches, as make_dataset), 'vocals' (make_vocal_stems) or 'validation' (one file per song).
+    # interrupted builds resume from the manifest and only new or changed songs are rebuilt
+    os.makedirs(patch_dir, exist_ok=True)
+
+    for f in os.listdir(patch_dir):
+        if f.endswith(TMP_SUFFIX):
+            os.remove(os.path.join(patch_dir, f))
+
+    manifest = Manifest(patch_dir)
+    params = { 'mode': mode, 'cropsize': cropsize, 'sr': sr, 'hop_length': hop_length, 'n_fft': n_fft, 'offset': offset }
+
+    if not manifest.exists:
+        manifest.seed(filelist, params)
+
+    taken = { entry['name']: key for key, entry in manifest.songs.items() }
+
+    tasks, skipped = [], 0
+    for X_path, Y_path in filelist:
+        key = song_key(X_path, Y_path)
+        paths = sorted(set([X_path, Y_path]))
+        stats = [[os.path.getsize(p), os.path.getmtime(p)] for p in paths]
+        entry = manifest.songs.get(key)
+        previous = manifest.complete(key, params)
+
+        # unchanged size and mtime skip the song without rehashing; otherwise the worker hashes the sources and
+        # only rebuilds when the content actually changed
+        if previous is not None and previous['stats'] == stats:
+            skipped = skipped + 1
+            continue
+
+        name = entry['name'] if entry is not None else unique_name(os.path.splitext(os.path.basename(X_path))[0], key, taken)
+        taken[name] = key
+
+        tasks.append({
+            'X_path': X_path, 'Y_path': Y_path, 'paths': paths, 'key': key, 'stats': stats, 'name': name, 'patch_dir': patch_dir,
+            'params': params, 'previous_hash': previous['hash'] if previous is not None else None, **params
+        })
+
+    print(f'{patch_dir}: {len(tasks)} songs to build, {skipped} up to date')
+
+    if len(tasks) == 0:
+        return manifest
+
+    num_workers = num_workers if num_workers is not None else os.cpu_count()
+    failed, last_save = 0, time.time()
+
+    # workers hold one decoded song each, so memory is bounded by num_workers; maxtasksperchild recycles workers
+    # to keep decoder memory growth in check
+    with multiprocessing.Pool(num_workers, maxtasksperchild=maxtasksperchild) as pool:
+        for task, h, patches, error in tqdm(pool.imap_unordered(_build, tasks), total=len(tasks)):
+            key = task['key']
+            previous = manifest.songs.get(key, {}).get('patches', [])
+
+            if error is not None:
+                failed = failed + 1
+                print(f'failed to build {key}: {error}')
+                manifest.songs[key] = { 'name': task['name'], 'status': 'failed', 'hash': None, 'stats': task['stats'], 'params': params, 'patches': previous, 'error': error }
+            else:
+                if patches is None:
+                    patches = previous
+
+                # a changed song can produce fewer patches than before
+                for p in set(previous) - set(patches):
+                    if os.path.exists(os.path.join(patch_dir, p)):
+                        os.remove(os.path.join(patch_dir, p))
+
+                manifest.songs[key] = { 'name': task['name'], 'status': 'done', 'hash': h, 'stats': task['stats'], 'params': params, 'patches': patches }
+
+            if time.time() - last_save > 10:
+                manifest.save()
+                last_save = time.time()
+
+    manifest.save()
+
+    if failed > 0:
+        print(f'{failed} songs failed; rerun to retry them')
+
+    return manifest
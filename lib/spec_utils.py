@@ -108,19 +108,116 @@ def merge_artifacts(y_mask, thres=0.05, min_range=64, fade_size=32):
     return y_mask
 
 
-def align_wave_head_and_tail(a, b, sr):
+def xcorr_full(a, b):
+    # np.correlate(a, b, 'full') over the last axis computed with real ffts; leading axes are batched
+    la, lb = a.shape[-1], b.shape[-1]
+    n = 1 << (la + lb - 2).bit_length()
+    c = np.fft.irfft(np.fft.rfft(a, n) * np.conj(np.fft.rfft(b, n)), n)
+
+    return np.concatenate((c[..., n - lb + 1:], c[..., :la]), axis=-1)
+
+
+def decimate_mean(x, factor):
+    # block means are a cheap low pass that keeps the correlation peak of broadband material in place
+    n = x.shape[-1] // factor * factor
+    return x[..., :n].reshape(x.shape[:-1] + (-1, factor)).mean(axis=-1)
+
+
+def _peak_candidates(c, count, spread):
+    c = c.copy()
+    peaks = []
+
+    for _ in range(count):
+        i = int(np.argmax(c))
+
+        if not np.isfinite(c[i]):
+            break
+
+        peaks.append(i)
+        c[max(0, i - spread):i + spread + 1] = -np.inf
+
+    return peaks
+
+
+def _refine_delay(a, b, coarse, radius):
+    # exact correlation at full rate for every delay within radius of the coarse estimates. delay follows
+    # align_wave_head_and_tail: np.argmax(np.correlate(a, b, 'full')) - (len(a) - 1)
+    la, lb = len(a), len(b)
+    ea = np.concatenate(([0], np.cumsum(a.astype(np.float64) ** 2)))
+    eb = np.concatenate(([0], np.cumsum(b.astype(np.float64) ** 2)))
+
+    best, best_value, best_norm = 0, -np.inf, 0
+    for delay in sorted(set(d for c in coarse for d in range(c - radius, c + radius + 1))):
+        k = delay + la - lb
+        if k <= -lb or k >= la:
+            continue
+
+        a0, b0 = max(k, 0), max(-k, 0)
+        n = min(la - a0, lb - b0)
+        value = np.dot(a[a0:a0 + n], b[b0:b0 + n])
+
+        if value > best_value:
+            norm = np.sqrt((ea[a0 + n] - ea[a0]) * (eb[b0 + n] - eb[b0]))
+            best, best_value, best_norm = delay, value, norm
+
+    confidence = best_value / best_norm if best_norm > 0 else 0.
+
+    return best, float(confidence)
+
+
+def find_delays(a_monos, b_monos, decimation=16, candidates=3):
+    # multi resolution search: a batched fft correlation of the decimated signals proposes the strongest lags and
+    # each is refined at full rate. confidence is the normalized correlation of the overlapping samples at the
+    # chosen delay, so 1 is an exact match and values near 0 mean nothing lined up. windows too short to decimate
+    # are correlated directly over every lag
+    results = [None] * len(a_monos)
+    batch = []
+
+    for i, (a, b) in enumerate(zip(a_monos, b_monos)):
+        if min(len(a), len(b)) < decimation * 2:
+            results[i] = _refine_delay(a, b, [0], max(len(a), len(b)))
+        else:
+            batch.append(i)
+
+    if len(batch) == 0:
+        return results
+
+    la = max(len(a_monos[i]) for i in batch)
+    lb = max(len(b_monos[i]) for i in batch)
+    A = np.zeros((len(batch), la // decimation), dtype=np.float32)
+    B = np.zeros((len(batch), lb // decimation), dtype=np.float32)
+
+    for j, i in enumerate(batch):
+        a, b = decimate_mean(a_monos[i], decimation), decimate_mean(b_monos[i], decimation)
+        A[j, :len(a)] = a
+        B[j, :len(b)] = b
+
+    C = xcorr_full(A, B)
+
+    for j, i in enumerate(batch):
+        # decimated lag k sits at index k + B.shape[1] - 1 of the padded correlation, and lag k is delay + len(a) - len(b)
+        a, b = a_monos[i], b_monos[i]
+        peaks = _peak_candidates(C[j], candidates, 2)
+        coarse = [(p - (B.shape[1] - 1)) * decimation - len(a) + len(b) for p in peaks]
+        results[i] = _refine_delay(a, b, coarse, decimation)
+
+    return results
+
+
+def _trim_and_window(a, b, sr, window):
     a, _ = librosa.effects.trim(a)
     b, _ = librosa.effects.trim(b)
 
-    a_mono = a[:, :sr * 4].sum(axis=0)
-    b_mono = b[:, :sr * 4].sum(axis=0)
+    a_mono = a[:, :int(sr * window)].sum(axis=0)
+    b_mono = b[:, :int(sr * window)].sum(axis=0)
 
     a_mono -= a_mono.mean()
     b_mono -= b_mono.mean()
 
-    offset = len(a_mono) - 1
-    delay = np.argmax(np.correlate(a_mono, b_mono, 'full')) - offset
+    return a, b, a_mono, b_mono
 
+
+def _apply_delay(a, b, delay):
     if delay > 0:
         a = a[:, delay:]
     else:
@@ -133,6 +230,28 @@ def align_wave_head_and_tail(a, b, sr):
 
     return a, b
 
+
+def align_waves(pairs, sr, window=4, min_confidence=0.3, decimation=16):
+    # aligns many (a, b) pairs of [channels, samples] waves at once. returns the aligned pairs along with a report
+    # of (index, delay, confidence) for pairs whose confidence is under min_confidence; those are still trimmed by
+    # the best delay found, so callers decide whether to drop them
+    trimmed = [_trim_and_window(a, b, sr, window) for a, b in pairs]
+    delays = find_delays([t[2] for t in trimmed], [t[3] for t in trimmed], decimation=decimation)
+
+    aligned, failures = [], []
+    for i, ((a, b, _, _), (delay, confidence)) in enumerate(zip(trimmed, delays)):
+        aligned.append(_apply_delay(a, b, delay))
+
+        if confidence < min_confidence:
+            failures.append((i, delay, confidence))
+
+    return aligned, failures
+
+
+def align_wave_head_and_tail(a, b, sr):
+    aligned, _ = align_waves([(a, b)], sr)
+    return aligned[0]
+
 def to_spec(X, Y, hop_length=1024, n_fft=2048, sr=44100, va=False):
     X = wave_to_spectrogram(X, hop_length, n_fft)
 
@@ -1,4 +1,6 @@
-from lib.dataset import make_validation_set, train_val_split, make_vocal_stems, make_dataset, make_mix_dataset
+import os
+
+from lib.dataset import make_validation_set, train_val_split, make_vocal_stems, make_dataset
 
 vocal_dataset = [
     # ("J://dataset/vocals", "C://"),
@@ -50,19 +52,26 @@ pretraining_dirs = [
 cropsize = 2048
 hop_length = 1024
 fft = 2048
+num_workers = os.cpu_count()
+
+# pool workers re-import this script when processes are spawned (windows), so the builds only run as __main__
+if __name__ == '__main__':
+    for dir in dirs:
+        train_filelist, _ = train_val_split(
+            dataset_dir=dir[0],
+            val_filelist=[],
+            val_size=-1,
+            train_size=-1,
+            voxaug=dir[2])
 
-for dir in dirs:
-    train_filelist, _ = train_val_split(
-        dataset_dir=dir[0],
-        val_filelist=[],
-        val_size=-1,
-        train_size=-1,
-        voxaug=dir[2])
+        if not dir[2]:
+            print(train_filelist)
 
-    if not dir[2]:
-        print(train_filelist)
+        # lib.dataset has no mix dataset builder; skip those entries rather than stopping the remaining builds
+        if dir[3]:
+            print(f'skipping {dir[0]}: mix datasets are not supported by lib.dataset')
+            continue
 
-    if not dir[3]:
         val_dataset = make_dataset(
             filelist=train_filelist,
             cropsize=cropsize,
@@ -71,53 +80,47 @@ for dir in dirs:
             n_fft=fft,
             root=dir[1],
             is_validation=True,
-            suffix='_PAIRS' if not dir[2] else '')
-    else:
-        val_dataset = make_mix_dataset(
+            suffix='_PAIRS' if not dir[2] else '',
+            num_workers=num_workers)
+
+    for input_dir, output_dir in pretraining_dirs:
+        train_filelist, _ = train_val_split(
+            dataset_dir=input_dir,
+            val_filelist=[],
+            val_size=-1,
+            train_size=-1,
+            pretraining=True)
+
+        val_dataset = make_dataset(
             filelist=train_filelist,
             cropsize=cropsize,
             sr=44100,
             hop_length=hop_length,
             n_fft=fft,
-            root=dir[1],
-            is_validation=True)
+            root=output_dir,
+            is_validation=True,
+            suffix='_PRETRAINING',
+            num_workers=num_workers)
 
-for input_dir, output_dir in pretraining_dirs:
-    train_filelist, _ = train_val_split(
-        dataset_dir=input_dir,
-        val_filelist=[],
-        val_size=-1,
-        train_size=-1,
-        pretraining=True)
-    
-    val_dataset = make_dataset(
-        filelist=train_filelist,
-        cropsize=cropsize,
-        sr=44100,
-        hop_length=hop_length,
-        n_fft=fft,
-        root=output_dir,
-        is_validation=True,
-        suffix='_PRETRAINING')
-        
-for input_dir, output_dir in validation:
-    val_filelist, _ = train_val_split(
-        dataset_dir=input_dir,
-        val_filelist=[],
-        val_size=-1,
-        train_size=-1,
-        voxaug=False)
+    for input_dir, output_dir in validation:
+        val_filelist, _ = train_val_split(
+            dataset_dir=input_dir,
+            val_filelist=[],
+            val_size=-1,
+            train_size=-1,
+            voxaug=False)
 
-    val_dataset = make_dataset(
-        filelist=val_filelist,
-        cropsize=cropsize,
-        sr=44100,
-        hop_length=hop_length,
-        n_fft=fft,
-        root=output_dir,
-        is_validation=True,
-        suffix='_VALIDATION')
+        val_dataset = make_dataset(
+            filelist=val_filelist,
+            cropsize=cropsize,
+            sr=44100,
+            hop_length=hop_length,
+            n_fft=fft,
+            root=output_dir,
+            is_validation=True,
+            suffix='_VALIDATION',
+            num_workers=num_workers)
 
-for dir in vocal_dataset:
-    make_vocal_stems(dataset=dir[0], root=dir[1],
-                     cropsize=cropsize, hop_length=hop_length, n_fft=fft)
+    for dir in vocal_dataset:
+        make_vocal_stems(dataset=dir[0], root=dir[1],
+                         cropsize=cropsize, hop_length=hop_length, n_fft=fft, num_workers=num_workers)
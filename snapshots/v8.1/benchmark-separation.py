@@ -0,0 +1,170 @@
+import argparse
+import itertools
+import json
+import multiprocessing as mp
+import os
+import sys
+import tempfile
+import time
+import librosa
+import numpy as np
+import soundfile as sf
+import torch
+
+from libft2gan.frame_transformer5 import FrameTransformer
+from lib import spec_utils
+from inference import Separator
+
+STAGES = ['decode', 'stft', 'separate', 'istft', 'encode']
+
+def synthetic_audio(path, duration, sr, seed):
+    # a stereo mix of decaying harmonic notes over noise, so the spectrogram is not empty or uniform
+    rng = np.random.RandomState(seed)
+    t = np.arange(int(duration * sr)) / sr
+    wave = rng.randn(2, len(t)).astype(np.float32) * 0.01
+
+    for start in np.arange(0, duration, 0.25):
+        f0 = 110 * 2 ** (rng.randint(0, 36) / 12)
+        env = np.exp(-np.maximum(t - start, 0) * 6) * (t >= start)
+        note = sum(np.sin(2 * np.pi * f0 * k * t) / k for k in range(1, 6)) * env
+        wave += np.stack([note * rng.uniform(0.2, 1), note * rng.uniform(0.2, 1)]).astype(np.float32) * 0.1
+
+    sf.write(path, wave.T, sr)
+
+def peak_rss_mb():
+    # peak resident memory of this process, or None where neither resource (unix) nor psutil is available.
+    # ru_maxrss is kilobytes on linux and bytes on macos; psutil only reports a peak on windows
+    try:
+        import resource
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return rss / 1024 ** 2 if sys.platform == 'darwin' else rss / 1024
+    except ImportError:
+        pass
+
+    try:
+        import psutil
+        info = psutil.Process().memory_info()
+        return getattr(info, 'peak_wset', info.rss) / 1024 ** 2
+    except ImportError:
+        return None
+
+def run(args, setting):
+    # one setting per child process, so peak rss belongs to that setting alone
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+
+    model = FrameTransformer(in_channels=2, out_channels=2, channels=args.channels, expansion=args.expansion, n_fft=args.n_fft, dropout=args.dropout, num_heads=args.num_heads, num_attention_maps=args.num_attention_maps)
+    sp = Separator(None, model, torch.device('cpu'), setting['batchsize'], setting['cropsize'], args.n_fft)
+    times = {}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        start = time.perf_counter()
+        X, sr = librosa.load(args.input, sr=args.sr, mono=False, dtype=np.float32, res_type='kaiser_fast')
+        times['decode'] = time.perf_counter() - start
+
+        if X.ndim == 1:
+            X = np.asarray([X, X])
+
+        start = time.perf_counter()
+        X_spec = spec_utils.wave_to_spectrogram(X, args.hop_length, args.n_fft)
+        times['stft'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        if setting['tta']:
+            # separate_tta's own cropsizes and paddings unless both are given
+            tta = { 'cropsizes': args.tta_cropsizes, 'paddings': args.tta_paddings } if args.tta_cropsizes is not None else {}
+            y_spec, _, _ = sp.separate_tta(X_spec, **tta)
+        else:
+            y_spec, _, _ = sp.separate(X_spec, padding=setting['padding'])
+        times['separate'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        wave = spec_utils.spectrogram_to_wave(y_spec, hop_length=args.hop_length)
+        times['istft'] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        sf.write(os.path.join(tmp, f'instruments.{args.output_format}'), wave.T, sr)
+        times['encode'] = time.perf_counter() - start
+
+    duration = X.shape[1] / sr
+    total = sum(times.values())
+
+    return {
+        **setting,
+        'duration_s': duration,
+        'frames': X_spec.shape[2],
+        'total_s': total,
+        'rtf': total / duration,
+        'throughput_x': duration / total,
+        'separate_frames_per_s': X_spec.shape[2] / times['separate'],
+        'stages_s': times,
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument('--input', '-i', type=str, default=None, help='audio file to separate, synthetic audio when omitted')
+    p.add_argument('--duration', type=float, default=30, help='seconds of synthetic audio')
+    p.add_argument('--output_format', type=str, default='flac')
+    p.add_argument('--seed', type=int, default=1)
+    p.add_argument('--sr', '-r', type=int, default=44100)
+    p.add_argument('--n_fft', '-f', type=int, default=2048)
+    p.add_argument('--hop_length', '-H', type=int, default=1024)
+    p.add_argument('--batchsizes', type=str, default='1,4')
+    p.add_argument('--cropsizes', type=str, default='256,512,1024')
+    p.add_argument('--paddings', type=str, default='0,512')
+    p.add_argument('--tta', action='store_true', help='also time separate_tta at each batchsize')
+    p.add_argument('--tta_cropsizes', type=str, default=None)
+    p.add_argument('--tta_paddings', type=str, default=None)
+    p.add_argument('--threads', type=int, default=None)
+
+    p.add_argument('--num_attention_maps', type=int, default=1)
+    p.add_argument('--channels', type=int, default=8)
+    p.add_argument('--expansion', type=float, default=2.2)
+    p.add_argument('--num_heads', type=int, default=8)
+    p.add_argument('--dropout', type=float, default=0.2)
+
+    p.add_argument('--output', type=str, default=None, help='json file for the results')
+    args = p.parse_args()
+
+    if (args.tta_cropsizes is None) != (args.tta_paddings is None):
+        p.error('--tta_cropsizes and --tta_paddings go together')
+
+    if args.tta_cropsizes is not None:
+        args.tta_cropsizes = [int(c) for c in args.tta_cropsizes.split(',')]
+        args.tta_paddings = [int(pad) for pad in args.tta_paddings.split(',')]
+
+    batchsizes = [int(b) for b in args.batchsizes.split(',')]
+    settings = [{ 'batchsize': b, 'cropsize': int(c), 'padding': int(pad), 'tta': False } for b, c, pad in itertools.product(batchsizes, args.cropsizes.split(','), args.paddings.split(','))]
+
+    if args.tta:
+        settings += [{ 'batchsize': b, 'cropsize': None, 'padding': None, 'tta': True } for b in batchsizes]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        if args.input is None:
+            args.input = os.path.join(tmp, 'synthetic.wav')
+            synthetic_audio(args.input, args.duration, args.sr, args.seed)
+
+        ctx = mp.get_context('spawn')
+        results = []
+
+        for setting in settings:
+            with ctx.Pool(1) as pool:
+                r = pool.apply(run, (args, setting))
+
+            results.append(r)
+
+            name = 'tta' if r['tta'] else f'cropsize {r["cropsize"]} padding {r["padding"]}'
+            stages = ' '.join(f'{stage} {r["stages_s"][stage]:.2f}s' for stage in STAGES)
+            rss = f'{r["peak_rss_mb"]:.0f} MB' if r['peak_rss_mb'] is not None else 'unavailable'
+            print(f'batchsize {r["batchsize"]} {name}: rtf {r["rtf"]:.3f} ({r["throughput_x"]:.2f}x realtime), {r["separate_frames_per_s"]:.0f} frames/s, peak rss {rss} | {stages}')
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump({ 'torch': torch.__version__, 'threads': args.threads or torch.get_num_threads(), 'args': vars(args), 'results': results }, f, indent=1)
+
+if __name__ == '__main__':
+    main()
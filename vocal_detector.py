@@ -2,35 +2,43 @@ import torch
 import torch.nn as nn
 import numpy as np
 import argparse
+import os
+import sys
 import torch.utils.data
 
-from lib.lr_scheduler_linear_warmup import LinearWarmupScheduler
-from lib.lr_scheduler_polynomial_decay import PolynomialDecayScheduler
+# the lr schedulers are in app/libft2gan
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'app'))
+
+from libft2gan.lr_scheduler_linear_warmup import LinearWarmupScheduler
+from libft2gan.lr_scheduler_polynomial_decay import PolynomialDecayScheduler
 
 class ValuesDataset(torch.utils.data.Dataset):
+    # the [vmin, vmean, vvar, vmed, mmin, mmean, mmax, med, flagged] rows written by vox_detect_data.py, held as one
+    # statistics tensor and one label tensor; batches() slices whole batches out of them without a dataloader
     def __init__(self, value_arrays=[]):
-        self.items = []
+        values = np.concatenate([np.asarray(arr, dtype=np.float32).reshape(-1, 9) for arr in value_arrays]) if len(value_arrays) > 0 else np.zeros((0, 9), dtype=np.float32)
+
+        self.values = torch.from_numpy(np.ascontiguousarray(values[:, :8]))
+        self.flagged = torch.from_numpy(np.ascontiguousarray(values[:, 8]))
 
-        for arr in value_arrays:
-            for value in arr:
-                self.items.append(value)
+    def to(self, device):
+        self.values = self.values.to(device)
+        self.flagged = self.flagged.to(device)
+        return self
 
     def __len__(self):
-        return len(self.items)
+        return len(self.values)
 
     def __getitem__(self, idx):
-        values = self.items[idx]
-        vmin = values[0]
-        vmean = values[1]
-        vvar = values[2]
-        vmed = values[3]
-        mmin = values[4]
-        mmean = values[5]
-        mmax = values[6]
-        med = values[7]
-        flagged = values[8]
-        
-        return np.array([vmin, vmean, vvar, vmed, mmin, mmean, mmax, med]).astype(np.float32), np.float32(flagged)
+        return self.values[idx], self.flagged[idx]
+
+    def batches(self, batch_size, shuffle=True, drop_last=True):
+        order = torch.randperm(len(self), device=self.values.device) if shuffle else torch.arange(len(self), device=self.values.device)
+        stop = len(self) - len(self) % batch_size if drop_last else len(self)
+
+        for i in range(0, stop, batch_size):
+            idx = order[i:i + batch_size]
+            yield self.values[idx], self.flagged[idx]
 
 class ResBlock(nn.Module):
     def __init__(self, in_features):
@@ -76,15 +84,8 @@ def main():
 
     data = [np.load(d)['values'] for d in args.data]
 
-    dataset = ValuesDataset(data)
-    dataloader = torch.utils.data.DataLoader(
-        dataset=dataset,
-        batch_size=args.batchsize,
-        shuffle=True,
-        num_workers=4,
-        drop_last=True)
-
     device = torch.device('cuda')
+    dataset = ValuesDataset(data).to(device)
     model = VocalDetector(in_features=8, latent_features=args.latent_features, num_layers=args.num_layers)
     model = model.to(device)
     crit = nn.BCEWithLogitsLoss()
@@ -111,10 +112,7 @@ def main():
 
         epoch_loss = 0
 
-        for X, Y in dataloader:
-            X = X.to(device)
-            Y = Y.to(device)
-
+        for X, Y in dataset.batches(args.batchsize):
             pred = model(X).squeeze(-1)
             loss = crit(pred, Y)
             loss.backward()
@@ -1,7 +1,18 @@
 import argparse
+import csv
+import glob
+import os
+import shutil
+import sys
 import numpy as np
 import torch
-from libft.dataset_detection import VoxDetectDataset
+import torch.multiprocessing as mp
+from tqdm import tqdm
+
+# libft2gan lives in app/; lib is the one next to this script
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'app'))
+
+from libft2gan.patch_shards import is_shard_library, list_patches, load_patch, patch_library, patch_name
 from lib import dataset
 from lib import spec_utils
 from lib import nets
@@ -112,100 +123,165 @@ class Separator(object):
 
         return y_spec, v_spec, m_spec
 
-def main():
-    p = argparse.ArgumentParser()
-    p.add_argument('--gpu', '-g', type=int, default=-1)
-    p.add_argument('--pretrained_model', '-P', type=str, default='baseline.pth')
-    p.add_argument('--vocal_detector', type=str, default="voxdetector.pth")
-    p.add_argument('--input', '-i', required=True)
-    p.add_argument('--output', '-o', type=str, default="G://dataset//novx")
-    p.add_argument('--sr', '-r', type=int, default=44100)
-    p.add_argument('--n_fft', '-f', type=int, default=2048)
-    p.add_argument('--hop_length', '-H', type=int, default=1024)
-    p.add_argument('--batchsize', '-B', type=int, default=16)
-    p.add_argument('--cropsize', '-c', type=int, default=128)
-    p.add_argument('--padding', type=int, default=64)
+COLUMNS = ['path', 'score', 'vmin', 'vmean', 'vvar', 'vmed', 'mmin', 'mmean', 'mmax', 'mmed']
 
-    p.add_argument('--instrumental_lib', type=str, default="C://cs2048_sr44100_hl1024_nf2048_of0|D://cs2048_sr44100_hl1024_nf2048_of0|F://cs2048_sr44100_hl1024_nf2048_of0|H://cs2048_sr44100_hl1024_nf2048_of0")
-    p.add_argument('--num_heads', type=int, default=8)
-    p.add_argument('--channels', type=int, default=8)
-    p.add_argument('--num_res_blocks', type=int, default=1)
-    p.add_argument('--feedforward_expansion', type=int, default=24)
-    p.add_argument('--dropout', type=float, default=0.1)
+class PatchDataset(torch.utils.data.Dataset):
+    # instrumental patches as CascadedNet input, with their position in the patch list
+    def __init__(self, patches, max_bin):
+        self.patches = patches
+        self.max_bin = max_bin
 
-    args = p.parse_args()
+    def __len__(self):
+        return len(self.patches)
 
-    args.flag = str.lower(args.flag) == 'true'
-    args.include_phase = str.lower(args.include_phase) == 'true'
-    args.cropsizes = [int(cropsize) for cropsize in args.cropsizes.split(',')]
-    args.instrumental_lib = [p for p in args.instrumental_lib.split('|')]
+    def __getitem__(self, idx):
+        data = load_patch(self.patches[idx])
+        X = np.abs(data['X'][:, :self.max_bin]) / data['c']
+
+        return X.astype(np.float32), idx
+
+def patch_path(patch):
+    return os.path.join(patch_library(patch), patch_name(patch))
+
+def batch_statistics(X, mask):
+    # the eight VocalDetector inputs of every item at once: min, mean, var and median of the vocal residual, then
+    # min, mean, max and median of the mask. medians are the lower median, as torch.median over a whole patch
+    v = (X * (1 - mask)).flatten(1)
+    m = mask.flatten(1)
+    S = torch.stack((v, m), dim=1)
 
-    print('loading model...', end=' ')
-    device = torch.device('cpu')
+    mins = S.amin(dim=2)
+    means = S.mean(dim=2)
+    medians = S.median(dim=2).values
+
+    return torch.stack((mins[:, 0], means[:, 0], v.var(dim=1), medians[:, 0], mins[:, 1], means[:, 1], m.amax(dim=1), medians[:, 1]), dim=1)
+
+def read_results(results):
+    # results of earlier (or interrupted) runs, including the part files of scan processes that did not get merged
+    rows = {}
+    for path in [results] + sorted(glob.glob(f'{glob.escape(results)}.part*')):
+        if os.path.exists(path):
+            with open(path, newline='') as f:
+                for row in csv.DictReader(f):
+                    rows[row['path']] = row
+
+    return rows
+
+def write_results(results, rows):
+    with open(f'{results}.tmp', 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=COLUMNS)
+        writer.writeheader()
+        writer.writerows(rows.values())
+
+    os.replace(f'{results}.tmp', results)
+
+    for path in glob.glob(f'{glob.escape(results)}.part*'):
+        os.remove(path)
+
+def scan(rank, gpus, patches, args):
+    # one scan process per device, each over every len(gpus)-th remaining patch, appending to its own part file
+    # after every batch so an interrupted scan loses at most a batch
+    device = torch.device(f'cuda:{gpus[rank]}') if gpus[rank] >= 0 and torch.cuda.is_available() else torch.device('cpu')
 
     model = nets.CascadedNet(args.n_fft, 32, 128)
     model.load_state_dict(torch.load(args.pretrained_model, map_location=device))
+    model.to(device)
+    model.eval()
 
     detector = VocalDetector(latent_features=1024, num_layers=24)
     detector.load_state_dict(torch.load(args.vocal_detector, map_location=device))
+    detector.to(device)
     detector.eval()
 
-    if torch.cuda.is_available() and args.gpu >= 0:
-        device = torch.device('cuda:{}'.format(args.gpu))
-        model.to(device)
-        detector.to(device)
-    print('done')
-
-    dataset = VoxDetectDataset(
-        path=args.instrumental_lib,
-        vocal_path=[],
-        is_validation=False,
-        inst_rate=1
-    )
-
+    patches = patches[rank::len(gpus)]
     dataloader = torch.utils.data.DataLoader(
-        dataset=dataset,
-        batch_size=1,
-        num_workers=4,
-        prefetch_factor=4,
+        dataset=PatchDataset(patches, model.max_bin),
+        batch_size=args.batchsize,
+        num_workers=args.num_workers,
+        prefetch_factor=4 if args.num_workers > 0 else None,
+        pin_memory=device.type == 'cuda',
         shuffle=False
     )
 
-    model.eval()
+    with open(f'{args.results}.part{rank}', 'a', newline='') as f:
+        writer = csv.writer(f)
+
+        if f.tell() == 0:
+            writer.writerow(COLUMNS)
+
+        with torch.no_grad():
+            for X, idx in tqdm(dataloader, disable=rank != 0):
+                X = X.to(device, non_blocking=True)
+
+                with torch.cuda.amp.autocast_mode.autocast(enabled=device.type == 'cuda'):
+                    mask = model(X)
+
+                values = batch_statistics(X, mask.float())
+                scores = torch.sigmoid(detector(values))[:, 0]
+                rows = torch.cat((scores.unsqueeze(1), values), dim=1).cpu().numpy()
+
+                writer.writerows([patch_path(patches[i])] + row.tolist() for i, row in zip(idx.tolist(), rows))
+                f.flush()
+
+def quarantine(path):
+    library = os.path.dirname(path)
+
+    if is_shard_library(library):
+        print(f'{library}: cannot move {os.path.basename(path)} out of a shard library, rebuild it without the patch')
+        return False
+
+    if not os.path.exists(path):
+        return False
+
+    vox_dir = os.path.join(library, 'vox')
+    os.makedirs(vox_dir, exist_ok=True)
+    shutil.move(path, os.path.join(vox_dir, os.path.basename(path)))
+
+    return True
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument('--gpu', '-g', type=str, default='-1', help='comma separated devices, one scan process each')
+    p.add_argument('--pretrained_model', '-P', type=str, default='baseline.pth')
+    p.add_argument('--vocal_detector', type=str, default="voxdetector.pth")
+    p.add_argument('--n_fft', '-f', type=int, default=2048)
+    p.add_argument('--batchsize', '-B', type=int, default=16)
+    p.add_argument('--num_workers', type=int, default=4)
+    p.add_argument('--instrumental_lib', type=str, default="C://cs2048_sr44100_hl1024_nf2048_of0|D://cs2048_sr44100_hl1024_nf2048_of0|F://cs2048_sr44100_hl1024_nf2048_of0|H://cs2048_sr44100_hl1024_nf2048_of0")
+    p.add_argument('--results', type=str, default='vox_detect.csv')
+    p.add_argument('--threshold', type=float, default=0.5)
+    p.add_argument('--quarantine', type=str, default='false')
+    args = p.parse_args()
+
+    args.gpu = [int(g) for g in args.gpu.split(',')]
+    args.instrumental_lib = [p for p in args.instrumental_lib.split('|')]
+    args.quarantine = str.lower(args.quarantine) == 'true'
+
+    # patches already in the results are not scanned again
+    rows = read_results(args.results)
+    write_results(args.results, rows)
+
+    patches = [patch for library in args.instrumental_lib for patch in sorted(list_patches(library), key=patch_name)]
+    remaining = [patch for patch in patches if patch_path(patch) not in rows]
+    print(f'{len(remaining)} patches to scan, {len(patches) - len(remaining)} already in {args.results}')
+
+    if len(remaining) > 0:
+        if len(args.gpu) > 1:
+            mp.spawn(scan, args=(args.gpu, remaining, args), nprocs=len(args.gpu), join=True)
+        else:
+            scan(0, args.gpu, remaining, args)
+
+        rows = read_results(args.results)
+        write_results(args.results, rows)
+
+    flagged = sorted((row for row in rows.values() if float(row['score']) > args.threshold), key=lambda row: -float(row['score']))
+    print(f'{len(flagged)} of {len(rows)} patches score above {args.threshold}')
+
+    for row in flagged:
+        print(f'{row["path"]} f={float(row["score"]):.3f} mask min={float(row["mmin"]):.3f} avg={float(row["mmean"]):.3f} max={float(row["mmax"]):.3f}')
 
-    for X, s in dataloader:
-        X = X.to(device)
-        
-        with torch.cuda.amp.autocast_mode.autocast():
-            mask = model(X)
-
-        v = X * (1 - mask)
-
-        vmin = v.min()
-        vmean = v.mean()
-        vvar = v.var()
-        vmed = torch.median(v)
-        mmin = mask.min()
-        mmean = mask.mean()
-        mmax = mask.max()
-        med = torch.median(mask)
-
-        d = [
-            vmin,
-            vmean,
-            vvar,
-            vmed,
-            mmin,
-            mmean,
-            mmax,
-            med
-        ]
-
-        values = torch.tensor(d, dtype=torch.float32, device=device).unsqueeze(0)
-        f = torch.sigmoid(detector(values))[0].item()
-
-        if f > 0.5:
-            print(f'{s} min={mask.min()} avg={mask.mean()} max={mask.max()} f={f}')
+        if args.quarantine:
+            quarantine(row['path'])
 
 if __name__ == '__main__':
     main()
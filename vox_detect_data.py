@@ -1,4 +1,5 @@
 import argparse
+import hashlib
 import os
 import shutil
 import librosa
@@ -24,6 +25,56 @@ from lib import nets
 
 import ffmpeg
 
+FEATURES = ['vmin', 'vmean', 'vvar', 'vmed', 'mmin', 'mmean', 'mmax', 'mmed']
+FEATURE_DTYPE = np.dtype([('content', 'S40'), ('checkpoint', 'S40')] + [(f, np.float32) for f in FEATURES])
+
+def file_hash(path):
+    h = hashlib.sha1()
+
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+
+    return h.hexdigest()
+
+class FeatureCache(object):
+    # the mask statistics of every separated file as one structured array (a column per statistic), keyed by the
+    # sha1 of the file and of the separator checkpoint, so files are only separated again for a new checkpoint
+    def __init__(self, path, checkpoint):
+        self.path = path
+        self.checkpoint = checkpoint.encode()
+        self.table = np.load(path) if path is not None and os.path.exists(path) else np.zeros(0, dtype=FEATURE_DTYPE)
+        self.added = []
+
+        mine = self.table[self.table['checkpoint'] == self.checkpoint]
+        self.lookup = dict(zip(mine['content'].tolist(), np.stack([mine[f] for f in FEATURES], axis=1).tolist()))
+
+    def get(self, content):
+        return self.lookup.get(content.encode())
+
+    def add(self, content, values):
+        row = np.zeros(1, dtype=FEATURE_DTYPE)
+        row['content'] = content.encode()
+        row['checkpoint'] = self.checkpoint
+
+        for f, v in zip(FEATURES, values):
+            row[f] = v
+
+        self.added.append(row)
+        self.lookup[content.encode()] = [float(v) for v in values]
+
+    def save(self):
+        if self.path is None or len(self.added) == 0:
+            return
+
+        self.table = np.concatenate([self.table] + self.added)
+        self.added = []
+
+        with open(f'{self.path}.tmp', 'wb') as f:
+            np.save(f, self.table)
+
+        os.replace(f'{self.path}.tmp', self.path)
+
 class Separator(object):
 
     def __init__(self, corrector, model, device, batchsize, cropsize, n_fft, postprocess=False):
@@ -153,6 +204,7 @@ def main():
     p.add_argument('--bias', type=str, default='true')
     p.add_argument('--flag', type=str, default='false')
     p.add_argument('--name', type=str, default=None)
+    p.add_argument('--cache', type=str, default='vox_features.npy')
 
     p.add_argument('--include_phase', type=str, default='false')
     p.add_argument('--num_heads', type=int, default=8)
@@ -212,55 +264,64 @@ def main():
         curr_avg = 0
 
         values = []
+        keys = []
+
+        # statistics depend on the separation settings as much as on the weights, so both make up the checkpoint key
+        settings = f'{args.sr},{args.n_fft},{args.hop_length},{args.cropsize},{args.padding},{args.tta},{args.postprocess},{args.include_phase}'
+        cache = FeatureCache(args.cache, hashlib.sha1(f'{file_hash(args.pretrained_model)},{settings}'.encode()).hexdigest())
 
         idx = 0
         pbar = tqdm(files)
         for file in pbar:
-            X, sr = librosa.load(
-                file, args.sr, False, dtype=np.float32, res_type='kaiser_fast')
-            basename = os.path.splitext(os.path.basename(file))[0]
-
-            if X.ndim == 1:
-                X = np.asarray([X, X])
-
-            X_spec = spec_utils.wave_to_spectrogram(X, args.hop_length, args.n_fft)
-
-            sp = Separator(None, model, device, args.batchsize, args.cropsize, args.n_fft,   args.postprocess)
-
-            if args.tta:
-                y_spec, v_spec, m_spec = sp.separate_tta(X_spec)
-            else:
-                y_spec, v_spec, m_spec, mask = sp.separate(X_spec, padding=args.padding, include_phase=args.include_phase)
-
-            v = np.abs(v_spec)
-            v = v / v.max()
-
-            vmin = v.min()
-            vmean = v.mean()
-            vvar = v.var()
-            vmed = np.median(v)
-            mmin = mask.min()
-            mmean = mask.mean()
-            mmax = mask.max()
-            med = np.median(mask)
-
-            values.append([
-                vmin,
-                vmean,
-                vvar,
-                vmed,
-                mmin,
-                mmean,
-                mmax,
-                med,
-                1 if args.flag else 0
-            ])
-
-            pbar.set_description_str(f'{vmin} {vmean} {vvar} {vmed} {mmin} {mmean} {mmax} {med}')
-
-            del X_spec
-
-        np.savez(f'{args.name}.npz', values=values)
+            key = file_hash(file)
+            stats = cache.get(key)
+
+            if stats is None:
+                X, sr = librosa.load(
+                    file, args.sr, False, dtype=np.float32, res_type='kaiser_fast')
+                basename = os.path.splitext(os.path.basename(file))[0]
+
+                if X.ndim == 1:
+                    X = np.asarray([X, X])
+
+                X_spec = spec_utils.wave_to_spectrogram(X, args.hop_length, args.n_fft)
+
+                sp = Separator(None, model, device, args.batchsize, args.cropsize, args.n_fft,   args.postprocess)
+
+                if args.tta:
+                    y_spec, v_spec, m_spec = sp.separate_tta(X_spec)
+                else:
+                    y_spec, v_spec, m_spec, mask = sp.separate(X_spec, padding=args.padding, include_phase=args.include_phase)
+
+                v = np.abs(v_spec)
+                v = v / v.max()
+
+                stats = [
+                    v.min(),
+                    v.mean(),
+                    v.var(),
+                    np.median(v),
+                    mask.min(),
+                    mask.mean(),
+                    mask.max(),
+                    np.median(mask)
+                ]
+
+                cache.add(key, stats)
+
+                # a long run keeps what it has separated so far
+                if len(cache.added) >= 64:
+                    cache.save()
+
+                del X_spec
+
+            values.append(list(stats) + [1 if args.flag else 0])
+            keys.append(key)
+
+            pbar.set_description_str(' '.join(str(v) for v in stats))
+
+        cache.save()
+        np.savez(f'{args.name}.npz', values=np.array(values, dtype=np.float32), keys=np.array(keys))
     else:
         print('loading wave source...', end=' ')
         X, sr = librosa.load(